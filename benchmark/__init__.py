@@ -0,0 +1,134 @@
+"""\
+Benchmark suite for msgpack-rpc-python.
+
+Starts a local server in a child process and measures sequential,
+pipelined, multi-client and notify (blocking, queued and batched)
+throughput, latency percentiles, payload throughput, large blob throughput
+and peak client memory with and without zero-copy writes, and server CPU
+time per request. Run from the repository root:
+
+    % python -m benchmark --output result.json
+
+Results are written as JSON (see run()), so that runs can be compared to
+catch regressions in the session and transport hot paths.
+"""
+
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import msgpack
+import tornado
+
+import msgpackrpc
+from benchmark import scenarios
+from benchmark.server import ServerProcess
+
+SCENARIOS = ('sequential', 'pipelined', 'multi_client', 'notify', 'notify_async', 'payload', 'blob')
+
+DEFAULT_SIZES = (16, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 32 * 1024 * 1024)
+
+BLOB_SIZES = (16 * 1024 * 1024, 100 * 1024 * 1024)
+
+
+def run(names=SCENARIOS, builder='tcp', num=10000, depth=32, clients=4, sizes=DEFAULT_SIZES,
+        blob_sizes=BLOB_SIZES, log=None):
+    """\
+    Runs the scenarios in *names* against a fresh server and returns
+    {'meta': {...}, 'results': [...]}. Each result has the scenario name,
+    its parameters, requests, seconds, requests_per_second, latency
+    percentiles in seconds (when measured) and server_cpu_per_request; blob
+    results also have baseline_rss and peak_rss of the client in bytes.
+    """
+
+    tempdir = tempfile.mkdtemp()
+    address = _address(builder, tempdir)
+    server = ServerProcess(address, builder)
+    server.start()
+    try:
+        probe = scenarios.connect(address, builder)
+        results = []
+        for name in names:
+            for params in _parameters(name, num, depth, clients, sizes, blob_sizes):
+                cpu = probe.call('cpu_time')
+                result = getattr(scenarios, name)(address, builder, **params)
+                cpu = probe.call('cpu_time') - cpu
+
+                result['scenario'] = name
+                result['params'] = params
+                result['server_cpu_per_request'] = cpu / result['requests']
+                results.append(result)
+                if log is not None:
+                    log(_summary(result))
+        probe.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    return {'meta': _meta(builder), 'results': results}
+
+
+def _parameters(name, num, depth, clients, sizes, blob_sizes):
+    if name == 'pipelined':
+        return [dict(num=num, depth=depth)]
+    if name == 'multi_client':
+        return [dict(num=max(1, num // clients), clients=clients)]
+    if name == 'notify_async':
+        return [dict(num=num, batch=1), dict(num=num, batch=depth)]
+    if name == 'payload':
+        return [dict(size=size, num=max(3, min(num, 256 * 1024 * 1024 // size))) for size in sizes]
+    if name == 'blob':
+        return [dict(size=size, num=max(3, min(num, 1024 * 1024 * 1024 // size)), zero_copy=zero_copy)
+                for size in blob_sizes for zero_copy in (False, True)]
+    return [dict(num=num)]
+
+
+def _address(builder, tempdir):
+    if builder == 'tcp':
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return msgpackrpc.Address('localhost', port)
+    return msgpackrpc.UnixAddress(os.path.join(tempdir, 'bench.sock'))
+
+
+def _meta(builder):
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'builder': builder,
+        'msgpackrpc': msgpackrpc.__version__,
+        'msgpack': '.'.join(str(part) for part in msgpack.version),
+        'tornado': tornado.version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': _cpu_count(),
+    }
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+def _summary(result):
+    line = "{0:<13} {1:<28} {2:>10.0f} req/s".format(
+        result['scenario'], json.dumps(result['params'], sort_keys=True), result['requests_per_second'])
+    if 'p50' in result:
+        line += "  p50 {0:.1f} us  p99 {1:.1f} us  p999 {2:.1f} us".format(
+            result['p50'] * 1e6, result['p99'] * 1e6, result['p999'] * 1e6)
+    if 'bytes_per_second' in result:
+        line += "  {0:.1f} MB/s".format(result['bytes_per_second'] / (1024 * 1024))
+    if 'peak_rss' in result:
+        line += "  rss {0:.0f} -> {1:.0f} MB".format(result['baseline_rss'] / (1024.0 * 1024),
+                                                   result['peak_rss'] / (1024.0 * 1024))
+    return line + "  cpu {0:.1f} us/req".format(result['server_cpu_per_request'] * 1e6)
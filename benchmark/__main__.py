@@ -0,0 +1,39 @@
+import argparse
+import json
+import sys
+
+import benchmark
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description=benchmark.__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=benchmark.SCENARIOS,
+                        help="scenario to run; may be repeated (default: all)")
+    parser.add_argument('--builder', default='tcp', choices=['tcp', 'unix', 'shm'])
+    parser.add_argument('--num', type=int, default=10000, help="requests per scenario")
+    parser.add_argument('--depth', type=int, default=32, help="window size of the pipelined scenario")
+    parser.add_argument('--clients', type=int, default=4, help="processes of the multi_client scenario")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in benchmark.DEFAULT_SIZES),
+                        help="comma separated payload sizes in bytes")
+    parser.add_argument('--blob-sizes', default=','.join(str(size) for size in benchmark.BLOB_SIZES),
+                        help="comma separated blob sizes in bytes")
+    parser.add_argument('--output', help="file to write the JSON result to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    def log(line):
+        sys.stderr.write(line + "\n")
+
+    result = benchmark.run(args.scenario or benchmark.SCENARIOS, args.builder, args.num, args.depth,
+                           args.clients, [int(size) for size in args.sizes.split(',')],
+                           [int(size) for size in args.blob_sizes.split(',')], log=log)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""\
+Benchmark scenarios. Each takes the server address, the builder name and
+its parameters, and returns a dict with at least requests, seconds and
+requests_per_second.
+"""
+
+import multiprocessing
+import sys
+import time
+
+import msgpackrpc
+from msgpackrpc.compat import monotonic
+from msgpackrpc.metrics import Histogram
+from benchmark.server import BUILDERS
+
+
+def connect(address, builder, **options):
+    # Without Nagle's algorithm, as for the server.
+    options.setdefault('nodelay', True)
+    return msgpackrpc.Client(address, timeout=60, builder=BUILDERS[builder], **options)
+
+
+def sequential(address, builder, num):
+    """\
+    One call at a time on one connection.
+    """
+
+    client = connect(address, builder, metrics=True)
+    client.call('sum', 1, 2)
+    client.metrics.reset()
+
+    before = monotonic()
+    for x in range(num):
+        client.call('sum', 1, 2)
+    seconds = monotonic() - before
+
+    latency = client.metrics.method('sum').latency
+    client.close()
+    return _result(num, seconds, latency)
+
+
+def pipelined(address, builder, num, depth):
+    """\
+    Windows of *depth* calls sent back-to-back, waiting for each window.
+    """
+
+    client = connect(address, builder, metrics=True)
+    client.call('sum', 1, 2)
+    client.metrics.reset()
+
+    window = [('sum', (1, 2))] * depth
+    batches = max(1, num // depth)
+    before = monotonic()
+    for x in range(batches):
+        client.wait_all(client.call_many_async(window))
+    seconds = monotonic() - before
+
+    latency = client.metrics.method('sum').latency
+    client.close()
+    return _result(batches * depth, seconds, latency)
+
+
+def multi_client(address, builder, num, clients):
+    """\
+    *clients* processes, each making *num* sequential calls on its own
+    connection. Throughput is measured over the span from the first start
+    to the last finish.
+    """
+
+    start = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_client_process, args=(address, builder, num, start, queue))
+                 for x in range(clients)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        queue.get()  # connected
+    start.set()
+    reports = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+
+    latency = Histogram()
+    for began, ended, histogram in reports:
+        latency.merge(histogram)
+    seconds = max(report[1] for report in reports) - min(report[0] for report in reports)
+    return _result(num * clients, seconds, latency)
+
+
+def _client_process(address, builder, num, start, queue):
+    client = connect(address, builder, metrics=True)
+    client.call('sum', 1, 2)
+    client.metrics.reset()
+    queue.put(None)
+
+    start.wait()
+    began = time.time()
+    for x in range(num):
+        client.call('sum', 1, 2)
+    ended = time.time()
+
+    queue.put((began, ended, client.metrics.method('sum').latency))
+    client.close()
+
+
+def notify(address, builder, num):
+    """\
+    *num* notifications followed by one call, which returns once the server
+    has processed all of them.
+    """
+
+    client = connect(address, builder)
+    client.call('sum', 1, 2)
+
+    before = monotonic()
+    for x in range(num):
+        client.notify('sum', 1, 2)
+    client.call('sum', 1, 2)
+    seconds = monotonic() - before
+
+    client.close()
+    return _result(num, seconds)
+
+
+def notify_async(address, builder, num, batch):
+    """\
+    *num* notifications queued with notify_async (or notify_many in groups
+    of *batch* when batch > 1) without running the loop, then flush() and
+    one call.
+    """
+
+    client = connect(address, builder)
+    client.call('sum', 1, 2)
+
+    before = monotonic()
+    if batch > 1:
+        group = [('sum', (1, 2))] * batch
+        for x in range(max(1, num // batch)):
+            client.notify_many(group)
+        num = max(1, num // batch) * batch
+    else:
+        for x in range(num):
+            client.notify_async('sum', 1, 2)
+    client.flush()
+    client.call('sum', 1, 2)
+    seconds = monotonic() - before
+
+    client.close()
+    return _result(num, seconds)
+
+
+def payload(address, builder, num, size):
+    """\
+    Echoes a bytes value of *size* bytes *num* times.
+    """
+
+    client = connect(address, builder, metrics=True)
+    data = b'x' * size
+    client.call('echo', data)
+    client.metrics.reset()
+
+    before = monotonic()
+    for x in range(num):
+        client.call('echo', data)
+    seconds = monotonic() - before
+
+    latency = client.metrics.method('echo').latency
+    client.close()
+    result = _result(num, seconds, latency)
+    result['bytes_per_second'] = size * num / seconds
+    return result
+
+
+def blob(address, builder, num, size, zero_copy):
+    """\
+    Sends a bytearray of *size* bytes *num* times to a method which returns
+    its length, with or without zero-copy writes, from a child process so
+    that its peak RSS covers this run only. Reports the peak RSS and the
+    RSS before the first call (after allocating the payload) in bytes.
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_blob_process, args=(address, builder, num, size, zero_copy, queue))
+    process.start()
+    seconds, baseline_rss, peak_rss = queue.get()
+    process.join()
+
+    result = _result(num, seconds)
+    result['bytes_per_second'] = size * num / seconds
+    result['baseline_rss'] = baseline_rss
+    result['peak_rss'] = peak_rss
+    return result
+
+
+def _blob_process(address, builder, num, size, zero_copy, queue):
+    client = connect(address, builder, zero_copy_threshold=64 * 1024 if zero_copy else 0)
+    client.call('sum', 1, 2)
+    data = bytearray(size)
+    data[::4096] = b'x' * len(range(0, size, 4096))  # make its pages resident
+    baseline_rss = _peak_rss()
+
+    before = monotonic()
+    for x in range(num):
+        client.call('size', data)
+    seconds = monotonic() - before
+
+    queue.put((seconds, baseline_rss, _peak_rss()))
+    client.close()
+
+
+def _peak_rss():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _result(requests, seconds, latency=None):
+    result = dict(requests=requests, seconds=seconds, requests_per_second=requests / seconds)
+    if latency is not None and latency.count:
+        for name, percent in (('p50', 50), ('p99', 99), ('p999', 99.9)):
+            result[name] = latency.percentile(percent) / 1e6
+        result['mean'] = latency.mean / 1e6
+        result['max'] = latency.max / 1e6
+    return result
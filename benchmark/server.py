@@ -0,0 +1,63 @@
+"""\
+Benchmark server, run in a child process.
+"""
+
+import multiprocessing
+import os
+
+import msgpackrpc
+from msgpackrpc.transport import shm, tcp, unix
+
+BUILDERS = {'tcp': tcp, 'unix': unix, 'shm': shm}
+
+
+class BenchServer(object):
+    def sum(self, x, y):
+        return x + y
+
+    def echo(self, data):
+        return data
+
+    def size(self, data):
+        return len(data)
+
+    def cpu_time(self):
+        """\
+        Returns the user and system CPU seconds used by the server so far.
+        """
+
+        times = os.times()
+        return times[0] + times[1]
+
+
+def _serve(address, builder, ready):
+    # Responses written one by one must not wait for delayed ACKs.
+    server = msgpackrpc.Server(BenchServer(), builder=BUILDERS[builder], nodelay=True)
+    server.listen(address)
+    ready.set()
+    try:
+        server.start()
+    finally:
+        server.close()
+
+
+class ServerProcess(object):
+    def __init__(self, address, builder='tcp'):
+        self._address = address
+        self._builder = builder
+        self._process = None
+
+    def start(self):
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_serve, args=(self._address, self._builder, ready))
+        self._process.daemon = True
+        self._process.start()
+        if not ready.wait(10):
+            self.stop()
+            raise RuntimeError("benchmark server did not start")
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+        self._process = None
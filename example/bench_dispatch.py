@@ -0,0 +1,49 @@
+"""\
+Measures the per-call overhead of Server.dispatch without any I/O.
+
+"before" replays the old hasattr/getattr/force_str lookup, "after" goes
+through the dispatch table built at Server.__init__.
+"""
+
+import functools
+import time
+
+import msgpackrpc
+from msgpackrpc.compat import force_str
+from msgpackrpc.server import _NullResponder
+
+Num = 1000000
+
+
+class SumServer(object):
+    def sum(self, x, y):
+        return x + y
+
+
+def dispatch_by_getattr(dispatcher, method, param, responder):
+    try:
+        method = force_str(method)
+        if not hasattr(dispatcher, method):
+            raise msgpackrpc.error.NoMethodError("'{0}' method not found".format(method))
+        responder.set_result(getattr(dispatcher, method)(*param))
+    except Exception as e:
+        responder.set_error(str(e))
+
+
+def run(name, dispatch, method):
+    responder = _NullResponder()
+    param = (1, 2)
+    before = time.time()
+    for x in range(Num):
+        dispatch(method, param, responder)
+    diff = time.time() - before
+
+    print("{0}: {1:.3f} usec/call".format(name, diff / Num * 1e6))
+
+
+server = msgpackrpc.Server(SumServer())
+dispatcher = server._dispatcher
+
+for method in ('sum', b'sum'):
+    run("before ({0!r})".format(method), functools.partial(dispatch_by_getattr, dispatcher), method)
+    run("after  ({0!r})".format(method), server.dispatch, method)
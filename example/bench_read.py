@@ -0,0 +1,49 @@
+"""\
+Compares the client receive paths for large responses:
+read_into=True (recv_into a reusable buffer) vs read_into=False
+(IOStream.read_until_close).
+"""
+
+import threading
+import time
+
+import msgpackrpc
+
+Port = 18801
+Sizes = [(1024, 10000), (1024 * 1024, 200), (64 * 1024 * 1024, 4)]
+
+
+class BlobServer(object):
+    def __init__(self):
+        self._blobs = {}
+
+    def blob(self, size):
+        if size not in self._blobs:
+            self._blobs[size] = b'x' * size
+        return self._blobs[size]
+
+
+def run(read_into, size, num):
+    client = msgpackrpc.Client(msgpackrpc.Address("localhost", Port), timeout=60, read_into=read_into)
+    client.call('blob', size)  # warm up the connection and the server cache
+    before = time.time()
+    for x in range(num):
+        client.call('blob', size)
+    diff = time.time() - before
+    client.close()
+
+    print("read_into={0} size={1}: {2:.1f} calls/s, {3:.1f} MB/s".format(
+        read_into, size, num / diff, size * num / diff / (1024 * 1024)))
+
+
+server = msgpackrpc.Server(BlobServer())
+server.listen(msgpackrpc.Address("localhost", Port))
+thread = threading.Thread(target=server.start)
+thread.daemon = True
+thread.start()
+
+for size, num in Sizes:
+    for read_into in (False, True):
+        run(read_into, size, num)
+
+server.stop()
@@ -1,9 +0,0 @@
-import msgpackrpc
-
-class SumServer(object):
-    def sum(self, x, y):
-        return x + y
-
-server = msgpackrpc.Server(SumServer())
-server.listen(msgpackrpc.Address("localhost", 18800))
-server.start()
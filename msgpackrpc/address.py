@@ -1,17 +1,140 @@
 import socket
+import threading
 
 from tornado.platform.auto import set_close_exec
 
+from msgpackrpc.compat import monotonic
+
+
+class ResolverStats(object):
+    """\
+    Counts the lookups of a Resolver, how many were answered from its cache
+    or by the lookup already in flight for the same name, and the seconds
+    spent in getaddrinfo for the others.
+    """
+
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    @property
+    def mean_seconds(self):
+        if self.misses == 0:
+            return 0.0
+        return self.seconds / self.misses
+
+
+class _Lookup(object):
+    __slots__ = ('done', 'addresses', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.addresses = None
+        self.error = None
+
+
+class Resolver(object):
+    """\
+    Caches getaddrinfo results for *ttl* seconds, as measured by *clock*.
+    Addresses share the default resolver unless given their own.
+
+    Concurrent misses for the same name wait for a single getaddrinfo call.
+    """
+
+    def __init__(self, ttl=60, clock=monotonic):
+        self._ttl = ttl
+        self._clock = clock
+        self._cache = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = ResolverStats()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        """\
+        Returns the (family, socktype, proto, sockaddr) tuples of the stream
+        addresses of *host*, in getaddrinfo's order.
+        """
+
+        key = (host, port, family)
+        with self._lock:
+            self.stats.lookups += 1
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self.stats.hits += 1
+                return entry[1]
+            lookup = self._inflight.get(key)
+            if lookup is None:
+                lookup = self._inflight[key] = _Lookup()
+                self.stats.misses += 1
+                owner = True
+            else:
+                self.stats.coalesced += 1
+                owner = False
+
+        if not owner:
+            lookup.done.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.addresses
+
+        started = monotonic()
+        try:
+            lookup.addresses = self.lookup(host, port, family)
+        except Exception as e:
+            lookup.error = e
+            with self._lock:
+                self.stats.failures += 1
+            raise
+        finally:
+            seconds = monotonic() - started
+            with self._lock:
+                self.stats.seconds += seconds
+                self.stats.max_seconds = max(self.stats.max_seconds, seconds)
+                if lookup.addresses is not None and self._ttl > 0:
+                    self._cache[key] = (self._clock() + self._ttl, lookup.addresses)
+                del self._inflight[key]
+            lookup.done.set()
+        return lookup.addresses
+
+    def lookup(self, host, port, family=socket.AF_UNSPEC):
+        """\
+        Resolves *host* without the cache; resolve() calls it on a miss.
+        """
+
+        infos = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+        addresses = []
+        for af, socktype, proto, canonname, sockaddr in infos:
+            if (af, socktype, proto, sockaddr) not in addresses:
+                addresses.append((af, socktype, proto, sockaddr))
+        return addresses
+
+    def invalidate(self, host, port, family=socket.AF_UNSPEC):
+        with self._lock:
+            self._cache.pop((host, port, family), None)
+
+
+default_resolver = Resolver()
+
 
 class Address(object):
     """\
     The class to represent the RPC address.
+
+    Its host is resolved through *resolver* (the shared default_resolver
+    unless given), so reconnects reuse a recent result. Clients try every
+    resolved address (see the connect_delay transport option).
     """
 
-    def __init__(self, host, port, family=socket.AF_UNSPEC):
+    def __init__(self, host, port, family=socket.AF_UNSPEC, resolver=None):
         self._host = host
         self._port = port
         self._family = family
+        self._resolver = resolver or default_resolver
 
     @property
     def host(self):
@@ -21,13 +144,30 @@ class Address(object):
     def port(self):
         return self._port
 
+    @property
+    def resolver(self):
+        return self._resolver
+
     def unpack(self):
         return (self._host, self._port)
 
-    def socket(self):
-        res = socket.getaddrinfo(self._host, self._port, self._family,
-                                 socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
-        af, socktype, proto, canonname, sockaddr = res
+    def resolve(self):
+        return self._resolver.resolve(self._host, self._port, self._family)
+
+    def invalidate(self):
+        """\
+        Drops the cached resolution, e.g. when none of its addresses answered.
+        """
+
+        self._resolver.invalidate(self._host, self._port, self._family)
+
+    def socket(self, addrinfo=None):
+        """\
+        Returns a non-blocking socket for *addrinfo*, one of the tuples of
+        resolve(), by default the first.
+        """
+
+        af, socktype, proto, sockaddr = addrinfo or self.resolve()[0]
         sock = socket.socket(af, socktype, proto)
         set_close_exec(sock.fileno())
         sock.setblocking(0)
@@ -36,3 +176,37 @@ class Address(object):
                 sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
 
         return sock
+
+
+class UnixAddress(object):
+    """\
+    The class to represent the RPC address of a UNIX domain socket.
+    Use it with the msgpackrpc.transport.unix builder.
+    """
+
+    def __init__(self, path, mode=0o600):
+        self._path = path
+        self._mode = mode
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def unpack(self):
+        return self._path
+
+    def resolve(self):
+        return [(socket.AF_UNIX, socket.SOCK_STREAM, 0, self._path)]
+
+    def invalidate(self):
+        pass
+
+    def socket(self, addrinfo=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+        return sock
@@ -0,0 +1,291 @@
+"""\
+Client side load balancing over several servers (see BalancingClient).
+
+A BalancingTransport keeps one ClientTransport per backend address and
+stands in for the session towards each of them, so that a backend's
+failures are handled per backend instead of failing the whole session.
+"""
+
+import random
+
+from msgpackrpc import message
+from msgpackrpc import compression
+from msgpackrpc.compat import monotonic
+from msgpackrpc.transport.tcp import WriteStats
+
+# Weight of a new round-trip sample in a backend's latency average.
+_EWMA_WEIGHT = 0.3
+
+# Ejections back off up to this multiple of eject_time.
+_MAX_EJECT_FACTOR = 32
+
+
+class Backend(object):
+    """\
+    One server of a BalancingTransport. It receives the callbacks of its
+    ClientTransport, tracks the requests sent to it and their round-trip
+    times, and is ejected from the selection after repeated failures.
+    """
+
+    def __init__(self, balancer, address, transport_factory):
+        self._balancer = balancer
+        self._loop = balancer._session._loop
+        self.address = address
+        self.requests = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected = False
+        self._requests = {}
+        self._timer = None
+        self._transport = transport_factory(self)
+
+    @property
+    def outstanding(self):
+        return len(self._requests)
+
+    def track(self, msg):
+        self._requests[msg[1]] = (monotonic(), msg)
+        self.requests += 1
+
+    def forget(self, msgid):
+        if self._requests.pop(msgid, None) is None:
+            return False
+        self._transport.forget(msgid)
+        return True
+
+    def eject(self):
+        """\
+        Takes the backend out of the selection, for eject_time doubled per
+        consecutive ejection, after which it is probed with a connection.
+        """
+
+        self.ejected = True
+        self.ejections += 1
+        self._cancel_probe()
+        balancer = self._balancer
+        delay = balancer._eject_time * min(2 ** (self.ejections - 1), _MAX_EJECT_FACTOR)
+        self._timer = self._loop.add_timeout(self._loop.time() + delay, self._probe)
+
+    def close(self):
+        self._cancel_probe()
+        self._transport.close()
+
+    def _probe(self):
+        self._timer = None
+        if self._transport._sockets:
+            self.ejected = False
+        else:
+            self._transport.connect()
+
+    def _cancel_probe(self):
+        if self._timer is not None:
+            self._loop.remove_timeout(self._timer)
+            self._timer = None
+
+    # The session callbacks of the backend's ClientTransport.
+
+    def on_connect(self):
+        self.ejected = False
+        self._cancel_probe()
+
+    def on_connect_failed(self, reason):
+        # Nothing was sent to it; its requests can go elsewhere.
+        requests, self._requests = self._requests, {}
+        self.eject()
+        self._balancer.reroute([msg for _, msg in requests.values()], reason)
+
+    def on_connection_lost(self, requests):
+        for msg in requests:
+            self._requests.pop(msg[1], None)
+        self.failures += 1
+        if self.failures >= self._balancer._eject_after and not self.ejected:
+            self.eject()
+        self._balancer._session.on_connection_lost(requests)
+
+    def on_send_failed(self, requests, error):
+        for msg in requests:
+            self._requests.pop(msg[1], None)
+        self._balancer._session.on_send_failed(requests, error)
+
+    def on_response(self, msgid, error, result):
+        entry = self._requests.pop(msgid, None)
+        if entry is not None:
+            rtt = monotonic() - entry[0]
+            if self.latency:
+                self.latency += _EWMA_WEIGHT * (rtt - self.latency)
+            else:
+                self.latency = rtt
+            self.failures = 0
+            self.ejections = 0
+        self._balancer._session.on_response(msgid, error, result)
+
+    def on_stream(self, msgid, items):
+        return self._balancer._session.on_stream(msgid, items)
+
+
+class BalancingTransport(object):
+    """\
+    Sends every message to a backend picked by the power of two choices: of
+    two random backends which are not ejected, the one with the lower cost.
+    With balance='ewma' the cost is the latency average times one plus the
+    outstanding requests, with 'outstanding' the outstanding requests only.
+    A backend without a round trip yet counts with the average latency of
+    the others, so fresh backends do not draw every request.
+    When every backend is ejected, all of them are candidates again.
+    """
+
+    def __init__(self, session, addresses, builder, reconnect_limit, encodings=('utf-8', None), pool_size=1,
+                 options=None, balance='ewma', eject_after=3, eject_time=1.0):
+        if not addresses:
+            raise ValueError("no backend addresses")
+        if balance not in _COSTS:
+            raise ValueError("unknown balance: {0}".format(balance))
+
+        self._session = session
+        self._cost = _COSTS[balance]
+        self._eject_after = eject_after
+        self._eject_time = eject_time
+        self._random = random.Random()
+
+        def factory(address):
+            return lambda backend: builder.ClientTransport(backend, address, reconnect_limit, encodings=encodings,
+                                                           pool_size=pool_size, options=options)
+        self.backends = [Backend(self, address, factory(address)) for address in addresses]
+
+    @property
+    def write_stats(self):
+        stats = WriteStats()
+        for backend in self.backends:
+            stats.merge(backend._transport.write_stats)
+        return stats
+
+    @property
+    def compression_stats(self):
+        stats = compression.CompressionStats()
+        for backend in self.backends:
+            stats.merge(backend._transport.compression_stats)
+        return stats
+
+    def select(self, exclude=None):
+        backends = [backend for backend in self.backends if not backend.ejected and backend is not exclude]
+        if not backends:
+            backends = self.backends
+        if len(backends) == 1:
+            return backends[0]
+
+        first, second = self._random.sample(backends, 2)
+        if self._cost(self, second) < self._cost(self, first):
+            return second
+        return first
+
+    def default_latency(self):
+        """\
+        The latency average of the backends which have one, or 1.0.
+        """
+
+        measured = [backend.latency for backend in self.backends if backend.latency]
+        if not measured:
+            return 1.0
+        return sum(measured) / len(measured)
+
+    def send_message(self, msg, callback=None):
+        backend = self.select()
+        if msg[0] == message.REQUEST:
+            backend.track(msg)
+        backend._transport.send_message(msg, callback)
+
+    def send_messages(self, messages, callback=None):
+        groups = {}
+        for msg in messages:
+            backend = self.select()
+            if msg[0] == message.REQUEST:
+                backend.track(msg)
+            groups.setdefault(backend, []).append(msg)
+
+        # Fire the callback once every per-backend write has been flushed.
+        remaining = [len(groups)]
+        def on_written():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback()
+
+        for backend, group in groups.items():
+            backend._transport.send_messages(group, on_written if callback is not None else None)
+
+    def can_hedge(self, msgid):
+        """\
+        True if a backend other than the one of the request *msgid* is not
+        ejected.
+        """
+
+        return self._hedge_backend(msgid) is not None
+
+    def send_hedge(self, msg, msgid):
+        """\
+        Sends *msg*, a copy of the request *msgid*, to another backend than
+        the request. Check can_hedge() first.
+        """
+
+        backend = self._hedge_backend(msgid)
+        backend.track(msg)
+        backend._transport.send_message(msg)
+
+    def _hedge_backend(self, msgid):
+        sent_to = None
+        for backend in self.backends:
+            if msgid in backend._requests:
+                sent_to = backend
+                break
+        if sent_to is None or all(backend.ejected for backend in self.backends if backend is not sent_to):
+            return None
+        return self.select(exclude=sent_to)
+
+    def reroute(self, messages, reason):
+        """\
+        Sends the still unanswered requests among *messages* to the other
+        backends, or fails them with *reason* when every backend is ejected.
+        """
+
+        table = self._session._request_table
+        requests = [msg for msg in messages if msg[0] == message.REQUEST and msg[1] in table]
+        if not requests:
+            return
+        if all(backend.ejected for backend in self.backends):
+            self._session.on_send_failed(requests, reason)
+        else:
+            self.send_messages(requests)
+
+    def forget(self, msgid):
+        for backend in self.backends:
+            if backend.forget(msgid):
+                return
+
+    def flush(self, callback):
+        remaining = [len(self.backends)]
+        def on_flushed():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback()
+        for backend in self.backends:
+            backend._transport.flush(on_flushed)
+
+    def connect(self):
+        for backend in self.backends:
+            backend._transport.connect()
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+def _ewma_cost(balancer, backend):
+    latency = backend.latency or balancer.default_latency()
+    return latency * (len(backend._requests) + 1)
+
+
+def _outstanding_cost(balancer, backend):
+    return len(backend._requests)
+
+
+_COSTS = {'ewma': _ewma_cost, 'outstanding': _outstanding_cost}
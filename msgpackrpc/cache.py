@@ -0,0 +1,242 @@
+"""\
+Result caches: ResultCache on the client side, ResponseCache on the server.
+
+ResultCache adds single-flight request coalescing to a client.
+
+Only the methods given to ResultCache are cached, so that calls with side
+effects are never answered from the cache. Requests are keyed by method
+name and packed arguments:
+
+    cache = ResultCache(['lookup'], max_entries=10000, ttl=30)
+    client = msgpackrpc.Client(address, cache=cache)
+
+A call whose key is cached gets an already resolved Future. A call whose
+key is in flight gets the Future of that request, so identical concurrent
+calls go over the wire once. Only successful results are cached, and they
+are shared between callers: do not mutate them.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import msgpack
+
+from msgpackrpc import extension
+from msgpackrpc.compat import force_str
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_ratio(self):
+        """\
+        Share of lookups served without a request of their own.
+        """
+
+        total = self.hits + self.coalesced + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits + self.coalesced) / total
+
+
+class ResultCache(object):
+    """\
+    LRU cache of call results.
+
+    :param methods:     names of the idempotent methods to cache.
+    :param max_entries: number of results kept; the least recently used
+                        one is evicted beyond that.
+    :param max_bytes:   limit on the packed size of the kept results, or None.
+    :param ttl:         seconds a result is kept, None for no expiry and 0 to
+                        only coalesce in-flight requests.
+
+    It is thread-safe, so a ThreadedClient or several clients may share one.
+    Coalesced calls share the timeout of the request in flight.
+    """
+
+    def __init__(self, methods, max_entries=1024, max_bytes=None, ttl=None):
+        self._methods = set(force_str(method) for method in methods)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, method, args):
+        """\
+        Returns the cache key of a call, or None if *method* is not cached.
+        """
+
+        method = force_str(method)
+        if method not in self._methods:
+            return None
+        return (method, msgpack.packb(args, default=extension.default))
+
+    def begin(self, key, create_future):
+        """\
+        Returns (future, True) on a miss: *future* comes from create_future()
+        and the caller must send its request. Otherwise returns (future,
+        False) with a resolved future or the one of the request in flight.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires, size = entry
+                if expires is None or expires > time.time():
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.stats.hits += 1
+                    hit = True
+                else:
+                    self._remove(key)
+                    self.stats.expirations += 1
+                    hit = False
+            else:
+                hit = False
+
+            if not hit:
+                future = self._inflight.get(key)
+                if future is not None:
+                    self.stats.coalesced += 1
+                    return future, False
+
+                self.stats.misses += 1
+                future = create_future()
+                future._cache_key = key
+                self._inflight[key] = future
+                return future, True
+
+        future = create_future()
+        future.set_result(result)
+        return future, False
+
+    def complete(self, key, future):
+        """\
+        Ends the in-flight request of *key*, keeping its result if it
+        succeeded. Called by the session once *future* is settled or dropped.
+        """
+
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if self._ttl == 0 or not future.done or future.error is not None:
+                return
+
+            size = len(msgpack.packb(future.result, default=extension.default)) if self._max_bytes is not None else 0
+            if self._max_bytes is not None and size > self._max_bytes:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            expires = time.time() + self._ttl if self._ttl is not None else None
+            self._entries[key] = (future.result, expires, size)
+            self._bytes += size
+
+            while len(self._entries) > self._max_entries or (self._max_bytes is not None and self._bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def invalidate(self, method=None, args=None):
+        """\
+        Drops the result of one call, of all calls of *method*, or everything.
+        """
+
+        with self._lock:
+            if method is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif args is not None:
+                key = (force_str(method), msgpack.packb(args, default=extension.default))
+                if key in self._entries:
+                    self._remove(key)
+            else:
+                method = force_str(method)
+                for key in [key for key in self._entries if key[0] == method]:
+                    self._remove(key)
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+
+class ResponseCache(object):
+    """\
+    Server side LRU cache of packed response bodies, bounded by their total
+    size. Keys are (method name, packed params). Used by Server for the
+    methods decorated with cacheable(); see Server.invalidate().
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                body, expires = entry
+                if expires is None or expires > time.time():
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.stats.hits += 1
+                    return body
+                self._remove(key)
+                self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+
+    def put(self, key, body, ttl=None):
+        size = len(body)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, time.time() + ttl if ttl is not None else None)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def invalidate(self, method=None, params_key=None):
+        """\
+        Drops the body of one call, of all calls of *method*, or everything.
+        """
+
+        with self._lock:
+            if method is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif params_key is not None:
+                if (method, params_key) in self._entries:
+                    self._remove((method, params_key))
+            else:
+                for key in [key for key in self._entries if key[0] == method]:
+                    self._remove(key)
+
+    def _remove(self, key):
+        self._bytes -= len(self._entries.pop(key)[0])
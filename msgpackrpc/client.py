@@ -1,5 +1,18 @@
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from tornado import ioloop
+
 from msgpackrpc import Loop
+from msgpackrpc import balancer
+from msgpackrpc import message
 from msgpackrpc import session
+from msgpackrpc.error import TransportError
+from msgpackrpc.future import ThreadedFuture
 from msgpackrpc.transport import tcp
 
 class Client(session.Session):
@@ -7,12 +20,9 @@ class Client(session.Session):
     Client is useful for MessagePack RPC API.
     """
 
-    def __init__(self, address, timeout=10, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None):
+    def __init__(self, address, timeout=10, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None, pool_size=1, metrics=False, cache=None, idempotent=(), hedging=None, **transport_options):
         loop = loop or Loop()
-        session.Session.__init__(self, address, timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding)
-
-        if timeout:
-            loop.attach_periodic_callback(self.step_timeout, 1000) # each 1s
+        session.Session.__init__(self, address, timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding, pool_size, metrics, cache, idempotent, hedging, **transport_options)
 
     @classmethod
     def open(cls, *args):
@@ -37,3 +47,206 @@ class Client(session.Session):
             if type:
                 return False
             return True
+
+
+class BalancingClient(Client):
+    """\
+    Client which spreads its requests over the servers at *addresses*, each
+    with its own pool of pool_size connections, all on one loop.
+
+    Every request goes to the better of two randomly picked backends (see
+    balancer.BalancingTransport): by latency average and outstanding
+    requests with balance='ewma', by outstanding requests only with
+    balance='outstanding'. A backend which could not be connected, or lost
+    *eject_after* connections in a row, is ejected for *eject_time* seconds
+    (doubling while it keeps failing) and then probed with a connection.
+    Requests waiting for a backend which could not be connected go to
+    another one.
+    """
+
+    def __init__(self, addresses, timeout=10, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None, pool_size=1, metrics=False, cache=None, idempotent=(), hedging=None, balance='ewma', eject_after=3, eject_time=1.0, **transport_options):
+        self._balance = balance
+        self._eject_after = eject_after
+        self._eject_time = eject_time
+        Client.__init__(self, list(addresses), timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding, pool_size, metrics, cache, idempotent, hedging, **transport_options)
+
+    def create_transport(self, builder, reconnect_limit, encodings, pool_size, options):
+        return balancer.BalancingTransport(self, self._address, builder, reconnect_limit, encodings, pool_size, options,
+                                           self._balance, self._eject_after, self._eject_time)
+
+    @property
+    def backends(self):
+        """\
+        The balancer.Backend of each address, with its requests, outstanding
+        requests, latency average in seconds and whether it is ejected.
+        """
+
+        return list(self._transport.backends)
+
+
+class ThreadedClient(session.Session):
+    """\
+    Client which can be shared by threads.
+
+    The loop runs on a dedicated I/O thread, which owns the session state:
+    request ids are allocated, requests sent and responses handled there
+    only. Other threads hand their requests over with Loop.add_callback and
+    wait for ThreadedFuture results on a condition variable. Future callbacks
+    run on the I/O thread and must not block.
+
+    A failed connection fails the waiting requests but not the client; the
+    next request connects again. close() stops the I/O thread; requests and
+    notifications raise a TransportError afterwards.
+    """
+
+    def __init__(self, address, timeout=10, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None, pool_size=1, metrics=False, cache=None, idempotent=(), hedging=None, **transport_options):
+        # Loop() makes its ioloop current; keep the caller's.
+        current = ioloop.IOLoop.current(instance=False)
+        loop = Loop()
+        if current is not None:
+            current.make_current()
+        else:
+            ioloop.IOLoop.clear_current()
+
+        session.Session.__init__(self, address, timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding, pool_size, metrics, cache, idempotent, hedging, **transport_options)
+        self._flush_waiters = set()
+        # Guards _closed, so nothing is handed to the loop once it stops.
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='msgpackrpc-io')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        self._loop._ioloop.make_current()
+        self._loop.start()
+
+    def _submit(self, callback, *args):
+        # Callbacks queued before close() run before the loop stops.
+        with self._lock:
+            if self._closed:
+                raise TransportError("Client is closed")
+            self._loop.add_callback(callback, *args)
+
+    def _new_future(self, timeout):
+        with self._lock:
+            if self._closed:
+                raise TransportError("Client is closed")
+            thread = self._thread
+        if timeout is None:
+            timeout = self._timeout
+        return ThreadedFuture(self._loop, timeout, thread)
+
+    def _send_request(self, method, args, timeout, future=None):
+        if future is None:
+            future = self._new_future(timeout)
+        try:
+            self._submit(self._send_requests, [(method, args, future)])
+        except TransportError as e:
+            # A cached request's future may be shared already.
+            future.set_error(e)
+            self._settled(future)
+            raise
+        return future
+
+    def call_many_async(self, requests):
+        pending = [(method, args, self._new_future(None)) for method, args in requests]
+        if pending:
+            self._submit(self._send_requests, pending)
+        return [future for _, _, future in pending]
+
+    def _send_requests(self, pending):
+        if self._transport is None:
+            for _, _, future in pending:
+                future.set_error(TransportError("Client is closed"))
+                self._settled(future)
+            return
+
+        messages = []
+        for method, args, future in pending:
+            messages.append(self._create_request(method, args, future._timeout, future)[1])
+        if len(messages) == 1:
+            self._transport.send_message(messages[0])
+        else:
+            self._transport.send_messages(messages)
+
+    def wait_all(self, futures):
+        for future in futures:
+            future.join()
+        return futures
+
+    def as_completed(self, futures):
+        queue = Queue()
+        for future in futures:
+            future._set_waiter(queue.put)
+        for _ in range(len(futures)):
+            yield queue.get()
+
+    def notify_async(self, method, *args):
+        self._submit(self._send_notifications, [[message.NOTIFY, method, args]])
+
+    def notify_many(self, notifications):
+        messages = [[message.NOTIFY, method, args] for method, args in notifications]
+        if messages:
+            self._submit(self._send_notifications, messages)
+
+    def _send_notifications(self, messages):
+        if self._transport is not None:
+            self._transport.send_messages(messages)
+
+    def flush(self):
+        flushed = threading.Event()
+        with self._lock:
+            if self._closed:
+                return
+            self._loop.add_callback(self._flush, flushed)
+        flushed.wait()
+
+    def _flush(self, flushed):
+        if self._transport is None:
+            flushed.set()
+            return
+
+        self._flush_waiters.add(flushed)
+        def callback():
+            self._flush_waiters.discard(flushed)
+            flushed.set()
+        self._transport.flush(callback)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._loop.add_callback(self._close)
+        self._thread.join()
+        self._thread = None
+
+    def _close(self):
+        table = self._request_table
+        session.Session.close(self)
+        for future in table.values():
+            future.set_error(TransportError("Client is closed"))
+        self._release_flush_waiters()
+        self._loop.stop()
+
+    def on_connect_failed(self, reason):
+        """\
+        Fails the waiting requests but keeps the transport, which connects
+        again on the next request. Called by the transport layer.
+        """
+
+        self._clear_hedges()
+        table = self._request_table
+        self._request_table = {}
+        self._clear_deadlines()
+        self._finish_all_metered()
+        for future in table.values():
+            future.set_error(reason)
+            self._settled(future)
+        self._release_flush_waiters()
+
+    def _release_flush_waiters(self):
+        waiters, self._flush_waiters = self._flush_waiters, set()
+        for flushed in waiters:
+            flushed.set()
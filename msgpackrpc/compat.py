@@ -15,3 +15,8 @@ else:
 
     def iteritems(d):
         return d.iteritems()
+
+try:
+    from time import perf_counter as monotonic
+except ImportError:
+    from time import time as monotonic
@@ -0,0 +1,145 @@
+"""\
+Payload compression codecs for the transports.
+
+A client created with compression=[names] offers these codecs in the
+connection handshake; the server picks the first one it accepts. From then
+on either side sends writes of at least compression_threshold bytes as a
+single ext type frame holding the compressed messages.
+
+zlib is always available, lz4 when the lz4 package is installed. Other
+codecs can be added with register().
+
+A received frame may not expand beyond the max_buffer_size transport
+option, the limit on plain messages.
+"""
+
+import zlib
+
+from msgpackrpc.compat import monotonic
+from msgpackrpc.error import RPCError
+
+# The Unpacker's limit when max_buffer_size is 0.
+_DEFAULT_MAX_SIZE = 2 ** 31 - 1
+
+EXT_CODE = 0x43
+
+_codecs = {}
+
+
+class Codec(object):
+    def __init__(self, name, compress, decompress, decompress_bounded=None):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.decompress_bounded = decompress_bounded
+
+
+def register(name, compress, decompress, decompress_bounded=None):
+    """\
+    Registers a codec: *compress* and *decompress* take and return bytes.
+    *decompress_bounded*, if given, takes bytes and a size and returns no
+    more than that many bytes of the output, so that an oversized frame is
+    detected without expanding all of it. Both peers must register the codec
+    under the same name.
+    """
+
+    _codecs[name] = Codec(name, compress, decompress, decompress_bounded)
+
+
+def get(name):
+    return _codecs.get(name)
+
+
+def names():
+    return sorted(_codecs)
+
+
+def _zlib_decompress_bounded(data, size):
+    return zlib.decompressobj().decompress(data, size)
+
+
+register('zlib', lambda data: zlib.compress(data, 1), zlib.decompress, _zlib_decompress_bounded)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    def _lz4_decompress_bounded(data, size):
+        return lz4.frame.LZ4FrameDecompressor().decompress(data, max_length=size)
+
+    # max_length came with lz4 2.0.
+    register('lz4', lz4.frame.compress, lz4.frame.decompress,
+             _lz4_decompress_bounded if hasattr(lz4.frame, 'LZ4FrameDecompressor') else None)
+
+
+class CompressionStats(object):
+    """\
+    Counts the compressed frames sent and received, their sizes before and
+    after compression and the seconds spent in the codec.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.skipped = 0
+        self.decompressed_frames = 0
+        self.decompressed_bytes = 0
+        self.decompress_seconds = 0.0
+
+    @property
+    def ratio(self):
+        """\
+        Uncompressed over compressed size of the frames sent.
+        """
+
+        if self.bytes_out == 0:
+            return 0.0
+        return float(self.bytes_in) / self.bytes_out
+
+    def merge(self, other):
+        for name in ('frames', 'bytes_in', 'bytes_out', 'compress_seconds', 'skipped',
+                     'decompressed_frames', 'decompressed_bytes', 'decompress_seconds'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+
+def compress(codec, data, stats):
+    """\
+    Returns *data* compressed by *codec*, or None when that saves nothing.
+    """
+
+    started = monotonic()
+    compressed = codec.compress(data)
+    stats.compress_seconds += monotonic() - started
+    if len(compressed) >= len(data):
+        stats.skipped += 1
+        return None
+
+    stats.frames += 1
+    stats.bytes_in += len(data)
+    stats.bytes_out += len(compressed)
+    return compressed
+
+
+def decompress(codec, data, stats, max_size=0):
+    """\
+    Returns *data* decompressed by *codec*. Raises RPCError if it expands
+    beyond *max_size* bytes (0 means the Unpacker's default limit).
+    """
+
+    max_size = max_size or _DEFAULT_MAX_SIZE
+    started = monotonic()
+    if codec.decompress_bounded is not None:
+        # One byte more tells an oversized frame from one of exactly max_size.
+        data = codec.decompress_bounded(data, max_size + 1)
+    else:
+        data = codec.decompress(data)
+    stats.decompress_seconds += monotonic() - started
+    if len(data) > max_size:
+        raise RPCError("Compressed message expands beyond {0} bytes".format(max_size))
+    stats.decompressed_frames += 1
+    stats.decompressed_bytes += len(data)
+    return data
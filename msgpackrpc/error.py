@@ -23,6 +23,10 @@ class TransportError(RPCError):
     CODE = ".TransportError"
     pass
 
+class ServerBusyError(RPCError):
+    CODE = ".ServerBusyError"
+    pass
+
 class CallError(RPCError):
     CODE = ".NoMethodError"
     pass
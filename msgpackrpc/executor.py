@@ -0,0 +1,135 @@
+import itertools
+import multiprocessing
+import os
+
+from msgpackrpc import error
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+_ATTRIBUTE = '_msgpackrpc_executor'
+
+
+def run_in_thread(func):
+    """\
+    Marks a dispatcher method to be run in the server's thread pool.
+    """
+
+    setattr(func, _ATTRIBUTE, THREAD)
+    return func
+
+
+def run_in_process(func):
+    """\
+    Marks a dispatcher method to be run in the server's process pool.
+    The method name, arguments and result must be picklable, and so must
+    the dispatcher where pool processes are not forked (e.g. on Windows).
+    """
+
+    setattr(func, _ATTRIBUTE, PROCESS)
+    return func
+
+
+def executor_of(func):
+    return getattr(func, _ATTRIBUTE, None)
+
+
+class ExecutorPool(object):
+    """\
+    Runs blocking dispatcher methods in thread or process pools and completes
+    their responders back on the loop.
+
+    Pools are created on first use, so that they are created in each worker
+    after Server.start() forked. queue_limit caps the number of submitted but
+    unfinished calls per pool; further calls are rejected with ServerBusyError.
+    """
+
+    def __init__(self, loop, dispatcher, thread_pool_size=4, process_pool_size=None, queue_limit=None):
+        self._loop = loop
+        self._dispatcher = dispatcher
+        self._sizes = {THREAD: thread_pool_size, PROCESS: process_pool_size}
+        self._queue_limit = queue_limit
+        self._executors = {}
+        self._pending = {THREAD: 0, PROCESS: 0}
+        self._token = next(_tokens)
+
+    def attach(self, loop):
+        """\
+        Completes responders on *loop* from now on.
+        """
+
+        self._loop = loop
+
+    def pending(self, kind):
+        return self._pending[kind]
+
+    def submit(self, kind, method, func, param, responder):
+        if self._queue_limit is not None and self._pending[kind] >= self._queue_limit:
+            raise error.ServerBusyError("'{0}' rejected: {1} pool queue is full".format(method, kind))
+
+        if kind == PROCESS:
+            executor = self._executor(kind)
+            if _forks():
+                future = executor.submit(_call_in_forked, self._token, method, param)
+            else:
+                future = executor.submit(_call_in_process, self._dispatcher, method, param)
+        else:
+            future = self._executor(kind).submit(func, *param)
+        self._pending[kind] += 1
+
+        loop = self._loop
+        future.add_done_callback(lambda f: loop.add_callback(self._on_done, kind, f, responder))
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self._executors = {}
+        _process_dispatchers.pop(self._token, None)
+
+    def _on_done(self, kind, future, responder):
+        self._pending[kind] -= 1
+        try:
+            result = future.result()
+        except Exception as e:
+            responder.set_error(str(e))
+        else:
+            responder.set_result(result)
+
+    def _executor(self, kind):
+        executor = self._executors.get(kind)
+        if executor is None:
+            try:
+                from concurrent import futures
+            except ImportError:
+                raise error.RPCError("offloading requires concurrent.futures (install 'futures' on Python 2)")
+
+            if kind == PROCESS:
+                # Registered before the pool forks its processes, which inherit it.
+                _process_dispatchers[self._token] = self._dispatcher
+                executor = futures.ProcessPoolExecutor(self._sizes[kind])
+            else:
+                executor = futures.ThreadPoolExecutor(self._sizes[kind])
+            self._executors[kind] = executor
+        return executor
+
+
+# dispatchers of the ExecutorPools with a process pool, by token; forked pool
+# processes inherit them, so they are not pickled per call
+_process_dispatchers = {}
+_tokens = itertools.count()
+
+
+def _forks():
+    # Python < 3.4 forks on POSIX and has no start methods.
+    get_start_method = getattr(multiprocessing, 'get_start_method', None)
+    if get_start_method is None:
+        return os.name != 'nt'
+    return get_start_method() == 'fork'
+
+
+def _call_in_forked(token, method, param):
+    return getattr(_process_dispatchers[token], method)(*param)
+
+
+def _call_in_process(dispatcher, method, param):
+    return getattr(dispatcher, method)(*param)
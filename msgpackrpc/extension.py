@@ -0,0 +1,152 @@
+"""\
+msgpack ext types for values msgpack can not pack by itself.
+
+The transports pack instances of a registered class as an ext type with its
+code, and decode ext types with a registered code when unpacking. Other
+values msgpack does not know are still packed with their to_msgpack().
+
+numpy.ndarray is registered when NumPy is installed: an array is sent as
+its dtype, shape and raw bytes, and decoded with numpy.frombuffer over the
+received data without copying it, so decoded arrays are read-only. Other
+types can be added with register(); both peers must register them.
+"""
+
+import struct
+
+import msgpack
+
+from msgpackrpc.compat import force_str
+
+# Ext type codes the transports use themselves (compression, shm).
+_RESERVED = (0x43, 0x53)
+
+NDARRAY_CODE = 0x4e
+
+_types = {}
+_classes = {}
+
+
+class ExtensionType(object):
+    def __init__(self, code, cls, encode, decode, size=None):
+        self.code = code
+        self.cls = cls
+        self.encode = encode
+        self.decode = decode
+        self.size = size
+
+
+def register(code, cls, encode, decode, size=None):
+    """\
+    Registers an ext type for instances of *cls*. *encode* takes an instance
+    and returns bytes, or a list of bytes-like objects making up the data;
+    *decode* takes the data as bytes and returns the value. *size*, if
+    given, returns the size of the data without encoding it, which lets a
+    transport write large data from its own buffers (see zero_copy_threshold).
+    """
+
+    if code in _RESERVED:
+        raise ValueError("ext type code {0} is used by the transports".format(code))
+    ext = ExtensionType(code, cls, encode, decode, size)
+    _types[code] = ext
+    _classes[cls] = ext
+
+
+def get(code):
+    return _types.get(code)
+
+
+def lookup(cls):
+    """\
+    Returns the ext type registered for exactly *cls*, or None.
+    """
+
+    return _classes.get(cls)
+
+
+def find(obj):
+    ext = _classes.get(obj.__class__)
+    if ext is None:
+        for cls, registered in _classes.items():
+            if isinstance(obj, cls):
+                return registered
+    return ext
+
+
+def encode(ext, obj):
+    """\
+    Returns the data of *obj* as a list of bytes-like objects.
+    """
+
+    data = ext.encode(obj)
+    if not isinstance(data, list):
+        data = [data]
+    return data
+
+
+def default(obj):
+    """\
+    The Packer's default hook.
+    """
+
+    ext = find(obj)
+    if ext is not None:
+        return msgpack.ExtType(ext.code, b"".join(encode(ext, obj)))
+    return obj.to_msgpack()
+
+
+def ext_hook(code, data):
+    """\
+    The Unpacker's ext_hook; unknown codes stay ExtType.
+    """
+
+    ext = _types.get(code)
+    if ext is None:
+        return msgpack.ExtType(code, data)
+    return ext.decode(data)
+
+
+# An ndarray is a 2 byte header length, the packed [dtype, shape] header,
+# zero padding up to the next 16 byte offset, and the raw C ordered data.
+_ALIGNMENT = 16
+
+
+def _ndarray_header(array):
+    dtype = array.dtype
+    if dtype.hasobject or dtype.fields is not None:
+        raise TypeError("can not pack arrays of dtype {0}".format(dtype))
+    header = msgpack.packb([dtype.str, list(array.shape)])
+    offset = 2 + len(header)
+    padding = -offset % _ALIGNMENT
+    return struct.pack('>H', len(header)) + header + b'\0' * padding
+
+
+def _encode_ndarray(array):
+    header = _ndarray_header(array)
+    if not array.flags.c_contiguous:
+        array = numpy.ascontiguousarray(array)
+    if array.nbytes == 0:
+        return header
+    return [header, array.reshape(-1).view(numpy.uint8)]
+
+
+def _ndarray_size(array):
+    return len(_ndarray_header(array)) + array.nbytes
+
+
+def _decode_ndarray(data):
+    size, = struct.unpack_from('>H', data)
+    dtype, shape = msgpack.unpackb(data[2:2 + size])
+    dtype = numpy.dtype(force_str(dtype))
+    offset = 2 + size
+    offset += -offset % _ALIGNMENT
+    if offset == len(data):
+        return numpy.empty(shape, dtype)
+    return numpy.frombuffer(data, dtype, offset=offset).reshape(shape)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    register(NDARRAY_CODE, numpy.ndarray, _encode_ndarray, _decode_ndarray, _ndarray_size)
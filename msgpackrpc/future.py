@@ -1,3 +1,7 @@
+import threading
+import warnings
+from collections import deque
+
 from msgpackrpc import error
 
 
@@ -16,10 +20,61 @@ class Future(object):
         self._callback = callback
         self._error_handler = None
         self._result_handler = None
+        self._waiter = None
+        self._deadline = None
+        self._chunks = None
+        self._streaming = False
+        self._abandoned = False
+        self._resume = None
+        self._cache_key = None
+        self._replays = 0
+
+    @property
+    def done(self):
+        return self._set_flag
+
+    @property
+    def streamed(self):
+        """\
+        True once a chunk of a streamed result has arrived.
+        """
+
+        return self._chunks is not None
+
+    @property
+    def buffered(self):
+        """\
+        The number of received chunks of a streamed result not consumed yet.
+        """
+
+        chunks = self._chunks
+        return len(chunks) if chunks is not None else 0
 
     def join(self):
-        while (not self._set_flag):
-            self._loop.start()
+        if self._set_flag:
+            return
+
+        previous = self._waiter
+        def waiter(future):
+            self._loop.stop()
+            if previous is not None:
+                previous(future)
+
+        self._waiter = waiter
+        try:
+            while (not self._set_flag):
+                self._loop.start()
+        finally:
+            self._waiter = previous
+
+    def step_timeout(self):
+        """\
+        Deprecated: the session tracks deadlines itself. Returns True if
+        the deadline of this future has passed.
+        """
+
+        warnings.warn("Future.step_timeout is not needed anymore", DeprecationWarning, stacklevel=2)
+        return self._deadline is not None and self._loop.time() >= self._deadline
 
     def get(self):
         self.join()
@@ -46,6 +101,78 @@ class Future(object):
             else:
                 return self._result
 
+    def stream(self):
+        """\
+        Yields the items of the result as chunks of a streamed result arrive,
+        running the loop while none is buffered. A result which was not
+        streamed is yielded item by item once it is set.
+        """
+
+        self._streaming = True
+        return self._items()
+
+    def _items(self):
+        previous = self._waiter
+        def waiter(future):
+            self._loop.stop()
+            if previous is not None:
+                previous(future)
+
+        self._waiter = waiter
+        finished = False
+        try:
+            while True:
+                while self._chunks:
+                    for item in self._chunks.popleft():
+                        yield item
+                if self._set_flag:
+                    break
+                self._release()
+                self._loop.start()
+            finished = True
+        finally:
+            self._waiter = previous
+            if not finished:
+                self._abandon()
+            # Also when the caller stops iterating early.
+            self._release()
+
+        result = self.get()
+        if result is not None:
+            for item in result:
+                yield item
+
+    def _feed(self, items):
+        if self._chunks is None:
+            self._chunks = deque()
+        if self._abandoned:
+            return
+        self._chunks.append(items)
+        if self._streaming:
+            self._loop.stop()
+
+    def _abandon(self):
+        # The caller stopped iterating: the rest of the result is dropped
+        # as it arrives instead of holding back the connection.
+        self._abandoned = True
+        self._streaming = False
+        if self._chunks:
+            self._chunks.clear()
+
+    def _pause(self, resume):
+        # The transport stopped reading because too many chunks are buffered;
+        # *resume* is called once the consumer caught up.
+        self._resume = resume
+
+    def _take_resume(self):
+        resume, self._resume = self._resume, None
+        return resume
+
+    def _release(self):
+        resume = self._take_resume()
+        if resume is not None:
+            resume()
+
     def set(self, error=None, result=None):
         self._error = error
         self._result = result
@@ -58,8 +185,13 @@ class Future(object):
         return self._result
 
     def set_result(self, result):
+        if self._chunks is not None and not self._streaming:
+            result = [item for chunk in self._chunks for item in chunk]
+            self._chunks = None
         self.set(result=result)
         self._set_flag = True
+        self._notify_waiter()
+        self._release()
 
     @property
     def error(self):
@@ -68,6 +200,12 @@ class Future(object):
     def set_error(self, error):
         self.set(error=error)
         self._set_flag = True
+        self._notify_waiter()
+        self._release()
+
+    def _notify_waiter(self):
+        if self._waiter is not None:
+            self._waiter(self)
 
     def attach_callback(self, callback):
         self._callback = callback
@@ -78,11 +216,102 @@ class Future(object):
     def attach_result_handler(self, handler):
         self._result_handler = handler
 
-    # better name?
-    def step_timeout(self):
-        if self._timeout < 1:
-            return True
-        else:
-            self._timeout -= 1
-            return False
 
+
+class ThreadedFuture(Future):
+    """\
+    Future of a ThreadedClient. It is set on the client's I/O thread and
+    any other thread may wait for it on a condition variable.
+    """
+
+    def __init__(self, loop, timeout, io_thread):
+        Future.__init__(self, loop, timeout)
+        self._condition = threading.Condition()
+        self._io_thread = io_thread
+
+    def join(self):
+        if self._set_flag:
+            return
+        if threading.current_thread() is self._io_thread:
+            raise error.RPCError("ThreadedClient futures can not be waited for on its I/O thread")
+
+        with self._condition:
+            while not self._set_flag:
+                self._condition.wait()
+
+    def stream(self):
+        if threading.current_thread() is self._io_thread:
+            raise error.RPCError("ThreadedClient futures can not be waited for on its I/O thread")
+
+        with self._condition:
+            self._streaming = True
+        return self._items()
+
+    def _items(self):
+        condition = self._condition
+        finished = False
+        try:
+            while True:
+                if not self._chunks:
+                    self._release()
+                with condition:
+                    while not self._chunks and not self._set_flag:
+                        condition.wait()
+                    chunk = self._chunks.popleft() if self._chunks else None
+                if chunk is None:
+                    break
+                for item in chunk:
+                    yield item
+            finished = True
+        finally:
+            if not finished:
+                self._abandon()
+            self._release()
+
+        result = self.get()
+        if result is not None:
+            for item in result:
+                yield item
+
+    def _feed(self, items):
+        with self._condition:
+            if self._chunks is None:
+                self._chunks = deque()
+            if self._abandoned:
+                return
+            self._chunks.append(items)
+            self._condition.notify_all()
+
+    def _abandon(self):
+        with self._condition:
+            Future._abandon(self)
+
+    def _pause(self, resume):
+        with self._condition:
+            # The consumer may have caught up since the transport looked.
+            if self._chunks and not self._set_flag:
+                self._resume = resume
+                return
+        resume()
+
+    def _take_resume(self):
+        with self._condition:
+            return Future._take_resume(self)
+
+    def set_result(self, result):
+        with self._condition:
+            Future.set_result(self, result)
+            self._condition.notify_all()
+
+    def set_error(self, error):
+        with self._condition:
+            Future.set_error(self, error)
+            self._condition.notify_all()
+
+    def _set_waiter(self, waiter):
+        # Calls *waiter* right away if the future is already set.
+        with self._condition:
+            if not self._set_flag:
+                self._waiter = waiter
+                return
+        waiter(self)
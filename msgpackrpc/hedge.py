@@ -0,0 +1,126 @@
+"""\
+Hedged requests for the read-only methods of a client.
+
+A request of a hedged method which is still unanswered after a delay is
+sent once more, over another connection of the pool or to another backend
+of a BalancingClient. The first answer resolves the call and the late one
+is dropped. A copy is only sent when such a connection or backend is
+available, so hedging needs pool_size >= 2 or a BalancingClient:
+
+    hedging = Hedging(['get'], percentile=95, budget=0.05)
+    client = msgpackrpc.Client(address, pool_size=2, hedging=hedging)
+
+The delay is either fixed or a percentile of the round-trip times seen for
+the method. The budget caps the duplicates at a share of the hedged
+methods' requests, so that a slow server does not get twice the load.
+Only hedge methods which may safely run twice.
+"""
+
+from msgpackrpc.compat import force_str
+from msgpackrpc.metrics import Histogram
+
+# Round trips needed before the percentile is used instead of initial_delay.
+_MIN_SAMPLES = 20
+
+# The percentile is taken over the last window of this many round trips.
+_WINDOW = 1000
+
+
+class HedgeStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.wins = 0
+        self.throttled = 0
+
+    @property
+    def hedge_ratio(self):
+        """\
+        Share of the requests which were sent twice.
+        """
+
+        if self.requests == 0:
+            return 0.0
+        return float(self.hedged) / self.requests
+
+
+class Hedging(object):
+    """\
+    When and how often to hedge the requests of a client.
+
+    :param methods:       names of the methods to hedge.
+    :param delay:         seconds to wait for an answer before sending the
+                          duplicate, or None to use *percentile*.
+    :param percentile:    percentile of the method's round-trip times used
+                          as delay when *delay* is None.
+    :param initial_delay: delay used until enough round trips were seen.
+    :param budget:        duplicates allowed per request of a hedged method,
+                          e.g. 0.05 for at most 5% more requests.
+    :param burst:         duplicates which may be sent in a row once the
+                          budget has built up.
+
+    The client needs pool_size >= 2 or several backends (BalancingClient):
+    a duplicate goes over another connection or to another backend than the
+    request, and none is sent while there is no other one.
+
+    Its state is updated on the loop of the client; use one per client.
+    """
+
+    def __init__(self, methods, delay=None, percentile=95, initial_delay=0.05, budget=0.05, burst=10):
+        self._methods = set(force_str(method) for method in methods)
+        self._delay = delay
+        self._percentile = percentile
+        self._initial_delay = initial_delay
+        self._budget = budget
+        self._burst = max(1, burst)
+        self._tokens = 0.0
+        self._latencies = {}
+        self.stats = HedgeStats()
+
+    def applies(self, method):
+        return force_str(method) in self._methods
+
+    def delay(self, method):
+        """\
+        Returns the seconds to wait before hedging a request of *method*.
+        """
+
+        if self._delay is not None:
+            return self._delay
+
+        windows = self._latencies.get(force_str(method))
+        if windows is not None:
+            current, previous = windows
+            histogram = current if previous is None or current.count >= _MIN_SAMPLES else previous
+            if histogram.count >= _MIN_SAMPLES:
+                return histogram.percentile(self._percentile) / 1e6
+        return self._initial_delay
+
+    def begin(self):
+        """\
+        Counts a request of a hedged method, adding its share of the budget.
+        """
+
+        self.stats.requests += 1
+        self._tokens = min(self._burst, self._tokens + self._budget)
+
+    def spend(self):
+        """\
+        Returns True if the budget allows one more duplicate, and takes it.
+        """
+
+        if self._tokens < 1:
+            self.stats.throttled += 1
+            return False
+        self._tokens -= 1
+        self.stats.hedged += 1
+        return True
+
+    def record(self, method, seconds):
+        method = force_str(method)
+        windows = self._latencies.get(method)
+        if windows is None:
+            windows = self._latencies[method] = [Histogram(), None]
+        elif windows[0].count >= _WINDOW:
+            windows[:] = [Histogram(), windows[0]]
+        windows[0].record(seconds * 1e6)
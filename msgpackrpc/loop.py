@@ -31,6 +31,23 @@ class Loop(object):
         except:
             return
 
+    def add_callback(self, callback, *args):
+        """\
+        Schedules callback on the next loop iteration. Safe to call from other
+        threads.
+        """
+
+        self._ioloop.add_callback(callback, *args)
+
+    def time(self):
+        return self._ioloop.time()
+
+    def add_timeout(self, deadline, callback):
+        return self._ioloop.add_timeout(deadline, callback)
+
+    def remove_timeout(self, timeout):
+        self._ioloop.remove_timeout(timeout)
+
     def attach_periodic_callback(self, callback, callback_time):
         if self._periodic_callback is not None:
             self.dettach_periodic_callback()
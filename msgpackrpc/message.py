@@ -1,3 +1,11 @@
 REQUEST = 0
 RESPONSE = 1
 NOTIFY = 2
+# [STREAM, msgid, items]: a chunk of a streamed result, which ends with a
+# RESPONSE whose result is nil. Only sent to clients which asked for it.
+STREAM = 3
+
+# Connection setup request sent by the transport before any session message.
+# Peers which do not know it answer with an error and stay on plain messages.
+HANDSHAKE_METHOD = '.msgpackrpc.handshake'
+HANDSHAKE_MSGID = 0xFFFFFFFF
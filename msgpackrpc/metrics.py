@@ -0,0 +1,165 @@
+"""\
+Per-method request metrics.
+
+Server and Client record them when created with metrics=True (or with a
+shared Metrics instance): request and error counts, the number of requests
+in flight and a latency histogram per method. The server measures from
+dispatch until the response is handed to the transport, the client the
+round trip until the response or timeout arrives.
+"""
+
+from msgpackrpc.compat import monotonic
+
+# Values are bucketed HDR style: exact below 2 ** (_SUB_BITS + 1), then
+# 2 ** _SUB_BITS linear buckets per power of two (about 3% relative error).
+_SUB_BITS = 5
+_SUB_COUNT = 1 << _SUB_BITS
+
+UNKNOWN_METHOD = '<unknown>'
+
+
+class Histogram(object):
+    """\
+    Log-linear histogram of non-negative integers (latencies in microseconds).
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = _index(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    def percentile(self, percent):
+        """\
+        Returns the highest value equivalent to the *percent* percentile
+        (0 < percent <= 100), or None when nothing was recorded.
+        """
+
+        if not self.count:
+            return None
+
+        rank = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(_highest(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+
+def _index(value):
+    shift = value.bit_length() - _SUB_BITS - 1
+    if shift <= 0:
+        return value
+    return shift * _SUB_COUNT + (value >> shift)
+
+
+def _highest(index):
+    shift = max(0, (index >> _SUB_BITS) - 1)
+    mantissa = index - shift * _SUB_COUNT
+    return ((mantissa + 1) << shift) - 1
+
+
+class MethodMetrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+
+    def begin(self):
+        self.requests += 1
+        self.in_flight += 1
+        return monotonic()
+
+    def finish(self, started, failed=False):
+        self.in_flight -= 1
+        if failed:
+            self.errors += 1
+        self.latency.record((monotonic() - started) * 1e6)
+
+    def snapshot(self):
+        """\
+        Returns the counters and latency summary (in seconds) as a dict.
+        """
+
+        latency = self.latency
+        result = dict(requests=self.requests, errors=self.errors, in_flight=self.in_flight)
+        for name, percent in (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9)):
+            result[name] = _seconds(latency.percentile(percent))
+        result['min'] = _seconds(latency.min)
+        result['max'] = _seconds(latency.max)
+        result['mean'] = _seconds(latency.mean)
+        return result
+
+
+def _seconds(usec):
+    if usec is None:
+        return None
+    return usec / 1e6
+
+
+class Metrics(object):
+    """\
+    Registry of MethodMetrics by method name. Not thread-safe; it is updated
+    from the loop thread only. Forked server workers each count their own.
+    """
+
+    def __init__(self):
+        self._methods = {}
+
+    def method(self, name):
+        metrics = self._methods.get(name)
+        if metrics is None:
+            metrics = self._methods[name] = MethodMetrics()
+        return metrics
+
+    def snapshot(self):
+        """\
+        Returns {method name: MethodMetrics.snapshot()} for all methods.
+        """
+
+        return dict((name, metrics.snapshot()) for name, metrics in self._methods.items())
+
+    def reset(self):
+        self._methods = {}
+
+
+def create(metrics):
+    """\
+    Maps the metrics argument of Server and Client to a Metrics or None.
+    """
+
+    if metrics is True:
+        return Metrics()
+    return metrics or None
@@ -0,0 +1,146 @@
+import errno
+import os
+import signal
+import sys
+import threading
+import traceback
+
+
+class Supervisor(object):
+    """\
+    Forks worker processes and supervises them.
+
+    A worker which exits with a non-zero status or is killed by a signal is
+    forked again, up to max_restarts times in total. A worker which exits
+    cleanly is not replaced. stop() asks every worker to shut down gracefully
+    by sending SIGTERM.
+    """
+
+    def __init__(self, workers, max_restarts=100):
+        self._workers = workers
+        self._max_restarts = max_restarts
+        self._restarts = 0
+        self._children = {}
+        self._stopping = False
+        self._stop_signal = signal.SIGTERM
+        # Reentrant: the SIGTERM handler calls stop() on the main thread,
+        # which may be inside one of the locked sections.
+        self._lock = threading.RLock()
+
+    @property
+    def pids(self):
+        return list(self._children)
+
+    def start(self, run):
+        """\
+        Runs run(worker_id) in each worker and returns in the parent once all
+        workers have exited. Never returns in a worker.
+        """
+
+        try:
+            previous = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        except ValueError:
+            # Not in the main thread; shutdown has to go through stop().
+            previous = None
+
+        try:
+            for worker_id in range(self._workers):
+                self._spawn(run, worker_id)
+            self._supervise(run)
+        except BaseException:
+            self.stop()
+            self._reap_all()
+            raise
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
+
+    def stop(self, sig=signal.SIGTERM):
+        with self._lock:
+            self._stopping = True
+            self._stop_signal = sig
+            pids = list(self._children)
+
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self, run, worker_id):
+        # Fork outside the lock: a worker forked while another thread holds
+        # it would inherit it locked.
+        with self._lock:
+            if self._stopping:
+                return
+
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(run, worker_id)
+
+        with self._lock:
+            self._children[pid] = worker_id
+            stopping = self._stopping
+            sig = self._stop_signal
+        if stopping:
+            # stop() ran while forking and did not see this worker.
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _run_worker(self, run, worker_id):
+        self._children = {}
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run(worker_id)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                status = 1
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _supervise(self, run):
+        while self._children:
+            pid, status = self._wait()
+            with self._lock:
+                worker_id = self._children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                continue
+            if self._stopping:
+                continue
+
+            if self._restarts >= self._max_restarts:
+                raise RuntimeError("Too many worker restarts, giving up")
+            self._restarts += 1
+            self._spawn(run, worker_id)
+
+    def _reap_all(self):
+        while self._children:
+            pid, status = self._wait()
+            self._children.pop(pid, None)
+
+    def _wait(self):
+        while True:
+            try:
+                return os.wait()
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    # Somebody else reaped our workers.
+                    self._children = {}
+                    return 0, 0
+                if e.errno != errno.EINTR:
+                    raise
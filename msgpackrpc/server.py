@@ -1,9 +1,16 @@
+import signal
+
 import msgpack
 
-from msgpackrpc.compat import force_str
+from msgpackrpc.compat import force_str, inPy3k
+from msgpackrpc.cache import ResponseCache
+from msgpackrpc import compression
 from msgpackrpc import error
+from msgpackrpc import extension
 from msgpackrpc import Loop
-from msgpackrpc import message
+from msgpackrpc import metrics as _metrics
+from msgpackrpc import process
+from msgpackrpc.executor import ExecutorPool, executor_of, run_in_thread, run_in_process
 from msgpackrpc import session
 from msgpackrpc.transport import tcp
 
@@ -12,27 +19,181 @@ class Server(session.Session):
     Server is usaful for MessagePack RPC Server.
     """
 
-    def __init__(self, dispatcher, loop=None, builder=tcp, pack_encoding='utf-8', unpack_encoding=None):
+    def __init__(self, dispatcher, loop=None, builder=tcp, pack_encoding='utf-8', unpack_encoding=None,
+                 thread_pool_size=4, process_pool_size=None, executor_queue_limit=None, exports=None, metrics=False, max_inflight_total=None, response_cache_bytes=64 * 1024 * 1024, **transport_options):
+        """\
+        :param exports:              names of the callable dispatcher methods. By
+                                     default the methods decorated with export(),
+                                     or all public methods if none is decorated.
+        :param transport_options:    builder specific options, e.g. coalesce=True
+                                     for tcp (see tcp.DEFAULT_OPTIONS)
+        :param thread_pool_size:     workers for methods marked with run_in_thread.
+        :param process_pool_size:    workers for methods marked with run_in_process
+                                     (None means the number of CPUs).
+        :param executor_queue_limit: maximum unfinished calls per pool, beyond
+                                     which calls fail with ServerBusyError.
+        :param metrics:              True or a Metrics instance to record
+                                     per-method counts and dispatch latency.
+        :param max_inflight_total:   unanswered requests of all connections
+                                     beyond which connections stop being read
+                                     until some are answered (per worker).
+                                     Per connection limits are the transport
+                                     options max_inflight and max_pending_writes.
+        :param response_cache_bytes: size limit of the packed responses kept
+                                     for methods decorated with cacheable().
+        """
+
         self._loop = loop or Loop()
         self._builder = builder
         self._encodings = (pack_encoding, unpack_encoding)
+        self._transport_options = transport_options
         self._listeners = []
         self._dispatcher = dispatcher
+        self._exports = exports
+        self._dispatch_table = {}
+        self.refresh_dispatch_table()
+        self._packer = msgpack.Packer(encoding=pack_encoding, default=extension.default)
+        self._response_cache = ResponseCache(response_cache_bytes)
+        self._supervisor = None
+        self._worker_id = None
+        self._executors = ExecutorPool(self._loop, dispatcher, thread_pool_size, process_pool_size, executor_queue_limit)
+        self._metrics = _metrics.create(metrics)
+        self._max_inflight_total = max_inflight_total
+        self._inflight = 0
+        self._saturated = set()
+
+    @property
+    def worker_id(self):
+        """\
+        Index of the current worker process, or None when not forked.
+        """
+
+        return self._worker_id
+
+    @property
+    def metrics(self):
+        """\
+        The Metrics of this process, or None when disabled.
+        """
+
+        return self._metrics
+
+    @property
+    def write_stats(self):
+        stats = tcp.WriteStats()
+        for listener in self._listeners:
+            stats.merge(listener.write_stats)
+        return stats
+
+    @property
+    def compression_stats(self):
+        stats = compression.CompressionStats()
+        for listener in self._listeners:
+            stats.merge(listener.compression_stats)
+        return stats
 
     def listen(self, address):
-        listener = self._builder.ServerTransport(address, self._encodings)
+        listener = self._builder.ServerTransport(address, self._encodings, self._transport_options)
         listener.listen(self)
         self._listeners.append(listener)
 
-    def start(self):
+    def start(self, workers=1, max_restarts=100):
+        """\
+        Runs the server. With workers > 1, forks that many worker processes
+        after the listening sockets are bound; each runs its own loop on the
+        shared sockets. Crashed workers are restarted up to max_restarts times.
+        In the parent this blocks until all workers have exited.
+        """
+
+        if workers <= 1:
+            self._loop.start()
+            return
+
+        for listener in self._listeners:
+            listener.detach()
+
+        self._supervisor = process.Supervisor(workers, max_restarts)
+        try:
+            self._supervisor.start(self._run_worker)
+        finally:
+            self._supervisor = None
+
+    def _run_worker(self, worker_id):
+        self._worker_id = worker_id
+        self._supervisor = None
+        self._loop = Loop()
+        self._executors.attach(self._loop)
+
+        # Tornado's add_callback_from_signal does not wake a loop blocked in
+        # poll on Python 3, but stop() always does.
+        def on_signal(signum, frame):
+            self.stop()
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        for listener in self._listeners:
+            listener.attach(self._loop)
         self._loop.start()
+        self.close()
 
     def stop(self):
-        self._loop.stop()
+        if self._supervisor is not None:
+            self._supervisor.stop()
+        else:
+            self._loop.stop()
 
     def close(self):
+        if self._supervisor is not None:
+            self._supervisor.stop()
         for listener in self._listeners:
             listener.close()
+        self._executors.shutdown()
+
+    @property
+    def response_cache(self):
+        return self._response_cache
+
+    def invalidate(self, method=None, params=None):
+        """\
+        Drops cached responses: of the call of *method* with *params*, of all
+        calls of *method*, or all of them. Each worker has its own cache.
+        """
+
+        if method is None:
+            self._response_cache.invalidate()
+        elif params is None:
+            self._response_cache.invalidate(force_str(method))
+        else:
+            self._response_cache.invalidate(force_str(method), self._packer.pack(list(params)))
+
+    @property
+    def inflight(self):
+        """\
+        Number of requests received but not answered yet.
+        """
+
+        return self._inflight
+
+    def _request_started(self):
+        self._inflight += 1
+
+    def _request_finished(self):
+        self._inflight -= 1
+        if self._saturated and self._inflight < self._max_inflight_total:
+            saturated, self._saturated = self._saturated, set()
+            for sock in saturated:
+                sock._update_reading()
+
+    def _is_saturated(self, sock):
+        """\
+        Whether the global limit is reached; *sock* is then resumed once
+        requests are answered.
+        """
+
+        if self._max_inflight_total and self._inflight >= self._max_inflight_total:
+            self._saturated.add(sock)
+            return True
+        return False
 
     def on_request(self, sendable, msgid, method, param):
         self.dispatch(method, param, _Responder(sendable, msgid))
@@ -40,13 +201,60 @@ class Server(session.Session):
     def on_notify(self, method, param):
         self.dispatch(method, param, _NullResponder())
 
+    def refresh_dispatch_table(self, exports=None):
+        """\
+        Rebuilds the method name to callable table, e.g. after methods were
+        added to the dispatcher. Names are registered as both str and bytes,
+        so lookups work whatever unpack_encoding is. *exports* replaces the
+        export list given to the constructor.
+        """
+
+        if exports is not None:
+            self._exports = exports
+
+        dispatcher = self._dispatcher
+        if self._exports is not None:
+            names = list(self._exports)
+        else:
+            names = [name for name in dir(dispatcher) if not name.startswith('_')]
+            exported = [name for name in names if getattr(getattr(dispatcher, name, None), _EXPORT_ATTRIBUTE, False)]
+            if exported:
+                names = exported
+
+        table = {}
+        for name in names:
+            name = force_str(name)
+            func = getattr(dispatcher, name, None)
+            if not callable(func):
+                continue
+            entry = (func, executor_of(func), name, getattr(func, _CACHEABLE_ATTRIBUTE, None))
+            table[name] = entry
+            table[name.encode('utf-8')] = entry
+        self._dispatch_table = table
+
     def dispatch(self, method, param, responder):
         try:
-            method = force_str(method)
-            if not hasattr(self._dispatcher, method):
-                raise error.NoMethodError("'{0}' method not found".format(method))
+            entry = self._dispatch_table.get(method)
+            if entry is None:
+                if self._metrics is not None:
+                    responder = _MeteredResponder(responder, self._metrics.method(_metrics.UNKNOWN_METHOD))
+                raise error.NoMethodError("'{0}' method not found".format(force_str(method)))
 
-            result = getattr(self._dispatcher, method)(*param)
+            func, executor, name, cacheable = entry
+            if self._metrics is not None:
+                responder = _MeteredResponder(responder, self._metrics.method(name))
+            if cacheable is not None:
+                key = (name, self._packer.pack(param))
+                body = self._response_cache.get(key)
+                if body is not None:
+                    responder.set_packed_result(body)
+                    return
+                responder = _CachingResponder(responder, self._response_cache, key, cacheable['ttl'], self._packer)
+            if executor is not None:
+                self._executors.submit(executor, name, func, param, responder)
+                return
+
+            result = func(*param)
             if isinstance(result, AsyncResult):
                 result.set_responder(responder)
             else:
@@ -57,6 +265,40 @@ class Server(session.Session):
         # TODO: Support advanced return
 
 
+_EXPORT_ATTRIBUTE = '_msgpackrpc_export'
+
+_NEXT = '__next__' if inPy3k else 'next'
+
+
+_CACHEABLE_ATTRIBUTE = '_msgpackrpc_cacheable'
+
+
+def cacheable(func=None, ttl=None):
+    """\
+    Marks a pure dispatcher method: its packed responses are cached by
+    params, so repeated calls skip the method and packing. Use it as
+    @cacheable or @cacheable(ttl=seconds); see Server.invalidate().
+    """
+
+    def mark(func):
+        setattr(func, _CACHEABLE_ATTRIBUTE, {'ttl': ttl})
+        return func
+
+    if func is None:
+        return mark
+    return mark(func)
+
+
+def export(func):
+    """\
+    Marks a dispatcher method as callable. Once any method of a dispatcher is
+    marked, unmarked methods are no longer callable.
+    """
+
+    setattr(func, _EXPORT_ATTRIBUTE, True)
+    return func
+
+
 class AsyncResult:
     def __init__(self):
         self._responder = None
@@ -86,9 +328,74 @@ class _Responder:
 
     def set_result(self, value, error=None, packer=msgpack.Packer()):
         if not self._sent:
-            self._sendable.send_message([message.RESPONSE, self._msgid, error, value])
+            if error is None and _is_iterator(value):
+                if self._sendable.send_stream(self._msgid, value):
+                    self._sent = True
+                    return
+                try:
+                    value = list(value)
+                except Exception as e:
+                    value, error = None, str(e)
+            self._sendable.send_response(self._msgid, error, value)
+            self._sent = True
+
+    def set_error(self, error, value=None):
+        self.set_result(value, error)
+
+    def set_packed_result(self, body):
+        if not self._sent:
+            self._sendable.send_packed_response(self._msgid, body)
             self._sent = True
 
+
+def _is_iterator(value):
+    return hasattr(value, _NEXT) and not isinstance(value, (list, tuple, dict))
+
+
+class _MeteredResponder(object):
+    def __init__(self, responder, metrics):
+        self._responder = responder
+        self._metrics = metrics
+        self._started = metrics.begin()
+
+    def set_result(self, value, error=None):
+        if self._metrics is not None:
+            self._metrics.finish(self._started, error is not None)
+            self._metrics = None
+        self._responder.set_result(value, error)
+
+    def set_error(self, error, value=None):
+        self.set_result(value, error)
+
+    def set_packed_result(self, body):
+        if self._metrics is not None:
+            self._metrics.finish(self._started)
+            self._metrics = None
+        self._responder.set_packed_result(body)
+
+
+class _CachingResponder(object):
+    def __init__(self, responder, cache, key, ttl, packer):
+        self._responder = responder
+        self._cache = cache
+        self._key = key
+        self._ttl = ttl
+        self._packer = packer
+
+    def set_result(self, value, error=None):
+        if error is not None or _is_iterator(value):
+            self._responder.set_result(value, error)
+            return
+
+        try:
+            body = self._packer.pack(value)
+        except Exception:
+            # Let the transport report what can not be packed.
+            self._responder.set_result(value, error)
+            return
+        self._cache.put(self._key, body, self._ttl)
+        self._responder.set_packed_result(body)
+
     def set_error(self, error, value=None):
         self.set_result(value, error)
 
@@ -99,3 +406,6 @@ class _NullResponder:
 
     def set_error(self, error, value=None):
         pass
+
+    def set_packed_result(self, body):
+        pass
@@ -1,9 +1,18 @@
+import heapq
+import warnings
+from collections import deque
+
 from msgpackrpc import Loop
 from msgpackrpc import message
+from msgpackrpc import metrics as _metrics
 from msgpackrpc.future import Future
 from msgpackrpc.transport import tcp
-from msgpackrpc.compat import iteritems
-from msgpackrpc.error import TimeoutError
+from msgpackrpc.compat import force_str, iteritems
+from msgpackrpc.error import TimeoutError, TransportError
+
+# Times a request of an idempotent method is sent again after losing its
+# connection, so that a server dropping every connection is not retried forever.
+MAX_REPLAYS = 3
 
 
 class Session(object):
@@ -17,51 +26,283 @@ class Session(object):
 
     When it receives the message, the Session lookups the request table and set the
     result to the corresponding future.
+
+    Timeouts are kept in a heap of (deadline, msgid, future) entries and a single
+    loop timeout is armed for the earliest one. A response only pops the request
+    table; the stale heap entry is skipped when it reaches the top.
+
+    A hedged request maps the msgids of both its copies to one future in the
+    request table and to one _Hedge in self._hedges. The first answer pops
+    both; the late one then finds no entry and is dropped like any unknown
+    msgid.
     """
 
-    def __init__(self, address, timeout, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None):
+    def __init__(self, address, timeout, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None, pool_size=1, metrics=False, cache=None, idempotent=(), hedging=None, **transport_options):
         """\
         :param address: address of the server.
+        :param timeout: default request timeout in seconds (float allowed).
+                        None or 0 disables timeouts.
         :param loop:    context object.
         :param builder: builder for creating transport layer
+        :param pool_size: number of connections requests are striped over
+        :param metrics: True or a Metrics instance to record per-method
+                        counts and round-trip latency.
+        :param cache:   a msgpackrpc.cache.ResultCache for the results of
+                        call/call_async of its methods.
+        :param idempotent: names of the methods which may safely run twice,
+                        or True for all. Their requests are sent again when
+                        the connection they were sent on is lost; others
+                        fail with a TransportError.
+        :param hedging: a msgpackrpc.hedge.Hedging, to send requests of its
+                        methods once more when they are slow to be answered.
+        :param transport_options: builder specific options, e.g. coalesce=True
+                                  for tcp (see tcp.DEFAULT_OPTIONS)
         """
 
         self._loop = loop or Loop()
         self._address = address
         self._timeout = timeout
-        self._transport = builder.ClientTransport(self, self._address, reconnect_limit, encodings=(pack_encoding, unpack_encoding))
+        self._transport = self.create_transport(builder, reconnect_limit, (pack_encoding, unpack_encoding),
+                                                pool_size, transport_options)
         self._generator = _NoSyncIDGenerator()
         self._request_table = {}
+        self._deadlines = []
+        self._timer = None
+        self._timer_deadline = None
+        self._metrics = _metrics.create(metrics)
+        self._metered = {}
+        self._cache = cache
+        self._idempotent = idempotent if idempotent is True else frozenset(idempotent)
+        self._hedging = hedging
+        self._hedges = {}
+
+    def create_transport(self, builder, reconnect_limit, encodings, pool_size, options):
+        return builder.ClientTransport(self, self._address, reconnect_limit, encodings=encodings,
+                                       pool_size=pool_size, options=options)
 
     @property
     def address(self):
         return self._address
 
-    def call(self, method, *args):
-        return self.send_request(method, args).get()
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def hedging(self):
+        return self._hedging
+
+    @property
+    def metrics(self):
+        """\
+        The Metrics of this session, or None when disabled.
+        """
+
+        return self._metrics
+
+    @property
+    def write_stats(self):
+        return self._transport.write_stats
+
+    @property
+    def compression_stats(self):
+        return self._transport.compression_stats
+
+    def call(self, method, *args, **kwargs):
+        """\
+        Calls *method* and waits for the result. The keyword argument *timeout*
+        overrides the session timeout for this call.
+        """
+
+        return self.send_request(method, args, _timeout_option(kwargs)).get()
+
+    def call_async(self, method, *args, **kwargs):
+        return self.send_request(method, args, _timeout_option(kwargs))
+
+    def call_stream(self, method, *args, **kwargs):
+        """\
+        Calls *method* and returns an iterator over the items of its result.
+        With the streaming option, a handler returning an iterator sends its
+        items in chunks, which are yielded as they arrive. The timeout then
+        applies to the gap between chunks.
+        """
+
+        return self.send_request(method, args, _timeout_option(kwargs)).stream()
+
+    def call_many(self, requests):
+        """\
+        Sends all (method, args) pairs of *requests* back-to-back and returns
+        their results in the same order.
+        """
+
+        futures = self.call_many_async(requests)
+        self.wait_all(futures)
+        return [future.get() for future in futures]
+
+    def call_many_async(self, requests):
+        messages = []
+        futures = []
+        for method, args in requests:
+            future, msg = self._create_request(method, args)
+            messages.append(msg)
+            futures.append(future)
+
+        if messages:
+            self._transport.send_messages(messages)
+        return futures
 
-    def call_async(self, method, *args):
-        return self.send_request(method, args)
+    def send_request(self, method, args, timeout=None):
+        cache = self._cache
+        if cache is not None:
+            key = cache.key(method, args)
+            if key is not None:
+                future, new = cache.begin(key, lambda: self._new_future(timeout))
+                if not new:
+                    return future
+                return self._send_request(method, args, timeout, future)
+        return self._send_request(method, args, timeout)
 
-    def send_request(self, method, args):
-        # need lock?
+    def _send_request(self, method, args, timeout, future=None):
+        future, msg = self._create_request(method, args, timeout, future)
+        self._transport.send_message(msg)
+        return future
+
+    def _new_future(self, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        return Future(self._loop, timeout)
+
+    def _create_request(self, method, args, timeout=None, future=None):
+        # Not thread-safe; ThreadedClient only calls it on its I/O thread.
+        if timeout is None:
+            timeout = self._timeout
         msgid = next(self._generator)
-        future = Future(self._loop, self._timeout)
+        if future is None:
+            future = self._new_future(timeout)
         self._request_table[msgid] = future
-        self._transport.send_message([message.REQUEST, msgid, method, args])
-        return future
+        if timeout:
+            future._deadline = self._loop.time() + timeout
+            self._add_deadline(future._deadline, msgid, future)
+        if self._metrics is not None:
+            metrics = self._metrics.method(force_str(method))
+            self._metered[msgid] = (metrics, metrics.begin())
+        msg = [message.REQUEST, msgid, method, args]
+        if self._hedging is not None and self._hedging.applies(method):
+            self._arm_hedge(msg)
+        return future, msg
+
+    def wait_all(self, futures):
+        """\
+        Runs the loop until every future in *futures* is resolved. The loop is
+        stopped only once, after the last future is set.
+        """
+
+        pending = set(future for future in futures if not future.done)
+        if not pending:
+            return futures
+
+        def on_done(future):
+            pending.discard(future)
+            if not pending:
+                self._loop.stop()
+
+        previous = _attach_waiter(pending, on_done)
+        try:
+            while pending:
+                self._loop.start()
+        finally:
+            _restore_waiters(previous)
+        return futures
+
+    def as_completed(self, futures):
+        """\
+        Yields the futures in *futures* in the order they are resolved.
+        """
+
+        pending = set()
+        completed = deque()
+        for future in futures:
+            if future.done:
+                completed.append(future)
+            else:
+                pending.add(future)
+
+        def on_done(future):
+            if future in pending:
+                pending.discard(future)
+                completed.append(future)
+                self._loop.stop()
+
+        previous = _attach_waiter(pending, on_done)
+        try:
+            while completed or pending:
+                while completed:
+                    yield completed.popleft()
+                if pending:
+                    self._loop.start()
+        finally:
+            _restore_waiters(previous)
 
     def notify(self, method, *args):
+        """\
+        Sends a notification and waits until it has been written.
+        """
+
+        self.notify_async(method, *args)
+        self.flush()
+
+    def notify_async(self, method, *args):
+        """\
+        Queues a notification without running the loop. It is written right
+        away when connected, otherwise (or with coalesce=True) the next time
+        the loop runs; flush() waits for that.
+        """
+
+        self._transport.send_message([message.NOTIFY, method, args])
+
+    def notify_many(self, notifications):
+        """\
+        Queues all (method, args) pairs of *notifications* as one write,
+        like notify_async.
+        """
+
+        messages = [[message.NOTIFY, method, args] for method, args in notifications]
+        if messages:
+            self._transport.send_messages(messages)
+
+    def flush(self):
+        """\
+        Runs the loop until every message sent so far has been written, or
+        the connection failed.
+        """
+
+        if self._transport is None:
+            return
+
+        flushed = []
         def callback():
+            flushed.append(True)
             self._loop.stop()
-        self._transport.send_message([message.NOTIFY, method, args], callback=callback)
-        self._loop.start()
+        self._transport.flush(callback)
+        while not flushed and self._transport is not None:
+            self._loop.start()
 
     def close(self):
+        self._clear_hedges()
         if self._transport:
             self._transport.close()
         self._transport = None
+        for future in self._request_table.values():
+            self._settled(future)
         self._request_table = {}
+        self._clear_deadlines()
+        self._finish_all_metered()
+
+    def on_connect(self):
+        """\
+        The callback called when a connection is established.
+        Called by the transport layer.
+        """
 
     def on_connect_failed(self, reason):
         """
@@ -69,13 +310,70 @@ class Session(object):
         Called by the transport layer.
         """
         # set error for all requests
+        self._clear_hedges()
         for msgid, future in iteritems(self._request_table):
             future.set_error(reason)
+            self._settled(future)
 
         self._request_table = {}
+        self._clear_deadlines()
+        self._finish_all_metered()
         self.close()
         self._loop.stop()
 
+    def on_connection_lost(self, requests):
+        """\
+        The callback called with the request messages which were unanswered
+        on a connection that closed. Requests of idempotent methods are sent
+        again up to MAX_REPLAYS times, unless part of their result was
+        streamed already; the others fail now rather than at their timeout.
+        Called by the transport layer.
+        """
+
+        replayed = []
+        failed = []
+        exhausted = []
+        for request in requests:
+            future = self._request_table.get(request[1])
+            if future is None:
+                continue
+            if not self._is_idempotent(request[2]) or future.streamed:
+                failed.append(request[1])
+            elif future._replays >= MAX_REPLAYS:
+                exhausted.append(request[1])
+            else:
+                future._replays += 1
+                replayed.append(request)
+
+        self._fail_requests(failed, TransportError("Connection lost"))
+        self._fail_requests(exhausted, TransportError("Connection lost {0} times".format(MAX_REPLAYS + 1)))
+        if replayed:
+            self._transport.send_messages(replayed)
+
+    def on_send_failed(self, requests, error):
+        """\
+        The callback called with request messages which could not be sent.
+        Called by the transport layer.
+        """
+
+        self._fail_requests([request[1] for request in requests], error)
+
+    def _fail_requests(self, msgids, error):
+        for msgid in msgids:
+            future = self._request_table.pop(msgid, None)
+            if future is None:
+                continue
+            if self._hedges and self._drop_hedge(msgid):
+                # The other copy may still be answered.
+                continue
+            if self._metered:
+                self._finish_metered(msgid, True)
+            future.set_error(error)
+            self._settled(future)
+
+    def _is_idempotent(self, method):
+        return self._idempotent is True or force_str(method) in self._idempotent
+
     def on_response(self, msgid, error, result):
         """\
         The callback called when the message arrives.
@@ -87,31 +385,248 @@ class Session(object):
             #raise RPCError("Unknown msgid: id = {0}".format(msgid))
             return
         future = self._request_table.pop(msgid)
+        if self._hedges:
+            self._end_hedge(msgid, error is None)
+        if self._metered:
+            self._finish_metered(msgid, error is not None)
 
         if error is not None:
             future.set_error(error)
         else:
             future.set_result(result)
-        self._loop.stop()
+        if future._cache_key is not None:
+            self._settled(future)
+
+    def on_stream(self, msgid, items):
+        """\
+        The callback called when a chunk of a streamed result arrives.
+        Returns the future it was fed to, if any.
+        Called by the transport layer.
+        """
+
+        future = self._request_table.get(msgid)
+        if future is None:
+            return None
+        if self._hedges:
+            # The copy which streams first wins.
+            self._end_hedge(msgid, False)
+        if future._deadline is not None:
+            # Pushed back lazily when the old deadline comes up.
+            future._deadline = self._loop.time() + future._timeout
+        future._feed(items)
+        return future
 
     def on_timeout(self, msgid):
         future = self._request_table.pop(msgid)
-        future.set_error("Request timed out")
+        if self._hedges:
+            self._end_hedge(msgid, False)
+        if self._metered:
+            self._finish_metered(msgid, True)
+        future.set_error(TimeoutError("Request timed out"))
+        self._settled(future)
+        if self._transport is not None:
+            self._transport.forget(msgid)
 
-    def step_timeout(self):
-        timeouts = []
-        for msgid, future in iteritems(self._request_table):
-            if future.step_timeout():
-                timeouts.append(msgid)
+    def _arm_hedge(self, msg):
+        hedging = self._hedging
+        hedging.begin()
+        hedge = _Hedge(msg, self._loop.time())
+        deadline = hedge.started + hedging.delay(msg[2])
+        hedge.timer = self._loop.add_timeout(deadline, lambda: self._send_hedge(hedge))
+        self._hedges[msg[1]] = hedge
 
-        if len(timeouts) == 0:
+    def _send_hedge(self, hedge):
+        hedge.timer = None
+        msgid = hedge.msg[1]
+        future = self._request_table.get(msgid)
+        if future is None or future.streamed or self._transport is None:
+            return
+        # With one connection and one backend the copy would only queue
+        # behind the request; keep the budget for when it helps.
+        if not self._transport.can_hedge(msgid):
+            return
+        if not self._hedging.spend():
             return
 
-        self._loop.stop()
-        for timeout in timeouts:
-            future = self._request_table.pop(timeout)
-            future.set_error(TimeoutError("Request timed out"))
-        self._loop.start()
+        duplicate = next(self._generator)
+        hedge.duplicate = duplicate
+        self._request_table[duplicate] = future
+        self._hedges[duplicate] = hedge
+        self._transport.send_hedge([message.REQUEST, duplicate, hedge.msg[2], hedge.msg[3]], msgid)
+
+    def _end_hedge(self, msgid, succeeded):
+        # *msgid* answered first: drop the other copy and record the round trip.
+        hedge = self._hedges.pop(msgid, None)
+        if hedge is None:
+            return
+        self._cancel_hedge(hedge)
+        original = hedge.msg[1]
+        other = hedge.duplicate if msgid == original else original
+        if other is not None:
+            self._hedges.pop(other, None)
+            if self._request_table.pop(other, None) is not None and self._transport is not None:
+                self._transport.forget(other)
+        if msgid != original:
+            self._hedging.stats.wins += 1
+            self._adopt(msgid, original)
+        if succeeded:
+            self._hedging.record(hedge.msg[2], self._loop.time() - hedge.started)
+
+    def _drop_hedge(self, msgid):
+        # Returns True if the other copy of the request is still pending and
+        # carries on alone.
+        hedge = self._hedges.pop(msgid, None)
+        if hedge is None:
+            return False
+        self._cancel_hedge(hedge)
+        original = hedge.msg[1]
+        other = hedge.duplicate if msgid == original else original
+        if other is None or other not in self._request_table:
+            return False
+        del self._hedges[other]
+        if msgid == original:
+            self._adopt(other, original)
+        return True
+
+    def _adopt(self, msgid, original):
+        # The duplicate takes over the metering and timeout of the original.
+        if self._metered:
+            entry = self._metered.pop(original, None)
+            if entry is not None:
+                self._metered[msgid] = entry
+        future = self._request_table.get(msgid)
+        if future is not None and future._deadline is not None:
+            self._add_deadline(future._deadline, msgid, future)
+
+    def _cancel_hedge(self, hedge):
+        if hedge.timer is not None:
+            self._loop.remove_timeout(hedge.timer)
+            hedge.timer = None
+
+    def _clear_hedges(self):
+        # Leaves one entry per future in the request table.
+        for msgid, hedge in self._hedges.items():
+            self._cancel_hedge(hedge)
+            if msgid != hedge.msg[1]:
+                self._request_table.pop(msgid, None)
+        self._hedges = {}
+
+    def step_timeout(self):
+        """\
+        Deprecated: timeouts are enforced by a loop timeout armed for the
+        earliest deadline. Fails the requests whose deadline has passed.
+        """
+
+        warnings.warn("Session.step_timeout is not needed anymore", DeprecationWarning, stacklevel=2)
+        if self._timer is not None:
+            self._loop.remove_timeout(self._timer)
+            self._timer = None
+        self._on_deadline()
+
+    def _settled(self, future):
+        # Ends single-flight coalescing of a cached request.
+        if future._cache_key is not None:
+            self._cache.complete(future._cache_key, future)
+
+    def _finish_metered(self, msgid, failed):
+        entry = self._metered.pop(msgid, None)
+        if entry is not None:
+            entry[0].finish(entry[1], failed)
+
+    def _finish_all_metered(self):
+        for metrics, started in self._metered.values():
+            metrics.finish(started, True)
+        self._metered = {}
+
+    def _add_deadline(self, deadline, msgid, future):
+        heap = self._deadlines
+        heapq.heappush(heap, (deadline, msgid, future))
+
+        # Compact once stale entries of answered requests dominate the heap.
+        if len(heap) > 2 * len(self._request_table) + 1024:
+            table = self._request_table
+            heap[:] = [entry for entry in heap if table.get(entry[1]) is entry[2]]
+            heapq.heapify(heap)
+
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._arm_timer()
+
+    def _arm_timer(self):
+        heap = self._deadlines
+        table = self._request_table
+        while heap and table.get(heap[0][1]) is not heap[0][2]:
+            heapq.heappop(heap)
+
+        if self._timer is not None:
+            self._loop.remove_timeout(self._timer)
+            self._timer = None
+            self._timer_deadline = None
+        if heap:
+            self._timer_deadline = heap[0][0]
+            self._timer = self._loop.add_timeout(self._timer_deadline, self._on_deadline)
+
+    def _on_deadline(self):
+        self._timer = None
+        self._timer_deadline = None
+
+        now = self._loop.time()
+        heap = self._deadlines
+        while heap and heap[0][0] <= now:
+            deadline, msgid, future = heapq.heappop(heap)
+            if self._request_table.get(msgid) is future:
+                if future._deadline > deadline:
+                    heapq.heappush(heap, (future._deadline, msgid, future))
+                else:
+                    self.on_timeout(msgid)
+        self._arm_timer()
+
+    def _clear_deadlines(self):
+        if self._timer is not None:
+            self._loop.remove_timeout(self._timer)
+        self._timer = None
+        self._timer_deadline = None
+        self._deadlines = []
+
+
+class _Hedge(object):
+    __slots__ = ('msg', 'started', 'timer', 'duplicate')
+
+    def __init__(self, msg, started):
+        self.msg = msg
+        self.started = started
+        self.timer = None
+        self.duplicate = None
+
+
+def _attach_waiter(futures, waiter):
+    # Chains *waiter* before the waiters already set, e.g. by an outer
+    # wait_all, and returns those to be put back afterwards.
+    previous = []
+    for future in futures:
+        previous.append((future, future._waiter))
+        future._waiter = _chain_waiters(waiter, future._waiter)
+    return previous
+
+
+def _chain_waiters(waiter, previous):
+    if previous is None:
+        return waiter
+    def chained(future):
+        waiter(future)
+        previous(future)
+    return chained
+
+
+def _restore_waiters(previous):
+    for future, waiter in previous:
+        future._waiter = waiter
+
+
+def _timeout_option(kwargs):
+    timeout = kwargs.pop('timeout', None)
+    if kwargs:
+        raise TypeError("unexpected keyword arguments: {0}".format(", ".join(kwargs)))
+    return timeout
 
 
 def _NoSyncIDGenerator():
@@ -0,0 +1,216 @@
+"""\
+Shared-memory transport for co-located processes.
+
+Works like the unix builder (use a msgpackrpc.UnixAddress), but bytes-like
+values of at least shm_threshold bytes anywhere in a message are written to
+a region in shm_dir (a tmpfs such as /dev/shm) and only a small ext type
+descriptor goes over the socket. Both peers must use this builder.
+
+Each region is a file which the receiver maps, copies out and unlinks, so
+the kernel reclaims the memory once the receiver holds the only reference.
+The sender tracks its regions per connection and unlinks the ones that were
+never claimed when they outlive shm_ttl or the connection is closed.
+
+Region names carry the sender's pid. A receiver only claims regions in
+shm_dir itself (no symlinks) which are named with the pid of its peer and
+owned by the peer's user, as reported by SO_PEERCRED; where that is not
+available, by its own user.
+"""
+
+import mmap
+import os
+import socket
+import stat
+import struct
+import tempfile
+import time
+from collections import deque
+
+import msgpack
+
+from msgpackrpc import extension
+from msgpackrpc.error import TransportError
+from msgpackrpc.transport import tcp, unix
+
+EXT_CODE = 0x53
+
+_PREFIX = 'msgpackrpc-'
+_DEFAULT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# shm_threshold: smallest bytes value which is moved to shared memory.
+# shm_dir:       directory of the regions; should be a tmpfs.
+# shm_ttl:       seconds after which the sender reclaims an unclaimed region.
+DEFAULT_OPTIONS = dict(tcp.DEFAULT_OPTIONS,
+                       shm_threshold=1024 * 1024,
+                       shm_dir=_DEFAULT_DIR,
+                       shm_ttl=60)
+
+
+class SharedMemoryStats(object):
+    def __init__(self):
+        self.regions = 0
+        self.bytes = 0
+        self.reclaimed = 0
+
+
+class _SharedMemoryMixin(object):
+    def _init_shm(self, options, stats):
+        self._shm_threshold = options['shm_threshold']
+        self._shm_dir = os.path.realpath(options['shm_dir'])
+        self._peer = None
+        self._shm_ttl = options['shm_ttl']
+        self._shm_stats = stats
+        self._regions = deque()
+
+    def create_unpacker(self, encodings, options):
+        return msgpack.Unpacker(encoding=encodings[1], max_buffer_size=options['max_buffer_size'],
+                                ext_hook=self._load_region)
+
+    def pack(self, message):
+        # A message packing to less than shm_threshold holds no large value.
+        if not tcp._has_large_buffer(message[-1], self._shm_threshold):
+            data = self._packer.pack(message)
+            if len(data) < self._shm_threshold:
+                return data
+        return self._packer.pack(self._externalize(message))
+
+    def pack_segments(self, message):
+        # Large values go through shared memory instead.
+        return self.pack(message)
+
+    def close(self):
+        tcp.BaseSocket.close(self)
+        while self._regions:
+            self._unlink(self._regions.popleft()[0])
+
+    def _externalize(self, obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            view = memoryview(obj)
+            if view.nbytes and view.nbytes >= self._shm_threshold:
+                return self._store_region(view)
+            return obj
+        if isinstance(obj, (list, tuple)):
+            return [self._externalize(item) for item in obj]
+        if isinstance(obj, dict):
+            return dict((key, self._externalize(value)) for key, value in obj.items())
+        return obj
+
+    def _store_region(self, view):
+        self._reclaim()
+
+        size = view.nbytes
+        fd, path = tempfile.mkstemp(prefix='{0}{1}-'.format(_PREFIX, os.getpid()), dir=self._shm_dir)
+        try:
+            os.ftruncate(fd, size)
+            region = mmap.mmap(fd, size)
+            try:
+                if view.ndim != 1 or view.format != 'B':
+                    view = view.cast('B')
+                region[:] = view
+            finally:
+                region.close()
+        except Exception:
+            self._unlink(path)
+            raise
+        finally:
+            os.close(fd)
+
+        self._regions.append((path, time.time()))
+        self._shm_stats.regions += 1
+        self._shm_stats.bytes += size
+        return msgpack.ExtType(EXT_CODE, msgpack.packb([os.path.basename(path), size]))
+
+    def _load_region(self, code, data):
+        if code != EXT_CODE:
+            return extension.ext_hook(code, data)
+
+        name, size = msgpack.unpackb(data)
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        pid, uid = self._peer_credentials()
+        prefix = _PREFIX if pid is None else '{0}{1}-'.format(_PREFIX, pid)
+        if os.path.basename(name) != name or not name.startswith(prefix):
+            raise TransportError("Invalid shared memory region: {0}".format(name))
+
+        path = os.path.join(self._shm_dir, name)
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError:
+            raise TransportError("Shared memory region is gone: {0}".format(name))
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != uid or info.st_size < size:
+                raise TransportError("Shared memory region not owned by the peer: {0}".format(name))
+            # Claim the region; the memory is freed once it is unmapped.
+            os.unlink(path)
+            region = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            try:
+                return region[:]
+            finally:
+                region.close()
+        finally:
+            os.close(fd)
+
+    def _peer_credentials(self):
+        # (pid, uid) of the process at the other end of the socket.
+        if self._peer is None:
+            self._peer = (None, os.geteuid())
+            option = getattr(socket, 'SO_PEERCRED', None)
+            sock = self._stream.socket
+            if option is not None and sock is not None:
+                try:
+                    pid, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, option,
+                                                                      struct.calcsize('3i')))
+                except (socket.error, struct.error):
+                    pass
+                else:
+                    self._peer = (pid, uid)
+        return self._peer
+
+    def _reclaim(self):
+        regions = self._regions
+        deadline = time.time() - self._shm_ttl
+        while regions:
+            path, created = regions[0]
+            if os.path.exists(path):
+                if created > deadline:
+                    break
+                self._unlink(path)
+                self._shm_stats.reclaimed += 1
+            regions.popleft()
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class ClientSocket(_SharedMemoryMixin, tcp.ClientSocket):
+    def __init__(self, stream, transport, encodings):
+        self._init_shm(transport._options, transport.shm_stats)
+        tcp.ClientSocket.__init__(self, stream, transport, encodings)
+
+
+class ServerSocket(_SharedMemoryMixin, tcp.ServerSocket):
+    def __init__(self, stream, transport, encodings):
+        self._init_shm(transport._options, transport.shm_stats)
+        tcp.ServerSocket.__init__(self, stream, transport, encodings)
+
+
+class ClientTransport(unix.ClientTransport):
+    socket_class = ClientSocket
+    default_options = DEFAULT_OPTIONS
+
+    def __init__(self, *args, **kwargs):
+        self.shm_stats = SharedMemoryStats()
+        unix.ClientTransport.__init__(self, *args, **kwargs)
+
+
+class ServerTransport(unix.ServerTransport):
+    socket_class = ServerSocket
+    default_options = DEFAULT_OPTIONS
+
+    def __init__(self, *args, **kwargs):
+        self.shm_stats = SharedMemoryStats()
+        unix.ServerTransport.__init__(self, *args, **kwargs)
@@ -0,0 +1,205 @@
+import errno
+import itertools
+import socket
+from collections import deque
+
+from tornado import stack_context
+from tornado.concurrent import TracebackFuture
+from tornado.iostream import IOStream, StreamBufferFullError
+from tornado.log import gen_log
+
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+# recv_into calls per read event, so one busy peer cannot starve the loop.
+_MAX_READS_PER_EVENT = 16
+
+# Buffers per sendmsg call; well below IOV_MAX (1024 on Linux).
+_MAX_SEGMENTS = 64
+
+# Bytes per send call where sendmsg is missing (Windows blows up on larger).
+_MAX_SEND = 128 * 1024
+
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# DirectIOStream needs memoryview.cast (Python 3.3).
+DIRECT_IO_SUPPORTED = hasattr(memoryview, 'cast')
+
+
+class DirectIOStream(IOStream):
+    """\
+    IOStream which hands received data straight to a callback.
+
+    After read_into_callback(), data is received with socket.recv_into into one
+    preallocated buffer and passed to the callback as a memoryview over it,
+    synchronously from the read event. IOStream's own read buffer and the bytes
+    objects it creates per chunk are bypassed. The view is only valid during
+    the callback; the callback must copy whatever it keeps (Unpacker.feed does).
+
+    Writes are queued as the buffers they were given instead of being copied
+    into IOStream's write buffer, and write() also takes a list of buffers,
+    which are sent together with socket.sendmsg (scatter/gather I/O).
+
+    NOTE: This hooks into IOStream internals of Tornado < 5.
+    """
+
+    def __init__(self, socket, *args, **kwargs):
+        self._read_into_view = None
+        self._read_into_callback = None
+        self._read_paused = False
+        self._write_segments = deque()
+        IOStream.__init__(self, socket, *args, **kwargs)
+
+    def read_into_callback(self, callback, buffer_size=256 * 1024):
+        self._read_into_view = memoryview(bytearray(buffer_size))
+        self._read_into_callback = callback
+        self._add_io_state(self.io_loop.READ)
+
+    def pause_reading(self):
+        """\
+        Stops watching the socket for reads until resume_reading(); the
+        peer is held back by the kernel's receive buffer and flow control.
+        """
+
+        self._read_paused = True
+        self._drop_read_state()
+
+    def resume_reading(self):
+        self._read_paused = False
+        if self._read_into_callback is not None and not self.closed():
+            self._add_io_state(self.io_loop.READ)
+
+    def _drop_read_state(self):
+        if not self.closed() and self._state is not None and self._state & self.io_loop.READ:
+            self._state &= ~self.io_loop.READ
+            self.io_loop.update_handler(self.fileno(), self._state)
+
+    def _handle_events(self, fd, events):
+        IOStream._handle_events(self, fd, events)
+        # IOStream watches idle streams for reads to notice a close.
+        if self._read_paused:
+            self._drop_read_state()
+
+    def _maybe_add_error_listener(self):
+        if not self._read_paused:
+            IOStream._maybe_add_error_listener(self)
+
+    def reading(self):
+        if self._read_into_callback is not None:
+            return not self._read_paused
+        return IOStream.reading(self)
+
+    def _handle_read(self):
+        if self._read_into_callback is None:
+            return IOStream._handle_read(self)
+
+        view = self._read_into_view
+        reads = 0
+        while reads < _MAX_READS_PER_EVENT and not self._read_paused and not self.closed():
+            try:
+                size = self.socket.recv_into(view)
+            except (socket.error, IOError, OSError) as e:
+                err = e.args[0] if e.args else None
+                if err == errno.EINTR:
+                    continue
+                if err in _ERRNO_WOULDBLOCK:
+                    return
+                self.close(exc_info=True)
+                return
+
+            if size == 0:
+                self.close()
+                return
+            reads += 1
+            self._read_into_callback(view[:size])
+
+    def write(self, data, callback=None):
+        """\
+        Like IOStream.write, but *data* may also be a list of bytes-like
+        objects. They are sent as they are, so none of them may be modified
+        before the write has completed.
+        """
+
+        self._check_closed()
+        if not isinstance(data, list):
+            data = [data]
+        size = 0
+        for buf in data:
+            view = _byte_view(buf)
+            if len(view):
+                self._write_segments.append(view)
+                size += len(view)
+        if size:
+            if (self.max_write_buffer_size is not None and
+                    self._write_buffer_size + size > self.max_write_buffer_size):
+                raise StreamBufferFullError("Reached maximum write buffer size")
+            self._write_buffer_size += size
+            self._total_write_index += size
+
+        if callback is not None:
+            self._write_callback = stack_context.wrap(callback)
+            future = None
+        else:
+            future = TracebackFuture()
+            future.add_done_callback(lambda f: f.exception())
+            self._write_futures.append((self._total_write_index, future))
+        if not self._connecting:
+            self._handle_write()
+            if self._write_buffer_size:
+                self._add_io_state(self.io_loop.WRITE)
+            self._maybe_add_error_listener()
+        return future
+
+    def _handle_write(self):
+        segments = self._write_segments
+        while self._write_buffer_size:
+            try:
+                if _HAS_SENDMSG:
+                    size = self.socket.sendmsg(list(itertools.islice(segments, _MAX_SEGMENTS)))
+                else:
+                    size = self.socket.send(segments[0][:_MAX_SEND])
+            except (socket.error, IOError, OSError) as e:
+                err = e.args[0] if e.args else None
+                if err == errno.EINTR:
+                    continue
+                if err in _ERRNO_WOULDBLOCK:
+                    break
+                if not self._is_connreset(e):
+                    gen_log.warning("Write error on %s: %s", self.fileno(), e)
+                self.close(exc_info=True)
+                return
+
+            if size == 0:
+                break
+            self._write_buffer_size -= size
+            self._total_write_done_index += size
+            while size:
+                head = segments[0]
+                if len(head) > size:
+                    segments[0] = head[size:]
+                    break
+                size -= len(head)
+                segments.popleft()
+
+        while self._write_futures:
+            index, future = self._write_futures[0]
+            if index > self._total_write_done_index:
+                break
+            self._write_futures.popleft()
+            future.set_result(None)
+
+        if not self._write_buffer_size and self._write_callback:
+            callback = self._write_callback
+            self._write_callback = None
+            self._run_callback(callback)
+
+    def close(self, exc_info=False):
+        IOStream.close(self, exc_info)
+        self._write_segments.clear()
+
+
+def _byte_view(buf):
+    # A flat view of bytes, so that partial sends can be sliced off by byte.
+    view = memoryview(buf)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast('B')
+    return view
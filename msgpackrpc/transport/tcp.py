@@ -1,31 +1,398 @@
+import functools
+import random
+import socket
+import struct
+from collections import deque
+
 import msgpack
 from tornado import tcpserver
-from tornado.iostream import IOStream
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets
 
 import msgpackrpc.message
+from msgpackrpc import compression, extension
+from msgpackrpc.compat import force_str
 from msgpackrpc.error import RPCError, TransportError
+from msgpackrpc.transport.stream import DIRECT_IO_SUPPORTED, DirectIOStream
+
+
+# Transport options understood by this builder, with their defaults.
+#
+# coalesce:       buffer packed messages and write them together once per loop
+#                 iteration instead of one IOStream.write per message.
+# coalesce_bytes: flush the buffer as soon as it holds this many bytes.
+# coalesce_delay: seconds to hold the buffer before flushing; 0 flushes on the
+#                 next loop iteration.
+# read_into:      receive with recv_into into a reusable buffer and feed the
+#                 Unpacker from it (see DirectIOStream) instead of going
+#                 through IOStream.read_bytes. Needs Python 3.3 or
+#                 later and relies on internals of Tornado < 5.
+# read_buffer_size: size of that reusable receive buffer, or of the reads
+#                 from an IOStream without read_into.
+# max_buffer_size:  maximum bytes the Unpacker buffers, i.e. the largest
+#                   acceptable message, also after decompression; 0 means
+#                   msgpack's default.
+# nodelay:        disable Nagle's algorithm (TCP_NODELAY), so that responses
+#                 written one by one are not held back waiting for an ACK.
+# compression:    codec names (see msgpackrpc.compression). Clients offer them
+#                 in this order when connecting, None offers nothing. Servers
+#                 accept these, None accepts every registered codec.
+# compression_threshold: smallest write, in bytes, which is compressed.
+# streaming:      clients ask the server to stream iterator results in chunks
+#                 (see Session.call_stream). Servers always honour it.
+# stream_chunk_size: items per chunk of a streamed result (server).
+# max_stream_chunks: chunks of a streamed result a client buffers for a caller
+#                 iterating call_stream before it stops reading from that
+#                 connection until the caller caught up; 0 means no limit.
+#                 Other requests on the connection wait meanwhile.
+# max_inflight:   requests a server connection may have unanswered before
+#                 reading from it pauses, leaving the rest of the client's
+#                 requests in the kernel's buffers; 0 means no limit.
+# max_pending_writes: bytes a server connection may have waiting to be
+#                 written before reading from it pauses; 0 means no limit.
+# zero_copy_threshold: smallest bytes-like argument or result, in bytes, which
+#                 is written from its own buffer after its packed header
+#                 instead of being copied into the packed message; 0 copies
+#                 everything. Like read_into it uses a DirectIOStream, so it
+#                 needs Python 3.3 or later and Tornado < 5.
+# connect_delay:  seconds a client gives a connection attempt to one of the
+#                 resolved addresses before also trying the next one, taking
+#                 turns between address families (happy eyeballs).
+# reconnect_delay: seconds before a client tries to connect again after a
+#                 failed attempt; doubled per failure up to reconnect_delay_max,
+#                 and jittered over its upper half.
+# max_pending:    messages a client buffers while it is (re)connecting; the
+#                 requests beyond fail at once. 0 means no limit.
+DEFAULT_OPTIONS = {
+    'coalesce': False,
+    'coalesce_bytes': 64 * 1024,
+    'coalesce_delay': 0,
+    'read_into': False,
+    'read_buffer_size': 256 * 1024,
+    'max_buffer_size': 0,
+    'nodelay': False,
+    'compression': None,
+    'compression_threshold': 4096,
+    'streaming': False,
+    'stream_chunk_size': 100,
+    'max_stream_chunks': 1024,
+    'max_inflight': 0,
+    'max_pending_writes': 0,
+    'zero_copy_threshold': 0,
+    'connect_delay': 0.25,
+    'reconnect_delay': 0.05,
+    'reconnect_delay_max': 2.0,
+    'max_pending': 65536,
+}
+
+
+def transport_options(options, defaults=DEFAULT_OPTIONS):
+    """\
+    Returns *options* merged over *defaults*, rejecting unknown names.
+    """
+
+    options = options or {}
+    unknown = [name for name in options if name not in defaults]
+    if unknown:
+        raise TypeError("unknown transport options: {0}".format(", ".join(sorted(unknown))))
+
+    merged = dict(defaults)
+    merged.update(options)
+    if _direct_io(merged) and not DIRECT_IO_SUPPORTED:
+        raise ValueError("read_into and zero_copy_threshold need Python 3.3 or later")
+    return merged
+
+
+class WriteStats(object):
+    """\
+    Counts stream writes (flushes) and the messages and bytes they carried.
+    """
+
+    def __init__(self):
+        self.flushes = 0
+        self.messages = 0
+        self.bytes = 0
+
+    @property
+    def messages_per_flush(self):
+        if self.flushes == 0:
+            return 0.0
+        return float(self.messages) / self.flushes
+
+    def merge(self, other):
+        self.flushes += other.flushes
+        self.messages += other.messages
+        self.bytes += other.bytes
+        return self
 
 
 class BaseSocket(object):
-    def __init__(self, stream, encodings):
+    def __init__(self, stream, encodings, options=None, stats=None, compression_stats=None):
+        options = options or DEFAULT_OPTIONS
         self._stream = stream
-        self._packer = msgpack.Packer(encoding=encodings[0], default=lambda x: x.to_msgpack())
-        self._unpacker = msgpack.Unpacker(encoding=encodings[1])
+        self._encodings = encodings
+        self._options = options
+        self._packer = self.create_packer(encodings, options)
+        self._unpacker = self.create_unpacker(encodings, options)
+        self._stats = stats or WriteStats()
+        self._codec = None
+        self._compression_threshold = options['compression_threshold']
+        self._compression_stats = compression_stats or compression.CompressionStats()
+        self._zero_copy_threshold = options['zero_copy_threshold'] if isinstance(stream, DirectIOStream) else 0
+        self._bin_header = _raw_header if self._packer.pack(b'') == _RAW_EMPTY else _bin_header
+        self._frame_unpacker = None
+        self._read_paused = False
+        self._read_pending = False
+        self._processing = False
+        self._read_into = options['read_into']
+        self._read_buffer_size = options['read_buffer_size']
+        if options['nodelay']:
+            stream.set_nodelay(True)
+
+        self._coalesce = options['coalesce']
+        self._coalesce_bytes = options['coalesce_bytes']
+        self._coalesce_delay = options['coalesce_delay']
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._write_buffer_messages = 0
+        self._write_callbacks = []
+        self._flush_scheduled = False
+
+    def create_packer(self, encodings, options):
+        return msgpack.Packer(encoding=encodings[0], default=extension.default)
+
+    def create_unpacker(self, encodings, options):
+        return msgpack.Unpacker(encoding=encodings[1], max_buffer_size=options['max_buffer_size'],
+                                ext_hook=extension.ext_hook)
+
+    def pack(self, message):
+        return self._packer.pack(message)
+
+    def pack_segments(self, message):
+        """\
+        Packs *message* like pack(), except that a message whose arguments
+        or result include bytes-like values (or ext types, see
+        msgpackrpc.extension) of at least zero_copy_threshold bytes is
+        returned as a list of buffers: those values themselves, each after the
+        packed data in front of it, so that they are not copied.
+        """
+
+        threshold = self._zero_copy_threshold
+        if not threshold or self._codec is not None or not _has_large_buffer(message[-1], threshold):
+            return self.pack(message)
+
+        segments = []
+        pending = []
+        self._pack_segments(message, threshold, segments, pending)
+        if pending:
+            segments.append(b"".join(pending))
+        return segments
+
+    def _pack_segments(self, obj, threshold, segments, pending):
+        if isinstance(obj, _BUFFER_TYPES):
+            size = _nbytes(obj)
+            if size >= threshold and getattr(memoryview(obj), 'c_contiguous', True):
+                pending.append(self._bin_header(size))
+                segments.append(b"".join(pending))
+                segments.append(obj)
+                del pending[:]
+                return
+        elif isinstance(obj, (list, tuple)):
+            pending.append(self._packer.pack_array_header(len(obj)))
+            for item in obj:
+                self._pack_segments(item, threshold, segments, pending)
+            return
+        else:
+            ext = extension.lookup(obj.__class__)
+            if ext is not None and ext.size is not None:
+                data = extension.encode(ext, obj)
+                size = sum(_nbytes(part) for part in data)
+                if size >= threshold:
+                    pending.append(_ext_header(ext.code, size))
+                    for part in data:
+                        if _nbytes(part) >= threshold:
+                            segments.append(b"".join(pending))
+                            segments.append(part)
+                            del pending[:]
+                        else:
+                            pending.append(part)
+                    return
+        pending.append(self._packer.pack(obj))
 
     def close(self):
+        self.flush()
         self._stream.close()
 
     def send_message(self, message, callback=None):
-        self._stream.write(self._packer.pack(message), callback=callback)
+        self.send_packed(self.pack_segments(message), 1, callback)
+
+    def send_messages(self, messages, callback=None):
+        pack = self.pack_segments
+        packed = [pack(message) for message in messages]
+        if any(isinstance(data, list) for data in packed):
+            self.send_packed(_join_segments(packed), len(messages), callback)
+        else:
+            self.send_packed(b"".join(packed), len(messages), callback)
+
+    def send_packed(self, data, count=1, callback=None):
+        """\
+        Sends *count* already packed messages, as bytes or as a list of
+        buffers (see pack_segments).
+        """
+
+        if isinstance(data, list):
+            # Written as they are, after whatever was coalesced before.
+            self.flush()
+            self._write(data, count, callback)
+        elif self._coalesce:
+            self._buffer_write(data, count, callback)
+        else:
+            self._write(data, count, callback)
+
+    def flush(self):
+        """\
+        Writes the coalesced messages, if any, in a single IOStream.write.
+        """
+
+        self._flush_scheduled = False
+        if not self._write_buffer:
+            return
+
+        data = b"".join(self._write_buffer)
+        count = self._write_buffer_messages
+        callbacks = self._write_callbacks
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._write_buffer_messages = 0
+        self._write_callbacks = []
+
+        callback = None
+        if callbacks:
+            def callback():
+                for c in callbacks:
+                    c()
+        if not self._stream.closed():
+            self._write(data, count, callback)
+
+    def drain(self, callback):
+        """\
+        Calls *callback* once everything sent so far has been written.
+        """
+
+        self.flush()
+        io_loop = self._stream.io_loop
+        if self._stream.closed():
+            io_loop.add_callback(callback)
+        else:
+            self._stream.write(b'').add_done_callback(lambda future: io_loop.add_callback(callback))
+
+    def _write(self, data, count, callback):
+        if isinstance(data, list):
+            size = sum(_nbytes(segment) for segment in data)
+        else:
+            size = len(data)
+            if self._codec is not None and size >= self._compression_threshold:
+                compressed = compression.compress(self._codec, data, self._compression_stats)
+                if compressed is not None:
+                    data = self._packer.pack(msgpack.ExtType(compression.EXT_CODE, compressed))
+                    size = len(data)
+        self._stats.flushes += 1
+        self._stats.messages += count
+        self._stats.bytes += size
+        if callback is None:
+            self._stream.write(data)
+        else:
+            # IOStream keeps a single write callback, so concurrent writers
+            # (streams, notifies) wait on their own write future instead.
+            io_loop = self._stream.io_loop
+            self._stream.write(data).add_done_callback(lambda future: io_loop.add_callback(callback))
+
+    def _buffer_write(self, data, count, callback):
+        self._write_buffer.append(data)
+        self._write_buffer_size += len(data)
+        self._write_buffer_messages += count
+        if callback is not None:
+            self._write_callbacks.append(callback)
+
+        if self._write_buffer_size >= self._coalesce_bytes:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            io_loop = self._stream.io_loop
+            if self._coalesce_delay:
+                io_loop.add_timeout(io_loop.time() + self._coalesce_delay, self.flush)
+            else:
+                io_loop.add_callback(self.flush)
+
+    def start_reading(self):
+        if self._read_into:
+            self._stream.read_into_callback(self.on_read, self._read_buffer_size)
+        else:
+            self._read_next()
+
+    def _read_next(self):
+        # One read at a time, so that a paused socket stops taking data off
+        # the connection instead of only stopping to handle it.
+        if self._read_pending or self._read_paused:
+            return
+        self._read_pending = True
+        try:
+            # Data buffered before the peer closed is still handed over.
+            self._stream.read_bytes(self._read_buffer_size, self._on_chunk, partial=True)
+        except StreamClosedError:
+            self._read_pending = False
+
+    def _on_chunk(self, data):
+        self._read_pending = False
+        self.on_read(data)
+        self._read_next()
 
     def on_read(self, data):
         self._unpacker.feed(data)
-        for message in self._unpacker:
-            self.on_message(message)
+        self._process_messages()
+
+    def _process_messages(self):
+        # Not reentrant: a resume from within on_message lets this loop go on.
+        if self._processing or self._read_paused:
+            return
+        self._processing = True
+        try:
+            for message in self._unpacker:
+                self.on_message(message)
+                if self._read_paused:
+                    break
+        finally:
+            self._processing = False
+
+    def pause_reading(self):
+        """\
+        Stops handling messages and reading from the socket; the peer is held
+        back by the kernel's buffers. Up to read_buffer_size bytes already
+        read are kept.
+        """
+
+        if not self._read_paused:
+            self._read_paused = True
+            if self._read_into:
+                self._stream.pause_reading()
+
+    def resume_reading(self):
+        if self._read_paused:
+            self._read_paused = False
+            # Handle what the Unpacker already holds before reading more.
+            self._process_messages()
+            if not self._read_paused and not self._stream.closed():
+                if self._read_into:
+                    self._stream.resume_reading()
+                else:
+                    self._read_next()
 
     def on_message(self, message, *args):
         msgsize = len(message)
         if msgsize != 4 and msgsize != 3:
+            if isinstance(message, msgpack.ExtType) and message.code == compression.EXT_CODE:
+                self.on_compressed(message.data)
+                return
             raise RPCError("Invalid MessagePack-RPC protocol: message = {0}".format(message))
 
         msgtype = message[0]
@@ -35,9 +402,22 @@ class BaseSocket(object):
             self.on_response(message[1], message[2], message[3])
         elif msgtype == msgpackrpc.message.NOTIFY:
             self.on_notify(message[1], message[2])
+        elif msgtype == msgpackrpc.message.STREAM:
+            self.on_stream(message[1], message[2])
         else:
             raise RPCError("Unknown message type: type = {0}".format(msgtype))
 
+    def on_compressed(self, data):
+        if self._codec is None:
+            raise RPCError("Compressed message on a connection without compression")
+
+        if self._frame_unpacker is None:
+            self._frame_unpacker = self.create_unpacker(self._encodings, self._options)
+        self._frame_unpacker.feed(compression.decompress(self._codec, data, self._compression_stats,
+                                                         self._options['max_buffer_size']))
+        for message in self._frame_unpacker:
+            self.on_message(message)
+
     def on_request(self, msgid, method, param):
         raise NotImplementedError("on_request not implemented");
 
@@ -47,109 +427,685 @@ class BaseSocket(object):
     def on_notify(self, method, param):
         raise NotImplementedError("on_notify not implemented");
 
+    def on_stream(self, msgid, items):
+        raise NotImplementedError("on_stream not implemented");
+
 
 class ClientSocket(BaseSocket):
     def __init__(self, stream, transport, encodings):
-        BaseSocket.__init__(self, stream, encodings)
+        BaseSocket.__init__(self, stream, encodings, transport._options, transport.write_stats,
+                            transport.compression_stats)
         self._transport = transport
+        self._requests = {}
         self._stream.set_close_callback(self.on_close)
 
-    def connect(self):
-        self._stream.connect(self._transport._address.unpack(), self.on_connect)
+    @property
+    def outstanding(self):
+        return len(self._requests)
+
+    def track(self, messages):
+        """\
+        Remembers the requests among *messages* until they are answered, so
+        that they can be sent again if this connection is lost.
+        """
+
+        requests = self._requests
+        for message in messages:
+            if message[0] == msgpackrpc.message.REQUEST:
+                requests[message[1]] = message
 
     def on_connect(self):
-        self._stream.read_until_close(self.on_read, self.on_read)
+        self.start_reading()
+        if self._options['compression'] or self._options['streaming']:
+            self.send_handshake()
         self._transport.on_connect(self)
 
-    def on_connect_failed(self):
-        self._transport.on_connect_failed(self)
+    def send_handshake(self):
+        """\
+        Offers the configured codecs and asks for streamed results. Requests
+        are sent uncompressed until the server has agreed on a codec.
+        """
+
+        offer = {'compression': list(self._options['compression'] or ()),
+                 'streaming': bool(self._options['streaming'])}
+        self.send_message([msgpackrpc.message.REQUEST, msgpackrpc.message.HANDSHAKE_MSGID,
+                           msgpackrpc.message.HANDSHAKE_METHOD, [offer]])
+
+    def on_handshake(self, error, result):
+        # Servers without handshake support answer with an error.
+        if error is not None or not isinstance(result, dict):
+            return
+
+        accepted = _get_option(result, 'compression')
+        if accepted is not None:
+            self._codec = compression.get(force_str(accepted))
 
     def on_close(self):
         self._transport.on_close(self)
 
     def on_response(self, msgid, error, result):
+        if msgid == msgpackrpc.message.HANDSHAKE_MSGID:
+            self.on_handshake(error, result)
+            return
+        self._requests.pop(msgid, None)
         self._transport._session.on_response(msgid, error, result)
 
+    def on_stream(self, msgid, items):
+        future = self._transport._session.on_stream(msgid, items)
+        limit = self._options['max_stream_chunks']
+        if future is not None and limit and future._streaming and future.buffered >= limit:
+            # The caller is behind; read on once it consumed the chunks.
+            self.pause_reading()
+            future._pause(functools.partial(self._stream.io_loop.add_callback, self.resume_reading))
+
 
 class ClientTransport(object):
-    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None)):
+    """\
+    Keeps a pool of up to *pool_size* connections to the address. Requests are
+    striped over the connected sockets by least outstanding requests; every
+    socket has its own Unpacker and reports responses to the shared session.
+    """
+
+    socket_class = ClientSocket
+    default_options = DEFAULT_OPTIONS
+
+    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None), pool_size=1, options=None):
         self._session = session
         self._address = address
         self._encodings = encodings
+        self._options = transport_options(options, self.default_options)
         self._reconnect_limit = reconnect_limit;
+        self._pool_size = max(1, pool_size)
+        self.write_stats = WriteStats()
+        self.compression_stats = compression.CompressionStats()
 
         self._connecting = 0
+        self._failures = 0
         self._pending = []
+        self._max_pending = self._options['max_pending']
         self._sockets = []
+        self._connectors = set()
+        self._retries = set()
         self._closed  = False
 
     def send_message(self, message, callback=None):
-        if len(self._sockets) == 0:
-            if self._connecting == 0:
-                self.connect()
-                self._connecting = 1
+        sock = self._select_socket()
+        if sock is None:
+            if self._max_pending and len(self._pending) >= self._max_pending:
+                self._reject([message], callback)
+                return
             self._pending.append((message, callback))
         else:
-            sock = self._sockets[0]
+            if message[0] == msgpackrpc.message.REQUEST:
+                sock._requests[message[1]] = message
             sock.send_message(message, callback)
 
+    def send_messages(self, messages, callback=None):
+        sock = self._select_socket()
+        if sock is None:
+            if self._max_pending:
+                room = max(0, self._max_pending - len(self._pending))
+                if room < len(messages):
+                    rejected, messages = messages[room:], messages[:room]
+                    self._reject(rejected, None if messages else callback)
+                    if not messages:
+                        return
+            self._pending.extend((message, None) for message in messages[:-1])
+            self._pending.append((messages[-1], callback))
+        elif len(self._sockets) == 1:
+            sock.track(messages)
+            sock.send_messages(messages, callback)
+        else:
+            self._stripe_messages(messages, callback)
+
+    def can_hedge(self, msgid):
+        """\
+        True if another connection of the pool than the one of the request
+        *msgid* is open, so that a copy of it does not queue behind it.
+        """
+
+        return self._hedge_socket(msgid) is not None
+
+    def send_hedge(self, message, msgid):
+        """\
+        Sends *message*, a copy of the request *msgid*, over another connection
+        of the pool than the request. Check can_hedge() first.
+        """
+
+        sock = self._hedge_socket(msgid)
+        sock._requests[message[1]] = message
+        sock.send_message(message)
+
+    def _hedge_socket(self, msgid):
+        if not any(msgid in sock._requests for sock in self._sockets):
+            return None
+        sockets = [sock for sock in self._sockets if msgid not in sock._requests]
+        if not sockets:
+            return None
+        return min(sockets, key=_outstanding_of)
+
+    def _reject(self, messages, callback):
+        # The buffer is full; the requests fail and notifications are dropped.
+        requests = [message for message in messages if message[0] == msgpackrpc.message.REQUEST]
+        if requests:
+            self._session.on_send_failed(requests, TransportError("Too many messages waiting for a connection"))
+        if callback is not None:
+            callback()
+
+    def forget(self, msgid):
+        """\
+        Stops tracking a request which timed out.
+        """
+
+        for sock in self._sockets:
+            if sock._requests.pop(msgid, None) is not None:
+                return
+
+    def _select_socket(self):
+        # Refill the pool on demand, but stop topping up a partial pool after
+        # its connection attempts have given up.
+        if len(self._sockets) < self._pool_size and self._connecting == 0:
+            if len(self._sockets) == 0 or self._failures == 0:
+                self.connect()
+
+        sockets = self._sockets
+        if len(sockets) == 0:
+            return None
+        if len(sockets) == 1:
+            return sockets[0]
+        return min(sockets, key=_outstanding_of)
+
+    def _stripe_messages(self, messages, callback):
+        groups = {}
+        for message in messages:
+            sock = min(self._sockets, key=_outstanding_of)
+            if message[0] == msgpackrpc.message.REQUEST:
+                sock._requests[message[1]] = message
+            groups.setdefault(sock, []).append(message)
+
+        # Fire the callback once every per-socket write has been flushed.
+        remaining = [len(groups)]
+        def on_written():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback()
+
+        for sock, group in groups.items():
+            sock.send_messages(group, on_written if callback is not None else None)
+
+    def flush(self, callback):
+        """\
+        Calls *callback* once every message sent so far has been written.
+        """
+
+        if self._pending:
+            # They are written together once a connection is up.
+            message, previous = self._pending[-1]
+            self._pending[-1] = (message, _chain_callbacks(previous, callback))
+            return
+
+        sockets = list(self._sockets)
+        if not sockets:
+            callback()
+            return
+
+        remaining = [len(sockets)]
+        def on_drained():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback()
+        for sock in sockets:
+            sock.drain(on_drained)
+
     def connect(self):
-        stream = IOStream(self._address.socket(), io_loop=self._session._loop._ioloop)
-        socket = ClientSocket(stream, self, self._encodings)
-        socket.connect();
+        for _ in range(self._pool_size - len(self._sockets) - self._connecting):
+            self._open_socket()
+
+    def _open_socket(self):
+        connector = _Connector(self, self._session._loop._ioloop)
+        self._connectors.add(connector)
+        self._connecting += 1
+        connector.start()
+
+    def _on_connected(self, connector, stream):
+        self._connectors.discard(connector)
+        self.socket_class(stream, self, self._encodings).on_connect()
+
+    def _on_connect_failed(self, connector):
+        self._connectors.discard(connector)
+        # The server may have moved.
+        self._address.invalidate()
+        self.on_connect_failed()
 
     def close(self):
         for sock in self._sockets:
             sock.close()
+        for connector in list(self._connectors):
+            connector.cancel()
+        io_loop = self._session._loop._ioloop
+        for retry in self._retries:
+            io_loop.remove_timeout(retry)
 
+        self._connectors = set()
+        self._retries = set()
         self._connecting = 0
+        self._failures = 0
         self._pending = []
         self._sockets = []
         self._closed  = True
 
     def on_connect(self, sock):
+        self._connecting -= 1
+        self._failures = 0
         self._sockets.append(sock)
-        for pending, callback in self._pending:
-            sock.send_message(pending, callback)
-        self._pending = []
+        self._session.on_connect()
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
 
-    def on_connect_failed(self, sock):
-        if self._connecting < self._reconnect_limit:
-            self.connect()
-            self._connecting += 1
-        else:
-            self._connecting = 0
+        callbacks = [callback for _, callback in pending if callback is not None]
+        def callback():
+            for c in callbacks:
+                c()
+        messages = [message for message, _ in pending]
+        sock.track(messages)
+        sock.send_messages(messages, callback if callbacks else None)
+
+    def on_connect_failed(self):
+        self._failures += 1
+        if self._failures < self._reconnect_limit:
+            # Still counted as connecting while it waits.
+            io_loop = self._session._loop._ioloop
+            def reconnect():
+                self._retries.discard(retry)
+                self._connecting -= 1
+                self._open_socket()
+            retry = io_loop.add_timeout(io_loop.time() + self._backoff(), reconnect)
+            self._retries.add(retry)
+            return
+
+        self._connecting -= 1
+        if len(self._sockets) == 0 and self._connecting == 0:
+            self._failures = 0
             self._pending = []
             self._session.on_connect_failed(TransportError("Retry connection over the limit"))
 
-    def on_close(self, sock):
-        # Avoid calling self.on_connect_failed after self.close called.
-        if self._closed:
-            return
+    def _backoff(self):
+        delay = min(self._options['reconnect_delay_max'],
+                    self._options['reconnect_delay'] * 2 ** (self._failures - 1))
+        return random.uniform(delay / 2, delay)
 
+    def on_close(self, sock):
         if sock in self._sockets:
             self._sockets.remove(sock)
+            if sock._requests:
+                requests, sock._requests = sock._requests, {}
+                self._session.on_connection_lost(list(requests.values()))
+
+
+class _Connector(object):
+    """\
+    Connects to the first of the resolved addresses of the transport's
+    address that answers. They are tried in getaddrinfo's order, taking turns
+    between address families; an attempt which is still pending after
+    connect_delay seconds does not hold back the next one, and one which
+    fails starts the next right away (happy eyeballs, RFC 8305).
+    """
+
+    def __init__(self, transport, io_loop):
+        self._transport = transport
+        self._io_loop = io_loop
+        self._delay = transport._options['connect_delay']
+        self._stream_class = DirectIOStream if _direct_io(transport._options) else IOStream
+        self._addresses = deque()
+        self._streams = []
+        self._timeout = None
+        self._done = False
+
+    def start(self):
+        try:
+            self._addresses.extend(_interleave(self._transport._address.resolve()))
+        except socket.error:
+            pass
+        if self._addresses:
+            self._try_next()
+        else:
+            self._io_loop.add_callback(self._try_next)
+
+    def cancel(self):
+        self._finish()
+
+    def _try_next(self):
+        self._clear_timeout()
+        if self._done:
+            return
+
+        while self._addresses:
+            addrinfo = self._addresses.popleft()
+            try:
+                stream = self._stream_class(self._transport._address.socket(addrinfo), io_loop=self._io_loop)
+            except socket.error:
+                # e.g. IPv6 is not supported here
+                continue
+            self._streams.append(stream)
+            stream.set_close_callback(functools.partial(self._on_close, stream))
+            stream.connect(addrinfo[3], functools.partial(self._on_connect, stream))
+            if self._addresses:
+                self._timeout = self._io_loop.add_timeout(self._io_loop.time() + self._delay, self._try_next)
+            return
+
+        if not self._streams:
+            self._finish()
+            self._transport._on_connect_failed(self)
+
+    def _on_connect(self, stream):
+        if self._done:
+            stream.close()
+            return
+        self._streams.remove(stream)
+        stream.set_close_callback(None)
+        self._finish()
+        self._transport._on_connected(self, stream)
+
+    def _on_close(self, stream):
+        if self._done:
+            return
+        self._streams.remove(stream)
+        self._try_next()
+
+    def _finish(self):
+        self._done = True
+        self._clear_timeout()
+        streams, self._streams = self._streams, []
+        for stream in streams:
+            stream.set_close_callback(None)
+            stream.close()
+
+    def _clear_timeout(self):
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+
+def _interleave(addresses):
+    # The family of the first address first, then taking turns.
+    groups = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            by_family[address[0]] = []
+            groups.append(by_family[address[0]])
+        by_family[address[0]].append(address)
+
+    ordered = []
+    for index in range(max(len(group) for group in groups) if groups else 0):
+        for group in groups:
+            if index < len(group):
+                ordered.append(group[index])
+    return ordered
+
+
+_BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+# What a Packer without use_bin_type makes of b''.
+_RAW_EMPTY = b'\xa0'
+
+
+def _has_large_buffer(value, threshold):
+    # Arguments are a list, a result may be anything.
+    if isinstance(value, (list, tuple)):
+        return any(_is_large(item, threshold) for item in value)
+    return _is_large(value, threshold)
+
+
+def _is_large(value, threshold):
+    if isinstance(value, _BUFFER_TYPES):
+        return _nbytes(value) >= threshold
+    ext = extension.lookup(value.__class__)
+    return ext is not None and ext.size is not None and ext.size(value) >= threshold
+
+
+def _nbytes(buf):
+    if isinstance(buf, (bytes, bytearray)):
+        return len(buf)
+    view = memoryview(buf)
+    # memoryview has no nbytes in Python 2.
+    return getattr(view, 'nbytes', len(view) * view.itemsize)
+
+
+def _raw_header(size):
+    # Bytes are packed as raw (str) without use_bin_type.
+    if size <= 0x1f:
+        return struct.pack('>B', 0xa0 | size)
+    if size <= 0xffff:
+        return struct.pack('>BH', 0xda, size)
+    if size <= 0xffffffff:
+        return struct.pack('>BI', 0xdb, size)
+    raise ValueError("Bytes value is too large")
+
+
+def _bin_header(size):
+    if size <= 0xff:
+        return struct.pack('>BB', 0xc4, size)
+    if size <= 0xffff:
+        return struct.pack('>BH', 0xc5, size)
+    if size <= 0xffffffff:
+        return struct.pack('>BI', 0xc6, size)
+    raise ValueError("Bytes value is too large")
+
+
+def _ext_header(code, size):
+    fixed = _FIXEXT.get(size)
+    if fixed is not None:
+        return struct.pack('>Bb', fixed, code)
+    if size <= 0xff:
+        return struct.pack('>BBb', 0xc7, size, code)
+    if size <= 0xffff:
+        return struct.pack('>BHb', 0xc8, size, code)
+    if size <= 0xffffffff:
+        return struct.pack('>BIb', 0xc9, size, code)
+    raise ValueError("Ext type data is too large")
+
+
+_FIXEXT = {1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8}
+
+
+def _join_segments(packed):
+    # Flattens packed messages (bytes or lists of buffers) into one list.
+    segments = []
+    for data in packed:
+        if isinstance(data, list):
+            segments.extend(data)
         else:
-            # Tornado does not have on_connect_failed event.
-            self.on_connect_failed(sock)
+            segments.append(data)
+    return segments
+
+
+def _chain_callbacks(first, second):
+    if first is None:
+        return second
+
+    def callback():
+        first()
+        second()
+    return callback
+
+
+def _get_option(options, name):
+    # Keys are bytes when the peer unpacks without an encoding.
+    value = options.get(name)
+    if value is None:
+        value = options.get(name.encode('utf-8'))
+    return value
+
+
+def _direct_io(options):
+    # Both options need a DirectIOStream.
+    return options['read_into'] or bool(options['zero_copy_threshold'])
+
+
+def _outstanding_of(sock):
+    return len(sock._requests)
 
 
 class ServerSocket(BaseSocket):
     def __init__(self, stream, transport, encodings):
-        BaseSocket.__init__(self, stream, encodings)
+        BaseSocket.__init__(self, stream, encodings, transport._options, transport.write_stats,
+                            transport.compression_stats)
         self._transport = transport
-        self._stream.read_until_close(self.on_read, self.on_read)
+        self._streaming = False
+        self._inflight = 0
+        self._max_inflight = self._options['max_inflight']
+        self._max_pending_writes = self._options['max_pending_writes']
+        self._draining = False
+        self._stream.set_close_callback(self.on_close)
+        self.start_reading()
+
+    def send_response(self, msgid, error, result):
+        self._send_response(self.pack_segments([msgpackrpc.message.RESPONSE, msgid, error, result]))
+
+    def send_packed_response(self, msgid, body):
+        """\
+        Sends a successful response whose result is already packed.
+        """
+
+        pack = self._packer.pack
+        self._send_response(b"".join([_RESPONSE_HEADER, pack(msgid), _NIL, body]))
+
+    def _send_response(self, data):
+        try:
+            self.send_packed(data)
+        finally:
+            if self._inflight > 0:
+                self._inflight -= 1
+                self._transport._server._request_finished()
+                self._update_reading()
+
+    def _update_reading(self):
+        if self._stream.closed():
+            return
+        if ((self._max_inflight and self._inflight >= self._max_inflight) or
+                (self._max_pending_writes and self._writes_blocked()) or
+                self._transport._server._is_saturated(self)):
+            self.pause_reading()
+        else:
+            self.resume_reading()
+
+    def _writes_blocked(self):
+        # IOStream's write buffer is not public in Tornado < 5.
+        pending = self._stream._write_buffer_size + self._write_buffer_size
+        if pending < self._max_pending_writes:
+            return False
+
+        if not self._draining:
+            self._draining = True
+            io_loop = self._stream.io_loop
+            self._stream.write(b'').add_done_callback(lambda future: io_loop.add_callback(self._on_drained))
+        return True
+
+    def _on_drained(self):
+        self._draining = False
+        self._update_reading()
+
+    def send_stream(self, msgid, iterator):
+        """\
+        Sends the items of *iterator* as chunks followed by an empty response,
+        if the client asked for streamed results. Returns False otherwise.
+        """
+
+        if not self._streaming:
+            return False
+        _Stream(self, msgid, iterator, self._options['stream_chunk_size']).send_next()
+        return True
+
+    def on_handshake(self, msgid, param):
+        offer = param[0] if param and isinstance(param[0], dict) else {}
+
+        accepted = self._options['compression']
+        if accepted is None:
+            accepted = compression.names()
+        codec = None
+        for name in _get_option(offer, 'compression') or ():
+            name = force_str(name)
+            if name in accepted and compression.get(name) is not None:
+                codec = compression.get(name)
+                break
+
+        self._streaming = bool(_get_option(offer, 'streaming'))
+        self.send_message([msgpackrpc.message.RESPONSE, msgid, None,
+                           {'compression': codec.name if codec is not None else None,
+                            'streaming': self._streaming}])
+        # The answer itself must go out uncompressed.
+        self.flush()
+        self._codec = codec
 
     def on_close(self):
-        self._transport.on_close(self)
+        # Responses still to come for this connection are dropped; release
+        # their share of the server wide limit now.
+        server = self._transport._server
+        for _ in range(self._inflight):
+            server._request_finished()
+        self._inflight = 0
 
     def on_request(self, msgid, method, param):
-        self._transport._server.on_request(self, msgid, method, param)
+        if msgid == msgpackrpc.message.HANDSHAKE_MSGID and force_str(method) == msgpackrpc.message.HANDSHAKE_METHOD:
+            self.on_handshake(msgid, param)
+            return
+
+        server = self._transport._server
+        self._inflight += 1
+        server._request_started()
+        self._update_reading()
+        server.on_request(self, msgid, method, param)
 
     def on_notify(self, method, param):
         self._transport._server.on_notify(method, param)
 
 
+# fixarray of 4 and RESPONSE, and nil
+_RESPONSE_HEADER = b'\x94' + msgpack.packb(msgpackrpc.message.RESPONSE)
+_NIL = msgpack.packb(None)
+
+
+class _Stream(object):
+    """\
+    Sends an iterator result chunk by chunk. The next chunk is only taken from
+    the iterator once the previous one has been written to the socket, so a
+    slow client holds back the handler instead of filling the write buffer.
+    """
+
+    def __init__(self, sock, msgid, iterator, chunk_size):
+        self._sock = sock
+        self._msgid = msgid
+        self._iterator = iterator
+        self._chunk_size = max(1, chunk_size)
+
+    def send_next(self):
+        sock = self._sock
+        if sock._stream.closed():
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+            return
+
+        chunk = []
+        try:
+            for item in self._iterator:
+                chunk.append(item)
+                if len(chunk) >= self._chunk_size:
+                    break
+        except Exception as e:
+            sock.send_response(self._msgid, str(e), None)
+            return
+
+        if len(chunk) >= self._chunk_size:
+            sock.send_message([msgpackrpc.message.STREAM, self._msgid, chunk], callback=self.send_next)
+            return
+        if chunk:
+            sock.send_message([msgpackrpc.message.STREAM, self._msgid, chunk])
+        sock.send_response(self._msgid, None, None)
+
+
 class MessagePackServer(tcpserver.TCPServer):
     def __init__(self, transport, io_loop=None, encodings=None):
         self._transport = transport
@@ -157,18 +1113,57 @@ class MessagePackServer(tcpserver.TCPServer):
         tcpserver.TCPServer.__init__(self, io_loop=io_loop)
 
     def handle_stream(self, stream, address):
-        ServerSocket(stream, self._transport, self._encodings)
+        if _direct_io(self._transport._options):
+            # The accepted stream has not been used yet; take over its socket.
+            stream = DirectIOStream(stream.socket, io_loop=stream.io_loop)
+        self._transport.socket_class(stream, self._transport, self._encodings)
 
 
 class ServerTransport(object):
-    def __init__(self, address, encodings=('utf-8', None)):
+    socket_class = ServerSocket
+    default_options = DEFAULT_OPTIONS
+
+    def __init__(self, address, encodings=('utf-8', None), options=None):
         self._address = address;
         self._encodings = encodings
+        self._options = transport_options(options, self.default_options)
+        self.write_stats = WriteStats()
+        self.compression_stats = compression.CompressionStats()
 
     def listen(self, server):
         self._server = server;
-        self._mp_server = MessagePackServer(self, io_loop=self._server._loop._ioloop, encodings=self._encodings)
-        self._mp_server.listen(self._address.port)
+        self._sockets = self.bind()
+        self.attach(server._loop)
+
+    def bind(self):
+        """\
+        Creates the listening sockets.
+        """
+
+        return bind_sockets(self._address.port)
+
+    def attach(self, loop):
+        """\
+        Starts accepting connections on the listening sockets in the loop.
+        """
+
+        self._mp_server = MessagePackServer(self, io_loop=loop._ioloop, encodings=self._encodings)
+        self._mp_server.add_sockets(self._sockets)
+
+    def detach(self):
+        """\
+        Stops accepting connections in the current loop but keeps the listening
+        sockets open, so that forked workers can attach them to their own loop.
+        """
+
+        io_loop = self._mp_server.io_loop
+        for sock in self._sockets:
+            io_loop.remove_handler(sock.fileno())
+        self._mp_server = None
 
     def close(self):
-        self._mp_server.stop()
+        if self._mp_server is not None:
+            self._mp_server.stop()
+        else:
+            for sock in self._sockets:
+                sock.close()
@@ -0,0 +1,34 @@
+"""\
+UNIX domain socket transport.
+
+Works like the tcp builder, but takes a msgpackrpc.UnixAddress. The server
+removes a stale socket file before binding and unlinks its socket file
+when closed.
+"""
+
+import os
+
+from tornado.netutil import bind_unix_socket
+
+from msgpackrpc.transport import tcp
+from msgpackrpc.transport.tcp import DEFAULT_OPTIONS, ClientTransport
+
+
+class ServerTransport(tcp.ServerTransport):
+    def __init__(self, address, encodings=('utf-8', None), options=None):
+        tcp.ServerTransport.__init__(self, address, encodings, options)
+        self._owner = None
+
+    def bind(self):
+        # Forked workers share the socket; only the binding process unlinks it.
+        self._owner = os.getpid()
+        return [bind_unix_socket(self._address.path, mode=self._address.mode)]
+
+    def close(self):
+        tcp.ServerTransport.close(self)
+        if self._owner == os.getpid():
+            self._owner = None
+            try:
+                os.unlink(self._address.path)
+            except OSError:
+                pass
@@ -22,6 +22,8 @@ MessagePack RPC for Python.
 This implementation uses Tornado framework as a backend.
 """,
       packages=['msgpackrpc', 'msgpackrpc/transport'],
+      # The read_into and zero_copy_threshold transport options (DirectIOStream)
+      # rely on IOStream internals of Tornado < 5 and need Python 3.3 or later.
       install_requires=['msgpack-python', 'tornado >= 3,<5'],
       license="Apache Software License",
       classifiers=[
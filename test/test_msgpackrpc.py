@@ -1,17 +1,37 @@
-from time import sleep
+from time import sleep, time
+import array
+import os
+import socket
+import shutil
+import tempfile
 import threading
+import warnings
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import helper
+import msgpack
 import msgpackrpc
+import msgpackrpc.cache
+import msgpackrpc.compression
+import msgpackrpc.hedge
+import msgpackrpc.metrics
 from msgpackrpc import error
+from msgpackrpc.compat import monotonic
+from msgpackrpc.transport import shm, tcp, unix
+from msgpackrpc.transport.stream import DIRECT_IO_SUPPORTED
 
 
 class TestMessagePackRPC(unittest.TestCase):
     ENABLE_TIMEOUT_TEST = False
+    BUILDER = tcp
 
     class TestArg:
         ''' this class must know completely how to deserialize '''
@@ -46,6 +66,12 @@ class TestMessagePackRPC(unittest.TestCase):
         def nil(self):
             return None
 
+        def echo(self, data):
+            return data
+
+        def describe(self, value):
+            return type(value).__name__
+
         def add_arg(self, arg0, arg1):
             lhs = TestMessagePackRPC.TestArg.from_msgpack(arg0)
             rhs = TestMessagePackRPC.TestArg.from_msgpack(arg1)
@@ -58,37 +84,152 @@ class TestMessagePackRPC(unittest.TestCase):
             sleep(3)
             return 'finish!'
 
+        def sleep(self, sec):
+            sleep(sec)
+            return sec
+
+        def pid(self):
+            return os.getpid()
+
+        def _private(self):
+            return "secret"
+
+        def crash(self):
+            os._exit(1)
+
+        @msgpackrpc.server.run_in_thread
+        def blocking_sleep(self, sec):
+            sleep(sec)
+            return sec
+
+        @msgpackrpc.server.run_in_process
+        def pool_pid(self):
+            return os.getpid()
+
+        stalled = set()
+
+        @msgpackrpc.server.run_in_thread
+        def stall_once(self, key, sec):
+            # Only the first call of *key* is slow.
+            stalled = TestMessagePackRPC.TestServer.stalled
+            if key not in stalled:
+                stalled.add(key)
+                sleep(sec)
+            return key
+
+        produced = 0
+
+        def count(self, n, fail_at=None):
+            for x in range(n):
+                if x == fail_at:
+                    raise Exception('failed at {0}'.format(x))
+                yield x
+
+        def blobs(self, n, size):
+            TestMessagePackRPC.TestServer.produced = 0
+            for x in range(n):
+                TestMessagePackRPC.TestServer.produced += 1
+                yield b'x' * size
+
+        def get_produced(self):
+            return TestMessagePackRPC.TestServer.produced
+
+        notified = []
+
+        def record(self, value):
+            TestMessagePackRPC.TestServer.notified.append(value)
+
+        def pop_notified(self):
+            notified = TestMessagePackRPC.TestServer.notified
+            TestMessagePackRPC.TestServer.notified = []
+            return notified
+
+        computed = 0
+
+        @msgpackrpc.server.cacheable
+        def expensive(self, x, y=0):
+            TestMessagePackRPC.TestServer.computed += 1
+            return {'sum': x + y, 'blob': b'x' * x}
+
+        @msgpackrpc.server.cacheable(ttl=0.2)
+        @msgpackrpc.server.run_in_thread
+        def expensive_in_thread(self, x):
+            TestMessagePackRPC.TestServer.computed += 1
+            return x
+
+        def get_computed(self):
+            return TestMessagePackRPC.TestServer.computed
+
         def async_result(self):
             ar = msgpackrpc.server.AsyncResult()
+            loop = msgpackrpc.Loop.instance()
             def do_async():
                 sleep(2)
-                ar.set_result("You are async!")
+                # The response is written on the server's loop thread.
+                loop.add_callback(ar.set_result, "You are async!")
             threading.Thread(target=do_async).start()
             return ar
 
+    class TestResolver(msgpackrpc.address.Resolver):
+        ''' resolves the hosts in addresses to their fixed tuples '''
+        def __init__(self, addresses, delay=0, **options):
+            msgpackrpc.address.Resolver.__init__(self, **options)
+            self.addresses = addresses
+            self.delay = delay
+
+        def lookup(self, host, port, family=socket.AF_UNSPEC):
+            sleep(self.delay)
+            return self.addresses[host]
+
     def setUp(self):
-        self._address = msgpackrpc.Address('localhost', helper.unused_port())
+        self._address = self.unused_address()
+
+    def unused_address(self):
+        return msgpackrpc.Address('localhost', helper.unused_port())
+
+    def client_options(self):
+        return {}
 
-    def setup_env(self):
+    def new_client(self, address=None, **options):
+        for name, value in self.client_options().items():
+            options.setdefault(name, value)
+        return msgpackrpc.Client(address or self._address, builder=self.BUILDER, **options)
+
+    def new_server(self, dispatcher=None, **options):
+        return msgpackrpc.Server(dispatcher or TestMessagePackRPC.TestServer(), builder=self.BUILDER, **options)
+
+    def setup_env(self, **server_options):
+        self._server, self._thread = self.start_server(self._address, **server_options)
+        self._client = self.new_client(unpack_encoding='utf-8')
+        return self._client;
+
+    def start_server(self, address, **server_options):
         def _on_started():
-            self._server._loop.dettach_periodic_callback()
+            server._loop.dettach_periodic_callback()
             lock.release()
         def _start_server(server):
             server._loop.attach_periodic_callback(_on_started, 1)
             server.start()
             server.close()
 
-        self._server = msgpackrpc.Server(TestMessagePackRPC.TestServer())
-        self._server.listen(self._address)
-        self._thread = threading.Thread(target=_start_server, args=(self._server,))
+        server = self.new_server(**server_options)
+        server.listen(address)
+        thread = threading.Thread(target=_start_server, args=(server,))
 
         lock = threading.Lock()
-        self._thread.start()
-        lock.acquire()
+        lock.acquire()   # before the server can release it
+        thread.start()
         lock.acquire()   # wait for the server to start
+        return server, thread
 
-        self._client = msgpackrpc.Client(self._address, unpack_encoding='utf-8')
-        return self._client;
+    def wait_for(self, condition, timeout=2):
+        # for state the server thread updates after answering
+        deadline = time() + timeout
+        while not condition():
+            if time() > deadline:
+                return False
+            sleep(0.01)
+        return True
 
     def tearDown(self):
         self._client.close();
@@ -135,6 +276,172 @@ class TestMessagePackRPC(unittest.TestCase):
         self.assertEqual(future2.result, 3, "'sum' result is incorrect in call_async")
         self.assertIsNone(future3.result, "'nil' result is incorrect in call_async")
 
+    def test_call_many(self):
+        client = self.setup_env();
+
+        results = client.call_many([('hello', []), ('sum', [1, 2]), ('nil', [])])
+        self.assertEqual(results, ["world", 3, None], "'call_many' results are incorrect")
+
+        futures = client.call_many_async([('sum', [x, x]) for x in range(100)])
+        client.wait_all(futures)
+        self.assertEqual([f.result for f in futures], [x * 2 for x in range(100)])
+
+    def test_as_completed(self):
+        client = self.setup_env();
+
+        futures = client.call_many_async([('sum', [x, 1]) for x in range(10)])
+        completed = list(client.as_completed(futures))
+        self.assertEqual(len(completed), 10)
+        self.assertEqual(sorted(f.result for f in completed), list(range(1, 11)))
+
+        futures = client.call_many_async([('raise_error', [])])
+        for future in client.as_completed(futures):
+            self.assertRaises(error.RPCError, future.get)
+
+    def test_nested_waits(self):
+        client = self.setup_env();
+
+        futures = [client.call_async('sleep', sec) for sec in (0.05, 0.1, 0.15)]
+        completed = client.as_completed(futures)
+        self.assertIs(next(completed), futures[0])
+        # An inner wait leaves the outer iteration's waiters in place.
+        client.wait_all(futures[1:2])
+        self.assertEqual(futures[1].get(), 0.1)
+        self.assertEqual(list(completed), futures[1:])
+        self.assertEqual([future._waiter for future in futures], [None] * 3)
+
+    def test_connection_pool(self):
+        self.setup_env();
+
+        client = self.new_client(unpack_encoding='utf-8', pool_size=3)
+        try:
+            self.assertEqual(client.call('hello'), "world")
+            while len(client._transport._sockets) < 3:
+                client.call('hello')
+
+            futures = client.call_many_async([('sum', [x, 1]) for x in range(90)])
+            outstanding = [sock.outstanding for sock in client._transport._sockets]
+            self.assertEqual(sum(outstanding), 90)
+            self.assertEqual(outstanding, [30, 30, 30])
+
+            client.wait_all(futures)
+            self.assertEqual([f.result for f in futures], [x + 1 for x in range(90)])
+            self.assertEqual([sock.outstanding for sock in client._transport._sockets], [0, 0, 0])
+        finally:
+            client.close()
+
+    def test_write_coalescing(self):
+        self.setup_env(coalesce=True);
+
+        client = self.new_client(unpack_encoding='utf-8', coalesce=True)
+        try:
+            futures = [client.call_async('sum', x, 1) for x in range(50)]
+            client.wait_all(futures)
+            self.assertEqual([f.result for f in futures], [x + 1 for x in range(50)])
+            self.assertEqual(client.write_stats.messages, 50)
+            self.assertEqual(client.write_stats.flushes, 1)
+
+            stats = self._server.write_stats
+            self.assertEqual(stats.messages, 50)
+            self.assertLess(stats.flushes, 50)
+        finally:
+            client.close()
+
+        self.assertRaises(TypeError, lambda: self.new_client(coalesec=True))
+
+    def test_large_payload(self):
+        self.setup_env(read_buffer_size=4096);
+
+        payload = os.urandom(3 * 1024 * 1024)
+        for read_into in (True, False) if DIRECT_IO_SUPPORTED else (False,):
+            client = self.new_client(read_into=read_into, read_buffer_size=1000)
+            try:
+                self.assertEqual(client.call('echo', payload), payload)
+                self.assertEqual(client.call('sum', 1, 2), 3)
+            finally:
+                client.close()
+
+    @unittest.skipUnless(DIRECT_IO_SUPPORTED, "needs Python 3.3")
+    def test_zero_copy(self):
+        self.setup_env(zero_copy_threshold=1024);
+
+        payload = os.urandom(64 * 1024)
+        numbers = array.array('d', range(1000))
+        client = self.new_client(zero_copy_threshold=1024, coalesce=True)
+        try:
+            self.assertEqual(client.call('echo', bytearray(payload)), payload)
+            self.assertEqual(client.call('echo', memoryview(numbers)), numbers.tobytes())
+            self.assertEqual(client.call('sum', payload, b'x'), payload + b'x')
+            self.assertEqual(client.call_many([('echo', [payload]), ('sum', [1, 2])] * 2), [payload, 3] * 2)
+            self.assertEqual(client.call('sum', 1, 2), 3)
+
+            message = [0, 1, 'echo', [payload, 'small']]
+            sock = client._transport._sockets[0]
+            segments = sock.pack_segments(message)
+            if self.BUILDER is not shm:
+                self.assertIs(segments[1], payload)
+                self.assertEqual(len(segments), 3)
+            self.assertEqual(b"".join(segments) if isinstance(segments, list) else segments,
+                             msgpack.packb(message))
+        finally:
+            client.close()
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_ndarray(self):
+        client = self.setup_env(zero_copy_threshold=1024);
+
+        arrays = [numpy.arange(12, dtype='<f8').reshape(3, 4),
+                  numpy.asfortranarray(numpy.arange(6, dtype='>i4').reshape(2, 3)),
+                  numpy.arange(10, dtype=numpy.uint16)[::3],
+                  numpy.array(7, dtype=numpy.int8),
+                  numpy.zeros((0, 5), dtype=numpy.float32),
+                  numpy.random.random((300, 300))]
+        for array in arrays:
+            result = client.call('echo', array)
+            self.assertEqual((result.dtype, result.shape), (array.dtype, array.shape))
+            self.assertTrue(numpy.array_equal(result, array))
+        self.assertEqual(client.call('describe', arrays[0]), 'ndarray')
+
+        result = client.call_many([('echo', [arrays[-1]]), ('echo', [[1, arrays[0]]])])
+        self.assertTrue(numpy.array_equal(result[0], arrays[-1]))
+        self.assertFalse(result[0].flags.writeable)
+        self.assertTrue(numpy.array_equal(result[1][1], arrays[0]))
+
+        self.assertRaises(TypeError, lambda: client.call('echo', numpy.array([object()])))
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+    def test_workers(self):
+        if not hasattr(os, 'fork'):
+            return
+
+        self._server = self.new_server()
+        self._server.listen(self._address)
+        self._thread = threading.Thread(target=self._server.start, kwargs={'workers': 2})
+        self._thread.start()
+
+        self._client = self.new_client(unpack_encoding='utf-8')
+        pid = self._client.call('pid')
+        self.assertNotEqual(pid, os.getpid())
+
+        # A crashed worker is replaced and the server keeps answering.
+        self._client.notify('crash')
+        self._client.close()
+        while pid in self._server._supervisor.pids:
+            sleep(0.01)
+        for _ in range(50):
+            client = self.new_client(unpack_encoding='utf-8')
+            try:
+                self.assertNotEqual(client.call('pid', timeout=1), pid)
+            finally:
+                client.close()
+        self.assertEqual(len(self._server._supervisor.pids), 2)
+        self.assertNotIn(pid, self._server._supervisor.pids)
+
+        self._client = self.new_client(unpack_encoding='utf-8')
+        self._server.close()
+        self._thread.join(10)
+        self.assertFalse(self._thread.is_alive())
+
     def test_notify(self):
         client = self.setup_env();
 
@@ -148,6 +455,146 @@ class TestMessagePackRPC(unittest.TestCase):
 
         self.assertTrue(result)
 
+    def test_notify_async(self):
+        client = self.setup_env();
+        client.pop_notified = lambda: client.call('pop_notified')
+
+        # Queued before the connection is up.
+        client.notify_async('record', -1)
+        client.flush()
+        self.assertEqual(client.pop_notified(), [-1])
+
+        for x in range(100):
+            client.notify_async('record', x)
+        client.notify_many([('record', [x]) for x in range(100, 200)])
+        client.notify_many([])
+        client.flush()
+        self.assertEqual(client.pop_notified(), list(range(200)))
+
+        client = self.new_client(coalesce=True)
+        for x in range(10):
+            client.notify_async('record', x)
+        self.assertEqual(client.write_stats.flushes, 0)
+        client.flush()
+        self.assertEqual(client.write_stats.flushes, 1)
+        self.assertEqual(client.call('pop_notified'), list(range(10)))
+        client.close()
+
+    def test_threaded_client(self):
+        self.setup_env();
+        client = msgpackrpc.ThreadedClient(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                           streaming=True, **self.client_options())
+
+        errors = []
+        def worker(n):
+            try:
+                for x in range(50):
+                    self.assertEqual(client.call('sum', n, x), n + x)
+                futures = [client.call_async('sum', n, x) for x in range(50)]
+                self.assertEqual([f.get() for f in futures], [n + x for x in range(50)])
+                self.assertEqual(client.call_many([('sum', [n, x]) for x in range(10)]), [n + x for x in range(10)])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        futures = [client.call_async('blocking_sleep', sec) for sec in (0.2, 0.1, 0.0)]
+        self.assertEqual([f.get() for f in client.as_completed(futures)], [0.0, 0.1, 0.2])
+        self.assertRaises(error.TimeoutError, lambda: client.call('sleep', 0.3, timeout=0.05))
+        self.assertEqual(list(client.call_stream('count', 250)), list(range(250)))
+
+        client.notify_many([('record', [x]) for x in range(3)])
+        client.notify('record', 3)
+        self.assertEqual(client.call('pop_notified'), [0, 1, 2, 3])
+
+        client.close()
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+        self.assertRaises(error.TransportError, lambda: client.call_many([('hello', [])]))
+        self.assertRaises(error.TransportError, lambda: client.notify_async('record', 4))
+        self.assertRaises(error.TransportError, lambda: client.notify_many([('record', [4])]))
+        client.flush()
+        client.close()
+
+        # A failed connection fails the requests, not the client.
+        client = msgpackrpc.ThreadedClient(self.unused_address(), builder=self.BUILDER, **self.client_options())
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+        client.flush()
+        client.close()
+
+    def test_result_cache(self):
+        self.setup_env(thread_pool_size=4);
+        cache = msgpackrpc.cache.ResultCache(['blocking_sleep', 'pid', 'raise_error'], max_entries=2, ttl=0.3)
+        client = self.new_client(unpack_encoding='utf-8', metrics=True, cache=cache)
+
+        # Identical calls in flight share one request and one future.
+        futures = [client.call_async('blocking_sleep', 0.1) for x in range(3)]
+        self.assertIs(futures[0], futures[2])
+        self.assertNotEqual(futures[0], client.call_async('blocking_sleep', 0.05))
+        client.wait_all(futures)
+        self.assertEqual(client.call('blocking_sleep', 0.1), 0.1)
+        self.assertEqual(client.metrics.method('blocking_sleep').requests, 2)
+        self.assertEqual((cache.stats.misses, cache.stats.coalesced, cache.stats.hits), (2, 2, 1))
+
+        # LRU eviction and expiry
+        pid = client.call('pid')
+        self.assertEqual(client.call('pid'), pid)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats.evictions, 1)
+        sleep(0.35)
+        client.call('pid')
+        self.assertEqual(cache.stats.expirations, 1)
+        self.assertEqual(client.metrics.method('pid').requests, 2)
+
+        # Errors and uncached methods always go over the wire.
+        for x in range(2):
+            self.assertRaises(error.RPCError, lambda: client.call('raise_error'))
+            client.call('hello')
+        self.assertEqual(client.metrics.method('raise_error').requests, 2)
+        self.assertEqual(client.metrics.method('hello').requests, 2)
+
+        cache.invalidate('pid')
+        client.call('pid')
+        self.assertEqual(client.metrics.method('pid').requests, 3)
+        client.close()
+
+    def test_response_cache(self):
+        client = self.setup_env(response_cache_bytes=10000, metrics=True);
+        TestMessagePackRPC.TestServer.computed = 0
+
+        first = client.call('expensive', 10)
+        self.assertEqual(first, {'sum': 10, 'blob': 'x' * 10})
+        self.assertEqual(client.call('expensive', 10), first)
+        self.assertEqual(client.call('expensive', 10, 1)['sum'], 11)
+        self.assertEqual(client.call('get_computed'), 2)
+        self.assertEqual(self._server.metrics.method('expensive').requests, 3)
+
+        # Responses are bounded by size, with LRU eviction.
+        client.call('expensive', 9950)
+        client.call('expensive', 9950)
+        self.assertEqual(client.call('get_computed'), 3)
+        client.call('expensive', 10)
+        self.assertEqual(client.call('get_computed'), 4)
+        self.assertLessEqual(self._server.response_cache.bytes, 10000)
+
+        self._server.invalidate('expensive', [10])
+        client.call('expensive', 10)
+        self.assertEqual(client.call('get_computed'), 5)
+
+        self.assertEqual(client.call('expensive_in_thread', 1), 1)
+        self.assertEqual(client.call('expensive_in_thread', 1), 1)
+        self.assertEqual(client.call('get_computed'), 6)
+        sleep(0.25)
+        self.assertEqual(client.call('expensive_in_thread', 1), 1)
+        self.assertEqual(client.call('get_computed'), 7)
+
+        self._server.invalidate()
+        self.assertEqual(len(self._server.response_cache), 0)
+
     def test_raise_error(self):
         client = self.setup_env();
         self.assertRaises(error.RPCError, lambda: client.call('raise_error'))
@@ -162,15 +609,565 @@ class TestMessagePackRPC(unittest.TestCase):
             message = e.args[0]
             self.assertEqual(message, "'unknown' method not found", "Error message mismatched")
 
+    def test_private_method(self):
+        client = self.setup_env();
+        try:
+            client.call('_private')
+            self.assertTrue(False)
+        except error.RPCError as e:
+            self.assertEqual(e.args[0], "'_private' method not found")
+
+    def test_exports(self):
+        client = self.setup_env(exports=['hello']);
+        self.assertEqual(client.call('hello'), "world")
+        self.assertRaises(error.RPCError, lambda: client.call('sum', 1, 2))
+
+        self._server.refresh_dispatch_table(['hello', 'sum'])
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+        # Names unpacked without an encoding are bytes.
+        self._server.refresh_dispatch_table([b'hello', b'sum'])
+        self.assertEqual(client.call('hello'), "world")
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+        class ExportServer(object):
+            @msgpackrpc.server.export
+            def exported(self):
+                return True
+
+            def unexported(self):
+                return False
+
+        server = self.new_server(ExportServer())
+        self.assertEqual(set(server._dispatch_table), set([b'exported', 'exported']))
+
     def test_async_result(self):
         client = self.setup_env();
         self.assertEqual(client.call('async_result'), "You are async!")
 
+    def test_executor_offload(self):
+        client = self.setup_env(thread_pool_size=2, executor_queue_limit=2);
+
+        blocking = client.call_async('blocking_sleep', 0.5)
+        before = time()
+        self.assertEqual(client.call('hello'), "world")
+        self.assertLess(time() - before, 0.4)
+        self.assertEqual(blocking.get(), 0.5)
+
+        futures = client.call_many_async([('blocking_sleep', [0.2])] * 3)
+        client.wait_all(futures)
+        self.assertEqual([f.result for f in futures[:2]], [0.2, 0.2])
+        self.assertRaises(error.RPCError, futures[2].get)
+
+        self.assertNotEqual(client.call('pool_pid'), os.getpid())
+
+    def test_compression(self):
+        client = self.setup_env();
+        client = self.new_client(unpack_encoding='utf-8', compression=['nope', 'zlib'], compression_threshold=1024)
+
+        self.assertEqual(client.call('echo', 'small'), 'small')
+        payload = ['record {0}'.format(x % 10) for x in range(10000)]
+        self.assertEqual(client.call('echo', payload), payload)
+        self.assertEqual(client.call_many([('echo', [payload])] * 3), [payload] * 3)
+
+        stats = client.compression_stats
+        # call_many is one write; its three responses are three.
+        self.assertEqual((stats.frames, stats.decompressed_frames), (2, 4))
+        self.assertGreater(stats.ratio, 10)
+        server_stats = self._server.compression_stats
+        self.assertEqual((server_stats.frames, server_stats.decompressed_frames), (4, 2))
+        client.close()
+
+        client = self.new_client(unpack_encoding='utf-8', compression=['nope'])
+        self.assertEqual(client.call('echo', payload), payload)
+        self.assertEqual(client.compression_stats.frames, 0)
+        client.close()
+
+    def test_compression_limit(self):
+        client = self.setup_env(max_buffer_size=64 * 1024);
+        client = self.new_client(unpack_encoding='utf-8', compression=['zlib'], compression_threshold=1024)
+        self.assertEqual(client.call('echo', 'x' * 32 * 1024), 'x' * 32 * 1024)
+
+        # A small frame expanding beyond max_buffer_size closes the connection.
+        self.assertRaises(error.TransportError, lambda: client.call('echo', 'x' * 1024 * 1024))
+        client.close()
+        self.assertEqual(self._client.call('hello'), 'world')
+
+        stats = msgpackrpc.compression.CompressionStats()
+        codec = msgpackrpc.compression.get('zlib')
+        bomb = codec.compress(b'\0' * 1024 * 1024)
+        self.assertRaises(error.RPCError, lambda: msgpackrpc.compression.decompress(codec, bomb, stats, 1024))
+        self.assertEqual(len(msgpackrpc.compression.decompress(codec, bomb, stats, 1024 * 1024)), 1024 * 1024)
+
+    def test_compression_refused(self):
+        client = self.setup_env(compression=());
+        client = self.new_client(unpack_encoding='utf-8', compression=['zlib'], compression_threshold=0)
+        self.assertEqual(client.call('echo', 'x' * 10000), 'x' * 10000)
+        self.assertEqual(client.compression_stats.frames, 0)
+        self.assertEqual(self._server.compression_stats.frames, 0)
+        client.close()
+
+    def test_stream(self):
+        client = self.setup_env(stream_chunk_size=10);
+
+        # Without the streaming option the result comes as one list.
+        self.assertEqual(client.call('count', 5), list(range(5)))
+        self.assertEqual(list(client.call_stream('count', 3)), [0, 1, 2])
+
+        client = self.new_client(unpack_encoding='utf-8', streaming=True)
+        self.assertEqual(list(client.call_stream('count', 1000)), list(range(1000)))
+        self.assertEqual(client.call('count', 25), list(range(25)))
+        self.assertEqual(list(client.call_stream('sum', [1], [2])), [1, 2])
+
+        items = []
+        def consume():
+            for item in client.call_stream('count', 100, 55):
+                items.append(item)
+        self.assertRaises(error.RPCError, consume)
+        self.assertEqual(items, list(range(50)))
+
+        # The handler only runs ahead of the consumer by what the socket buffers hold.
+        stream = client.call_stream('blobs', 1000, 64 * 1024)
+        self.assertEqual(len(next(stream)), 64 * 1024)
+        self.assertLess(self._client.call('get_produced'), 1000)
+        self.assertEqual(sum(1 for blob in stream), 999)
+        self.assertEqual(self._client.call('get_produced'), 1000)
+        client.close()
+
+    def test_stream_buffer_limit(self):
+        self.setup_env(stream_chunk_size=10);
+
+        client = self.new_client(unpack_encoding='utf-8', streaming=True, pool_size=2, max_stream_chunks=4)
+        client.call_many([('sum', [x, 1]) for x in range(4)])
+        future = client.send_request('count', [2000])
+        items = future.stream()
+        self.assertEqual(next(items), 0)
+        # Other calls run the loop; the stream stops being read at the limit.
+        self.assertEqual(client.call('sleep', 0.2), 0.2)
+        self.assertLessEqual(future.buffered, 4)
+        self.assertEqual(list(items), list(range(1, 2000)))
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+        # A caller which stops iterating lets the connection read on.
+        items = client.call_stream('count', 2000)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(client.call('count', 30), list(range(30)))
+
+        # The paused connection is not read from either, so the server's
+        # handler stops once the socket buffers are full.
+        stream = client.call_stream('blobs', 2000, 64 * 1024)
+        self.assertEqual(len(next(stream)), 64 * 1024)
+        self.assertEqual(client.call('blocking_sleep', 0.5), 0.5)
+        self.assertLess(self._client.call('get_produced'), 1000)
+        stream.close()
+        client.close()
+
+        client = msgpackrpc.ThreadedClient(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                           streaming=True, max_stream_chunks=4, **self.client_options())
+        future = client.send_request('count', [2000])
+        items = future.stream()
+        self.assertEqual(next(items), 0)
+        sleep(0.2)
+        self.assertLessEqual(future.buffered, 4)
+        self.assertEqual(list(items), list(range(1, 2000)))
+        client.close()
+
+    def test_metrics(self):
+        client = self.setup_env(metrics=True);
+        client = self.new_client(unpack_encoding='utf-8', metrics=True)
+
+        for x in range(10):
+            client.call('sum', x, 1)
+        self.assertRaises(error.RPCError, lambda: client.call('raise_error'))
+        self.assertRaises(error.RPCError, lambda: client.call('unknown'))
+        self.assertEqual(client.call('async_result'), "You are async!")
+
+        server = self._server.metrics.snapshot()
+        self.assertEqual(server['sum']['requests'], 10)
+        self.assertEqual(server['sum']['errors'], 0)
+        self.assertEqual(server['raise_error']['errors'], 1)
+        self.assertEqual(server[msgpackrpc.metrics.UNKNOWN_METHOD]['errors'], 1)
+        self.assertEqual(server['async_result']['in_flight'], 0)
+        self.assertGreater(server['async_result']['p50'], 1.5)
+
+        stats = client.metrics.snapshot()
+        self.assertEqual(set(stats), set(['sum', 'raise_error', 'unknown', 'async_result']))
+        self.assertEqual((stats['sum']['requests'], stats['sum']['in_flight']), (10, 0))
+        self.assertEqual(stats['unknown']['errors'], 1)
+        self.assertTrue(0 < stats['sum']['p50'] <= stats['sum']['p99'] <= stats['sum']['max'])
+        client.close()
+
+        self.assertIsNone(self._client.metrics)
+
+        histogram = msgpackrpc.metrics.Histogram()
+        for value in range(1, 100001):
+            histogram.record(value)
+
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (100000, 1, 100000))
+        for percent in (1, 50, 90, 99, 99.9):
+            expected = 1000 * percent
+            self.assertLessEqual(abs(histogram.percentile(percent) - expected), expected * 0.04)
+        self.assertEqual(histogram.percentile(100), 100000)
+
+        small = msgpackrpc.metrics.Histogram()
+        for value in range(64):
+            small.record(value)
+        self.assertEqual([small.percentile(p) for p in (50, 100)], [31, 63])
+
+        histogram.merge(small)
+        self.assertEqual((histogram.count, histogram.min), (100064, 0))
+
+    def test_inflight_limit(self):
+        client = self.setup_env(thread_pool_size=4, max_inflight=1);
+
+        # Only one request of the flooding connection runs at a time, so the
+        # thread pool stays free for other connections.
+        flooder = self.new_client(unpack_encoding='utf-8')
+        before = time()
+        futures = flooder.call_many_async([('blocking_sleep', [0.2])] * 3)
+        self.assertEqual(client.call('blocking_sleep', 0.1), 0.1)
+        self.assertLess(time() - before, 0.2)
+        flooder.wait_all(futures)
+        self.assertGreaterEqual(time() - before, 0.6)
+        self.assertEqual([f.get() for f in futures], [0.2] * 3)
+        self.assertTrue(self.wait_for(lambda: self._server.inflight == 0))
+        flooder.close()
+
+        # While paused the server stops reading: the flood is held back by
+        # the socket buffers instead of piling up in the server.
+        flooder = self._address.socket()
+        flooder.settimeout(0.5)
+        flooder.connect(self._address.resolve()[0][3])
+        flood = msgpack.packb([0, 1, 'echo', [b'x' * 64 * 1024]]) * 16
+        sent = 0
+        try:
+            flooder.sendall(msgpack.packb([0, 0, 'blocking_sleep', [1.0]]))
+            while sent < 64 * 1024 * 1024:
+                view = memoryview(flood)
+                while view:
+                    size = flooder.send(view)
+                    view = view[size:]
+                    sent += size
+        except socket.timeout:
+            pass
+        finally:
+            flooder.close()
+        self.assertLess(sent, 32 * 1024 * 1024)
+
+    def test_inflight_total_limit(self):
+        client = self.setup_env(thread_pool_size=4, max_inflight_total=2, max_pending_writes=1024);
+
+        other = self.new_client(unpack_encoding='utf-8')
+        before = time()
+        futures = client.call_many_async([('blocking_sleep', [0.2])] * 2)
+        client.wait_all([client.call_async('hello')])
+        self.assertGreaterEqual(time() - before, 0.2)
+        self.assertEqual(other.call('echo', 'x' * 100000), 'x' * 100000)
+        self.assertEqual([f.get() for f in futures], [0.2] * 2)
+        self.assertTrue(self.wait_for(lambda: self._server.inflight == 0))
+        other.close()
+
     def test_connect_failed(self):
         client = self.setup_env();
-        port = helper.unused_port()
-        client = msgpackrpc.Client(msgpackrpc.Address('localhost', port), unpack_encoding='utf-8')
+        client = self.new_client(self.unused_address(), unpack_encoding='utf-8')
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+
+    def test_resolver(self):
+        client = self.setup_env();
+        if not isinstance(self._address, msgpackrpc.Address):
+            return
+
+        port = self._address.port
+        resolver = msgpackrpc.address.Resolver(ttl=60)
+        address = msgpackrpc.Address('localhost', port, resolver=resolver)
+        for x in range(3):
+            client = self.new_client(address)
+            self.assertEqual(client.call('sum', 1, 2), 3)
+            client.close()
+        self.assertEqual((resolver.stats.lookups, resolver.stats.misses, resolver.stats.hits), (3, 1, 2))
+        self.assertGreater(resolver.stats.seconds, 0)
+
+        # Entries expire after ttl seconds of the clock.
+        now = [0]
+        resolver = msgpackrpc.address.Resolver(ttl=60, clock=lambda: now[0])
+        resolver.resolve('localhost', port)
+        resolver.resolve('localhost', port)
+        now[0] = 61
+        resolver.resolve('localhost', port)
+        self.assertEqual((resolver.stats.misses, resolver.stats.hits), (2, 1))
+
+        # Concurrent misses share one lookup.
+        live = (socket.AF_INET, socket.SOCK_STREAM, 0, ('127.0.0.1', port))
+        resolver = self.TestResolver({'backends': [live]}, delay=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(resolver.resolve('backends', port)))
+                   for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[live]] * 4)
+        self.assertEqual((resolver.stats.misses, resolver.stats.coalesced), (1, 3))
+
+        # A refusing and a silent address (its accept queue is full) before
+        # the server's
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        fillers = [socket.socket() for x in range(2)]
+        for filler in fillers:
+            filler.setblocking(0)
+            filler.connect_ex(listener.getsockname())
+        dead = (socket.AF_INET, socket.SOCK_STREAM, 0, ('127.0.0.1', helper.unused_port()))
+        silent = (socket.AF_INET, socket.SOCK_STREAM, 0, listener.getsockname())
+        resolver = self.TestResolver({'backends': [dead, silent, live]})
+        client = self.new_client(msgpackrpc.Address('backends', port, resolver=resolver), connect_delay=0.05)
+        try:
+            self.assertEqual(client.call('sum', 1, 2), 3)
+        finally:
+            client.close()
+            for sock in fillers + [listener]:
+                sock.close()
+
+        # Nothing answers: the cached resolution is dropped.
+        resolver = self.TestResolver({'backends': [dead]})
+        client = self.new_client(msgpackrpc.Address('backends', port, resolver=resolver), reconnect_limit=1)
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+        client.close()
+        misses = resolver.stats.misses
+        resolver.resolve('backends', port)
+        self.assertEqual(resolver.stats.misses, misses + 1)
+
+    def test_connection_lost(self):
+        self.setup_env();
+        client = self.new_client(unpack_encoding='utf-8', idempotent=['blocking_sleep'])
+        try:
+            self.assertEqual(client.call('sum', 1, 2), 3)
+            replayed = client.call_async('blocking_sleep', 0.2)
+            failed = client.call_async('sleep', 0.2)
+            client._transport._sockets[0]._stream.close()
+
+            started = time()
+            self.assertRaises(error.TransportError, failed.get)
+            self.assertLess(time() - started, 1)
+            self.assertEqual(replayed.get(), 0.2)
+            self.assertEqual(client.call('sum', 1, 2), 3)
+        finally:
+            client.close()
+
+        # A server dropping every connection gets MAX_REPLAYS replays.
+        address = self.unused_address()
+        listener = address.socket()
+        listener.setblocking(1)
+        listener.bind(address.resolve()[0][3])
+        listener.listen(8)
+        accepted = []
+
+        def drop():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except socket.error:
+                    return
+                accepted.append(conn)
+                conn.recv(4096)
+                conn.close()
+
+        thread = threading.Thread(target=drop)
+        thread.daemon = True
+        thread.start()
+        client = self.new_client(address, idempotent=['sum'])
+        try:
+            self.assertRaises(error.TransportError, lambda: client.call('sum', 1, 2))
+            self.assertEqual(len(accepted), msgpackrpc.session.MAX_REPLAYS + 1)
+        finally:
+            client.close()
+            listener.shutdown(socket.SHUT_RDWR)
+            listener.close()
+            thread.join(1)
+
+    def test_reconnect_backoff(self):
+        self.setup_env();
+
+        client = self.new_client(self.unused_address(), reconnect_limit=3, reconnect_delay=0.1)
+        started = time()
         self.assertRaises(error.TransportError, lambda: client.call('hello'))
+        # 0.05-0.1 and 0.1-0.2 seconds
+        self.assertGreater(time() - started, 0.15)
+
+        client = self.new_client(self.unused_address(), reconnect_limit=100, reconnect_delay=10, max_pending=2)
+        try:
+            futures = [client.call_async('hello') for x in range(3)]
+            self.assertEqual([future.done for future in futures], [False, False, True])
+            self.assertRaises(error.TransportError, futures[2].get)
+        finally:
+            client.close()
+
+    def test_balancing_client(self):
+        self.setup_env();
+        address = self.unused_address()
+        server, thread = self.start_server(address)
+
+        addresses = [self._address, address, self.unused_address()]
+        for balance in ('ewma', 'outstanding'):
+            client = msgpackrpc.BalancingClient(addresses, builder=self.BUILDER, balance=balance,
+                                                reconnect_limit=2, eject_time=60, **self.client_options())
+            try:
+                results = client.call_many([('sum', [x, 1]) for x in range(200)])
+                self.assertEqual(results, [x + 1 for x in range(200)])
+                for x in range(50):
+                    self.assertEqual(client.call('sum', x, 2), x + 2)
+
+                live, other, dead = client.backends
+                self.assertTrue(dead.ejected)
+                self.assertFalse(live.ejected or other.ejected)
+                self.assertGreater(live.requests, 0)
+                self.assertGreater(other.requests, 0)
+                self.assertEqual(live.outstanding + other.outstanding + dead.outstanding, 0)
+                self.assertGreater(live.latency, 0)
+            finally:
+                client.close()
+
+        # A backend without a latency sample does not draw the whole burst.
+        client = msgpackrpc.BalancingClient(addresses[:2], builder=self.BUILDER, **self.client_options())
+        try:
+            client.call('sum', 1, 2)
+            measured = [backend for backend in client.backends if backend.latency]
+            self.assertEqual(len(measured), 1)
+            before = [backend.requests for backend in client.backends]
+            client.call_many([('sum', [x, 1]) for x in range(200)])
+            for backend, requests in zip(client.backends, before):
+                self.assertGreater(backend.requests - requests, 50)
+        finally:
+            client.close()
+
+        # An ejected backend is probed and comes back once it is up.
+        client = msgpackrpc.BalancingClient(addresses, builder=self.BUILDER, reconnect_limit=1, eject_time=0.05,
+                                            **self.client_options())
+        client.call_many([('sum', [x, 1]) for x in range(20)])
+        dead = client.backends[2]
+        self.assertTrue(dead.ejected)
+        revived, revived_thread = self.start_server(addresses[2])
+        try:
+            for x in range(200):
+                client.call('sum', 1, 2)
+                if not dead.ejected:
+                    break
+                sleep(0.01)
+            self.assertFalse(dead.ejected)
+        finally:
+            client.close()
+            for extra, extra_thread in ((server, thread), (revived, revived_thread)):
+                extra.stop()
+                extra_thread.join()
+
+    def test_hedging(self):
+        self.setup_env();
+        prefix = self.__class__.__name__
+
+        hedging = msgpackrpc.hedge.Hedging(['stall_once'], delay=0.05, budget=1.0)
+        client = self.new_client(pool_size=2, metrics=True, hedging=hedging, unpack_encoding='utf-8')
+        try:
+            started = monotonic()
+            self.assertEqual(client.call('stall_once', prefix + 'a', 1.0), prefix + 'a')
+            self.assertLess(monotonic() - started, 0.8)
+            self.assertEqual((hedging.stats.requests, hedging.stats.hedged, hedging.stats.wins), (1, 1, 1))
+            self.assertEqual(client.metrics.snapshot()['stall_once']['requests'], 1)
+            self.assertEqual(client.metrics.snapshot()['stall_once']['in_flight'], 0)
+
+            # Answered before the delay: not hedged.
+            self.assertEqual(client.call('stall_once', prefix + 'a', 1.0), prefix + 'a')
+            self.assertEqual(hedging.stats.hedged, 1)
+
+            # The late answer of the first copy is dropped.
+            sleep(1.0)
+            self.assertEqual(client.call('sum', 1, 2), 3)
+            self.assertEqual(client._request_table, {})
+            self.assertEqual(client._hedges, {})
+        finally:
+            client.close()
+
+        # Without budget left the request waits for its only copy.
+        hedging = msgpackrpc.hedge.Hedging(['stall_once'], delay=0.05, budget=0.0)
+        client = self.new_client(pool_size=2, hedging=hedging, unpack_encoding='utf-8')
+        try:
+            started = monotonic()
+            self.assertEqual(client.call('stall_once', prefix + 'b', 0.3), prefix + 'b')
+            self.assertGreaterEqual(monotonic() - started, 0.3)
+            self.assertEqual((hedging.stats.hedged, hedging.stats.throttled), (0, 1))
+        finally:
+            client.close()
+
+        # A single connection has nowhere else to send the copy.
+        hedging = msgpackrpc.hedge.Hedging(['stall_once'], delay=0.05, budget=1.0)
+        client = self.new_client(hedging=hedging, unpack_encoding='utf-8')
+        try:
+            started = monotonic()
+            self.assertEqual(client.call('stall_once', prefix + 'd', 0.3), prefix + 'd')
+            self.assertGreaterEqual(monotonic() - started, 0.3)
+            self.assertEqual((hedging.stats.requests, hedging.stats.hedged, hedging.stats.throttled), (1, 0, 0))
+        finally:
+            client.close()
+
+        # The delay follows the observed round-trip times.
+        hedging = msgpackrpc.hedge.Hedging(['sum'], percentile=90, initial_delay=5)
+        client = self.new_client(pool_size=2, hedging=hedging)
+        try:
+            self.assertEqual(hedging.delay('sum'), 5)
+            for x in range(30):
+                client.call('sum', x, 1)
+            self.assertLess(hedging.delay('sum'), 1)
+            # The default budget of 5% allows one copy in 30 requests.
+            self.assertLessEqual(hedging.stats.hedged, 1)
+        finally:
+            client.close()
+
+        # A BalancingClient sends the copy to another backend.
+        address = self.unused_address()
+        server, thread = self.start_server(address)
+        hedging = msgpackrpc.hedge.Hedging(['stall_once'], delay=0.05, budget=1.0)
+        client = msgpackrpc.BalancingClient([self._address, address], builder=self.BUILDER, hedging=hedging,
+                                            unpack_encoding='utf-8', **self.client_options())
+        try:
+            started = monotonic()
+            self.assertEqual(client.call('stall_once', prefix + 'c', 1.0), prefix + 'c')
+            self.assertLess(monotonic() - started, 0.8)
+            self.assertEqual([backend.requests for backend in client.backends], [1, 1])
+        finally:
+            client.close()
+            server.stop()
+            thread.join()
+
+    def test_subsecond_timeout(self):
+        client = self.setup_env();
+
+        self.assertRaises(error.TimeoutError, lambda: client.call('sleep', 0.3, timeout=0.05))
+        self.assertEqual(client.call('sleep', 0.05, timeout=1), 0.05)
+        self.assertRaises(TypeError, lambda: client.call('hello', unknown=1))
+
+        client = self.new_client(timeout=0.05, unpack_encoding='utf-8')
+        future = client.call_async('sleep', 0.3)
+        self.assertRaises(error.TimeoutError, future.get)
+        self.assertEqual(client.call('sleep', 0.1, timeout=2), 0.1)
+        self.assertEqual(client.call('hello'), "world")
+        client.close()
+
+    def test_step_timeout(self):
+        client = self.setup_env();
+
+        future = client.call_async('sleep', 0.3, timeout=0.05)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertFalse(future.step_timeout())
+            sleep(0.1)
+            self.assertTrue(future.step_timeout())
+            client.step_timeout()
+        self.assertTrue(future.done)
+        self.assertRaises(error.TimeoutError, future.get)
+        caught = [w.category for w in caught if 'step_timeout' in str(w.message)]
+        self.assertEqual(caught, [DeprecationWarning] * 3)
+        self.assertEqual(client.call('sleep', 0.05), 0.05)
 
     def test_timeout(self):
         client = self.setup_env();
@@ -178,12 +1175,100 @@ class TestMessagePackRPC(unittest.TestCase):
         if self.__class__.ENABLE_TIMEOUT_TEST:
             self.assertEqual(client.call('long_exec'), 'finish!', "'long_exec' result is incorrect")
 
-            client = msgpackrpc.Client(self._address, timeout=1, unpack_encoding='utf-8')
+            client = self.new_client(timeout=1, unpack_encoding='utf-8')
             self.assertRaises(error.TimeoutError, lambda: client.call('long_exec'))
         else:
             print("Skip test_timeout")
 
 
+@unittest.skipUnless(DIRECT_IO_SUPPORTED, "needs Python 3.3")
+class TestMessagePackRPCDirectIO(TestMessagePackRPC):
+    # Everything once more with recv_into reads on both sides.
+
+    def client_options(self):
+        return {'read_into': True}
+
+    def new_server(self, dispatcher=None, **options):
+        options.setdefault('read_into', True)
+        return TestMessagePackRPC.new_server(self, dispatcher, **options)
+
+
+class TestMessagePackRPCUnix(TestMessagePackRPC):
+    BUILDER = unix
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._count = 0
+        TestMessagePackRPC.setUp(self)
+
+    def tearDown(self):
+        TestMessagePackRPC.tearDown(self)
+        self.assertFalse(os.path.exists(self._address.path), "socket file is not removed")
+        shutil.rmtree(self._tempdir)
+
+    def unused_address(self):
+        self._count += 1
+        return msgpackrpc.UnixAddress(os.path.join(self._tempdir, 'rpc{0}.sock'.format(self._count)))
+
+
+class TestMessagePackRPCSharedMemory(TestMessagePackRPCUnix):
+    BUILDER = shm
+
+    def tearDown(self):
+        regions = [name for name in os.listdir(self._tempdir) if name.startswith('msgpackrpc-')]
+        TestMessagePackRPCUnix.tearDown(self)
+        self.assertEqual(regions, [], "shared memory regions are not reclaimed")
+
+    def client_options(self):
+        return {'shm_dir': self._tempdir}
+
+    def new_server(self, dispatcher=None, **options):
+        options.setdefault('shm_dir', self._tempdir)
+        return TestMessagePackRPCUnix.new_server(self, dispatcher, **options)
+
+    def test_shared_memory_payload(self):
+        client = self.setup_env(shm_threshold=1024);
+
+        payload = os.urandom(2 * 1024 * 1024)
+        self.assertEqual(client.call('echo', payload), payload)
+        self.assertEqual(client.call('echo', [1, {'big': payload}]), [1, {'big': payload}])
+        self.assertLess(client.write_stats.bytes, 1024)
+        self.assertEqual(client._transport.shm_stats.regions, 2)
+        self.assertEqual(client._transport.shm_stats.bytes, 2 * len(payload))
+
+        # Small messages are packed as they are.
+        self.assertEqual(len(client.call('echo', b'x' * 100)), 100)
+        self.assertEqual(client._transport.shm_stats.regions, 2)
+
+    def test_shared_memory_ownership(self):
+        client = self.setup_env(shm_threshold=1024);
+
+        # A peer may only hand over regions it created itself.
+        victim = os.path.join(self._tempdir, 'victim')
+        with open(victim, 'wb') as f:
+            f.write(b'x' * 4096)
+        forged = os.path.join(self._tempdir, 'msgpackrpc-1-forged')
+        shutil.copy(victim, forged)
+        link = os.path.join(self._tempdir, 'msgpackrpc-{0}-link'.format(os.getpid()))
+        os.symlink(victim, link)
+        try:
+            for name in (os.path.basename(forged), os.path.basename(link)):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self._address.path)
+                region = msgpack.ExtType(shm.EXT_CODE, msgpack.packb([name, 4096]))
+                sock.sendall(msgpack.packb([0, 1, 'echo', [region]]))
+                # The server closes the connection instead of answering.
+                self.assertEqual(sock.recv(1024), b'')
+                sock.close()
+            self.assertTrue(os.path.exists(forged))
+            self.assertTrue(os.path.islink(link))
+            self.assertTrue(os.path.exists(victim))
+        finally:
+            for path in (victim, forged, link):
+                os.unlink(path)
+        self.assertEqual(client.call('hello'), 'world')
+
+
 if __name__ == '__main__':
     import sys
 